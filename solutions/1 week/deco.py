@@ -1,74 +1,1568 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import sys
+import dis
+import json
+import math
+import time
+import mmap
+import fcntl
+import atexit
+import shutil
+import struct
+import sqlite3
+import tempfile
+import textwrap
+import hashlib
+import marshal
+import inspect
+import weakref
+import cPickle
+import thread
+import threading
+import itertools
+import collections
 from functools import update_wrapper
 from functools import wraps
 
 
-def disable():
+DISABLE_ENV = 'DECO_DISABLE'
+DEBUG_DECORATORS = ('trace', 'countcalls')
+
+
+def _parse_disabled(value):
+    '''Names of disabled decorators from 'trace,countcalls,memo'; '1' or 'all' stand for DEBUG_DECORATORS.'''
+    names = set(name.strip() for name in value.split(',') if name.strip())
+    if names & {'1', 'all', 'true', 'yes'}:
+        names = (names - {'1', 'all', 'true', 'yes'}) | set(DEBUG_DECORATORS)
+    return names
+
+
+DISABLED = _parse_disabled(os.environ.get(DISABLE_ENV, ''))
+
+
+def configure(disabled=DEBUG_DECORATORS):
+    '''
+    Turn the named decorators ('trace', 'countcalls', 'memo') into no-ops
+    for functions decorated from now on; configure(()) enables them all.
+    The DECO_DISABLE environment variable does the same at import.
+    '''
+    DISABLED.clear()
+    DISABLED.update(disabled)
+
+
+def disable(func=None, *args, **kwargs):
     '''
     Disable a decorator by re-assigning the decorator's name
     to this function. For example, to turn off memoization:
 
     >>> memo = disable
 
+    The function is returned as is, so it gets no extra frame. Works in
+    place of decorators with arguments too: @disable("####").
+    '''
+    if callable(func) and not args and not kwargs:
+        return func
+    return disable
+
+
+def _signature(func, reserved=()):
+    '''
+    Source of the parameters and of the call arguments of func, and its
+    defaults, for a generated wrapper with the same signature (defaults
+    refer to _defaults_). None when it cannot be reproduced: not a plain
+    Python function (a bound method's argspec has self, which its callers
+    do not pass; partials and builtins have none), tuple parameters or
+    names clashing with reserved.
+    '''
+    if not inspect.isfunction(func):
+        return None
+    spec = inspect.getargspec(func)
+    names = list(spec.args) + [spec.varargs, spec.keywords]
+    if any(isinstance(name, list) or name in reserved for name in names if name):
+        return None
+    defaults = spec.defaults or ()
+    required = len(spec.args) - len(defaults)
+    parameters = spec.args[:required] + ['{}=_defaults_[{}]'.format(name, index)
+                                         for index, name in enumerate(spec.args[required:])]
+    arguments = list(spec.args)
+    if spec.varargs:
+        parameters.append('*' + spec.varargs)
+        arguments.append('*' + spec.varargs)
+    if spec.keywords:
+        parameters.append('**' + spec.keywords)
+        arguments.append('**' + spec.keywords)
+    return ', '.join(parameters), ', '.join(arguments), defaults
+
+
+def _compile_wrapper(source, namespace):
+    '''Define the function named wrapper in source with the globals in namespace.'''
+    code = compile(source, '<deco wrapper>', 'exec')
+    exec code in namespace
+    return namespace['wrapper']
+
+
+_WRAPPER_HEADER = re.compile(r'^def\s+\w+\s*\(\s*\*\s*(\w+)\s*,\s*\*\*\s*(\w+)\s*\)\s*:\s*$')
+_LOCAL_WRITES = frozenset(dis.opmap[name] for name in ('STORE_FAST', 'DELETE_FAST'))
+
+
+def _rebinds(code, names):
+    '''Whether the code assigns to (or deletes) any of its local variables in names.'''
+    if any(name in code.co_cellvars for name in names):
+        return True
+    indices = set(code.co_varnames.index(name) for name in names if name in code.co_varnames)
+    bytecode = bytearray(code.co_code)
+    offset, extended = 0, 0
+    while offset < len(bytecode):
+        op = bytecode[offset]
+        if op < dis.HAVE_ARGUMENT:
+            offset += 1
+            continue
+        arg = bytecode[offset + 1] | bytecode[offset + 2] << 8 | extended
+        offset += 3
+        extended = arg << 16 if op == dis.EXTENDED_ARG else 0
+        if op in _LOCAL_WRITES and arg in indices:
+            return True
+    return False
+
+
+def _specialize(wrapper, func):
+    '''
+    Recompile a wrapper written as def wrapper(*args, **kwargs) with the
+    exact parameters of func. The body is the wrapper's own, so there is
+    no extra frame: calls go straight into it and the forwarding
+    func(*args, **kwargs) becomes a plain call. Other uses of args and
+    kwargs see the arguments packed positionally. None when the source is
+    not available, the wrapper does not have that form or it rebinds args
+    or kwargs.
     '''
-    return
+    code = getattr(wrapper, '__code__', None)
+    if code is None or wrapper.__closure__ is None and code.co_freevars:
+        return None
+    try:
+        lines = textwrap.dedent(''.join(inspect.getsourcelines(code)[0])).splitlines()
+        cells = [cell.cell_contents for cell in wrapper.__closure__ or ()]
+    except (IOError, TypeError, ValueError):
+        return None
+    while lines and lines[0].startswith('@'):
+        lines.pop(0)
+    match = _WRAPPER_HEADER.match(lines[0]) if lines else None
+    body = '\n'.join(lines[1:])
+    if match is None or "'''" in body or '"""' in body:
+        # indenting the body would change multi-line strings
+        return None
+    args_name, kwargs_name = match.groups()
+    if _rebinds(code, (args_name, kwargs_name)):
+        # the forwarding call would no longer pass the arguments as they came
+        return None
+    signature = _signature(func, reserved=code.co_freevars + (args_name, kwargs_name, '_defaults_'))
+    if signature is None:
+        return None
+    parameters, arguments, defaults = signature
+    spec = inspect.getargspec(func)
+    body = body.replace('(*{}, **{})'.format(args_name, kwargs_name), '({})'.format(arguments))
+    prelude = []
+    if re.search(r'\b{}\b'.format(args_name), body):
+        packed = '({},)'.format(', '.join(spec.args)) if spec.args else '()'
+        prelude.append('{} = {}{}'.format(args_name, packed, ' + ' + spec.varargs if spec.varargs else ''))
+    if re.search(r'\b{}\b'.format(kwargs_name), body):
+        prelude.append('{} = {}'.format(kwargs_name, spec.keywords or '{}'))
+    source = 'def _make_({}):\n    def wrapper({}):\n{}{}\n    return wrapper\n'.format(
+        ', '.join(code.co_freevars + ('_defaults_',)), parameters,
+        ''.join('        {}\n'.format(line) for line in prelude),
+        '\n'.join('    ' + line if line.strip() else line for line in body.splitlines()))
+    namespace = {}
+    # the wrapper's module globals stay live; its closure becomes the factory's arguments
+    exec compile(source, code.co_filename, 'exec') in wrapper.__globals__, namespace
+    fixed = namespace['_make_'](*(cells + [defaults]))
+    update_wrapper(fixed, func, updated=())
+    fixed.__dict__.update(wrapper.__dict__)
+    return fixed
 
 
-def decorator():
+def decorator(deco):
     '''
     Decorate a decorator so that it inherits the docstrings
-    and stuff from the function it's decorating.
+    and stuff from the function it's decorating. A wrapper written as
+    def wrapper(*args, **kwargs) is recompiled with exactly the signature
+    of the decorated function (see _specialize): no argument packing and
+    no extra call per call, and introspection (inspect.getargspec) sees
+    the function's own parameters. The decorator may take options:
+    @deco, @deco(option=...) and deco(func, option=...) all work.
+    '''
+    @wraps(deco)
+    def wrapped(func=None, *args, **kwargs):
+        if func is None:
+            return lambda func: wrapped(func, *args, **kwargs)
+        wrapper = deco(func, *args, **kwargs)
+        if wrapper is func:
+            return func
+        fixed = _specialize(wrapper, func)
+        return update_wrapper(wrapper, func) if fixed is None else fixed
+    return wrapped
+
+
+LATENCY_BUCKETS = 112  # 4 per octave from 1 us to about 4 minutes
+QUANTILES = (0.5, 0.95, 0.99)
+
+METRICS = collections.OrderedDict()  # registry: function name -> CallMetrics
+_THREAD = threading.local()
+_BUCKET_OFFSET = 72  # puts 2 ** -20 s (about 1 us) into the first bucket
+# the finest wall clock available: perf_counter on Python 3, time.time (1 us) on Python 2
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def _bucket_bound(index):
+    '''Upper bound of a latency bucket, in seconds.'''
+    exponent, part = divmod(index - _BUCKET_OFFSET, 4)
+    return (part + 5) / 16.0 * 2.0 ** exponent
+
+
+class CallMetrics(object):
+    '''
+    Call statistics of a function. Every thread updates its own shard
+    without locking; the shards are merged when the statistics are read.
+    A shard is [calls, timed calls, total time, self time, histogram,
+    stack of the thread's timed calls].
+    '''
+
+    def __init__(self, name, sample=1):
+        self.name = name
+        self.sample = sample
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def new_shard(self):
+        try:
+            stack = _THREAD.stack
+        except AttributeError:
+            stack = _THREAD.stack = []
+        shard = self.local.shard = [0, 0, 0.0, 0.0, [0] * LATENCY_BUCKETS, stack]
+        with self.lock:
+            self.shards.append(shard)
+        return shard
+
+    def _merged(self, field):
+        return sum(shard[field] for shard in list(self.shards))
+
+    @property
+    def calls(self):
+        return self._merged(0)
+
+    def histogram(self):
+        histogram = [0] * LATENCY_BUCKETS
+        for shard in list(self.shards):
+            for index, count in enumerate(shard[4]):
+                histogram[index] += count
+        return histogram
+
+    def quantile(self, q):
+        '''Latency quantile in seconds, up to the histogram resolution (19%).'''
+        histogram = self.histogram()
+        rank = q * sum(histogram)
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if count and seen >= rank:
+                return _bucket_bound(index)
+        return 0.0
+
+    def snapshot(self):
+        '''
+        Statistics as a dict. Times cover the timed calls only; with
+        sampling, untimed child calls count into their caller's self time.
+        '''
+        timed = self._merged(1)
+        total = self._merged(2)
+        return collections.OrderedDict([
+            ('calls', self.calls),
+            ('timed_calls', timed),
+            ('sample', self.sample),
+            ('total_time', float(total)),
+            ('self_time', float(self._merged(3))),
+            ('mean', total / timed if timed else 0.0),
+        ] + [('p{:g}'.format(q * 100), self.quantile(q)) for q in QUANTILES])
+
+    def reset(self):
+        for shard in list(self.shards):
+            shard[:5] = [0, 0, 0.0, 0.0, [0] * LATENCY_BUCKETS]
+
+
+@decorator
+def countcalls(func=None, sample=1, name=None):
+    '''
+    Decorator that counts calls made to the function decorated and
+    measures their latency: total and self time (without nested
+    instrumented calls) and a histogram for p50/p95/p99. With sample=N
+    only every N-th call is timed. The statistics are in wrapper.metrics
+    and in the METRICS registry, see dump_json and dump_prometheus.
+
+    Overhead per call (deco_bench.py, CPython 2.7 on a shared x86-64 VM):
+    about 2 us for a timed call, 0.6 us with sample=16.
+    '''
+    if 'countcalls' in DISABLED:
+        return disable(func)
+    if func is None:
+        return lambda func: countcalls(func, sample=sample, name=name)
+
+    metrics = CallMetrics(name or '{}.{}'.format(func.__module__, func.__name__), sample)
+    METRICS[metrics.name] = metrics
+    local = metrics.local
+    timer = _clock
+    frexp = math.frexp
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            shard = local.shard
+        except AttributeError:
+            shard = metrics.new_shard()
+        shard[0] += 1
+        if sample > 1 and shard[0] % sample:
+            return func(*args, **kwargs)
+        stack = shard[5]
+        stack.append(0.0)
+        start = timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = timer() - start
+            child = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            shard[1] += 1
+            shard[2] += elapsed
+            shard[3] += elapsed - child
+            if elapsed > 0:
+                mantissa, exponent = frexp(elapsed)
+                index = 4 * exponent + int(mantissa * 8) + _BUCKET_OFFSET
+                if index < 0:
+                    index = 0
+                elif index >= LATENCY_BUCKETS:
+                    index = LATENCY_BUCKETS - 1
+            else:
+                # faster than the clock resolution: frexp(0.0) would land in the 0.3 s bucket
+                index = 0
+            shard[4][index] += 1
+
+    wrapper.metrics = metrics
+    return wrapper
+
+
+def dump_json(metrics=None):
+    '''Statistics of the registered functions as a JSON document.'''
+    metrics = METRICS if metrics is None else metrics
+    return json.dumps(collections.OrderedDict(
+        (name, entry.snapshot()) for name, entry in metrics.items()), indent=2)
+
+
+def dump_prometheus(metrics=None, prefix='deco'):
+    '''Statistics of the registered functions in the Prometheus text format.'''
+    metrics = METRICS if metrics is None else metrics
+    lines = [
+        '# HELP {}_calls_total Calls of the function.'.format(prefix),
+        '# TYPE {}_calls_total counter'.format(prefix),
+    ]
+    for name, entry in metrics.items():
+        lines.append('{}_calls_total{{function="{}"}} {}'.format(prefix, name, entry.calls))
+    lines += [
+        '# HELP {}_self_seconds_total Time of the timed calls without nested instrumented calls.'.format(prefix),
+        '# TYPE {}_self_seconds_total counter'.format(prefix),
+    ]
+    for name, entry in metrics.items():
+        lines.append('{}_self_seconds_total{{function="{}"}} {!r}'.format(prefix, name, entry.snapshot()['self_time']))
+    lines += [
+        '# HELP {}_call_seconds Latency of the timed calls.'.format(prefix),
+        '# TYPE {}_call_seconds summary'.format(prefix),
+    ]
+    for name, entry in metrics.items():
+        snapshot = entry.snapshot()
+        for q in QUANTILES:
+            lines.append('{}_call_seconds{{function="{}",quantile="{:g}"}} {!r}'.format(
+                prefix, name, q, entry.quantile(q)))
+        lines.append('{}_call_seconds_sum{{function="{}"}} {!r}'.format(prefix, name, snapshot['total_time']))
+        lines.append('{}_call_seconds_count{{function="{}"}} {}'.format(prefix, name, snapshot['timed_calls']))
+    return '\n'.join(lines) + '\n'
+
+
+_MISSING = object()
+_KWARGS_MARK = object()
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses evictions maxsize currsize memory')
+
+
+def _make_key(args, kwargs):
+    '''Cache key: positional args, then keyword args sorted by name.'''
+    if not kwargs:
+        return args
+    return args + (_KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+
+
+class _Cache(object):
+    '''Unbounded store: a plain dict, the lookup is a single dict.get.'''
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self.data = {}
+        self.get = self.data.get
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def items(self):
+        return [(key, value) for key, value in self.data.items()]
+
+    def memory(self):
+        '''Approximate memory used by the keys and values, in bytes.'''
+        memory = sys.getsizeof(self.data)
+        for key, value in self.items():
+            memory += sys.getsizeof(key) + sys.getsizeof(value)
+        return memory
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class _LRUCache(_Cache):
+    '''Evicts the least recently used key: dict of links in a circular doubly linked list.'''
+
+    PREV, NEXT, KEY, VALUE = range(4)
+
+    def __init__(self, maxsize):
+        super(_LRUCache, self).__init__(maxsize)
+        self.get = self._get
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def _get(self, key, default=None):
+        link = self.data.get(key)
+        if link is None:
+            return default
+        # move the link to the most recently used end
+        link_prev, link_next, _, value = link
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+        last = self.root[0]
+        last[1] = self.root[0] = link
+        link[0] = last
+        link[1] = self.root
+        return value
+
+    def set(self, key, value):
+        link = self.data.get(key)
+        if link is not None:
+            link[3] = value
+            return
+        if len(self.data) >= self.maxsize:
+            oldest = self.root[1]
+            oldest[0][1] = oldest[1]
+            oldest[1][0] = oldest[0]
+            del self.data[oldest[2]]
+            self.evictions += 1
+        last = self.root[0]
+        link = [last, self.root, key, value]
+        last[1] = self.root[0] = self.data[key] = link
+
+    def items(self):
+        return [(key, link[3]) for key, link in self.data.items()]
+
+    def clear(self):
+        self.data.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+
+class _LFUCache(_Cache):
+    '''Evicts the least frequently used key (the oldest one among equals): frequency buckets.'''
+
+    def __init__(self, maxsize):
+        super(_LFUCache, self).__init__(maxsize)
+        self.get = self._get
+        self.buckets = {}
+        self.min_freq = 0
+
+    def _touch(self, key, entry):
+        freq = entry[1]
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = freq + 1
+        entry[1] = freq + 1
+        self.buckets.setdefault(freq + 1, collections.OrderedDict())[key] = None
+
+    def _get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+        self._touch(key, entry)
+        return entry[0]
+
+    def set(self, key, value):
+        entry = self.data.get(key)
+        if entry is not None:
+            entry[0] = value
+            self._touch(key, entry)
+            return
+        if len(self.data) >= self.maxsize:
+            bucket = self.buckets[self.min_freq]
+            oldest, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self.buckets[self.min_freq]
+            del self.data[oldest]
+            self.evictions += 1
+        self.data[key] = [value, 1]
+        self.buckets.setdefault(1, collections.OrderedDict())[key] = None
+        self.min_freq = 1
+
+    def items(self):
+        return [(key, entry[0]) for key, entry in self.data.items()]
+
+    def clear(self):
+        self.data.clear()
+        self.buckets.clear()
+        self.min_freq = 0
+
+
+class _TTLCache(_Cache):
+    '''Keys expire ttl seconds after they were stored; when full, the oldest key is evicted.'''
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        super(_TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self.timer = timer
+        self.data = collections.OrderedDict()
+        self.get = self._get
+
+    def _get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= self.timer():
+            del self.data[key]
+            self.evictions += 1
+            return default
+        return entry[1]
+
+    def set(self, key, value):
+        now = self.timer()
+        self.data.pop(key, None)
+        # keys are ordered by expiry time, so expired ones are at the front
+        while self.data:
+            oldest, (expires, _) = next(self.data.iteritems())
+            if expires > now and (self.maxsize is None or len(self.data) < self.maxsize):
+                break
+            del self.data[oldest]
+            self.evictions += 1
+        self.data[key] = (now + self.ttl, value)
+
+    def items(self):
+        return [(key, entry[1]) for key, entry in self.data.items()]
+
+
+def _make_cache(maxsize, policy, ttl):
+    if maxsize is not None and maxsize <= 0:
+        raise ValueError('maxsize must be positive')
+    if ttl is not None or policy == 'ttl':
+        if ttl is None:
+            raise ValueError('ttl policy requires ttl')
+        if ttl <= 0:
+            raise ValueError('ttl must be positive')
+        return _TTLCache(maxsize, ttl)
+    if maxsize is None:
+        return _Cache()
+    if policy == 'lru':
+        return _LRUCache(maxsize)
+    if policy == 'lfu':
+        return _LFUCache(maxsize)
+    raise ValueError('unknown cache policy: {!r}'.format(policy))
+
+
+Serializer = collections.namedtuple('Serializer', 'dumps loads')
+
+PICKLE = Serializer(lambda obj: cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL), cPickle.loads)
+MARSHAL = Serializer(marshal.dumps, marshal.loads)
+JSON = Serializer(lambda obj: json.dumps(obj, sort_keys=True, separators=(',', ':')), json.loads)
+
+
+def _code_hash(func, seen=None):
+    '''
+    Hash of the function's code, its constants (nested code included) and
+    of the functions it closes over, so that a memo wrapped around other
+    decorators still notices when the inner function changes.
+    '''
+    seen = set() if seen is None else seen
+    digest = hashlib.sha1()
+
+    def update_code(code):
+        digest.update(code.co_code)
+        digest.update(repr(code.co_names))
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                update_code(const)
+            else:
+                digest.update(repr(const))
+
+    def update_func(func):
+        if id(func) in seen:
+            return
+        seen.add(id(func))
+        update_code(func.__code__)
+        for cell in func.__closure__ or ():
+            if hasattr(cell.cell_contents, '__code__'):
+                update_func(cell.cell_contents)
+
+    update_func(func)
+    return digest.hexdigest()[:16]
+
+
+def code_namespace(func):
+    '''Cache namespace of a function: its name plus a hash of its code.'''
+    return '{}.{}:{}'.format(func.__module__, func.__name__, _code_hash(func))
+
+
+class _DiskStore(object):
+    '''
+    A namespace of a persistent backend. Writes are buffered and written
+    back in batches of backend.batch (and on flush / interpreter exit).
+    '''
+
+    def __init__(self, backend, namespace):
+        self.backend = backend
+        self.namespace = namespace
+        self.maxsize = None
+        self.evictions = 0
+        self.pending = {}
+        self.data = self.pending
+        self.get = self._get
+
+    def _get(self, key, default=None):
+        serializer = self.backend.serializer
+        raw_key = serializer.dumps(key)
+        raw = self.pending.get(raw_key)
+        if raw is None:
+            raw = self.backend.read(self.namespace, raw_key)
+            if raw is None:
+                return default
+        return serializer.loads(raw)
+
+    def set(self, key, value):
+        serializer = self.backend.serializer
+        self.pending[serializer.dumps(key)] = serializer.dumps(value)
+        if len(self.pending) >= self.backend.batch:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.backend.write(self.namespace, self.pending.items())
+            self.pending.clear()
+
+    def clear(self):
+        self.pending.clear()
+        self.backend.delete(self.namespace)
+
+    def items(self):
+        return []
+
+    def memory(self):
+        return sys.getsizeof(self.pending) + sum(len(key) + len(value) for key, value in self.pending.items())
+
+    def __len__(self):
+        self.flush()
+        return self.backend.count(self.namespace)
+
+
+class _Backend(object):
+    '''Base of the persistent memo backends, see SqliteBackend and LogBackend.'''
+
+    def __init__(self, serializer=PICKLE, batch=100):
+        self.serializer = serializer
+        self.batch = batch
+        self.lock = threading.RLock()
+        self.stores = []
+        atexit.register(self.flush)
+
+    def bind(self, namespace):
+        store = _DiskStore(self, namespace)
+        self.stores.append(store)
+        return store
+
+    def flush(self):
+        with self.lock:
+            for store in self.stores:
+                store.flush()
+
+
+class SqliteBackend(_Backend):
+    '''
+    Memo values in an SQLite file. Rows of older versions of a function
+    (other code hashes) are dropped when it is bound.
+    '''
+
+    def __init__(self, path, serializer=PICKLE, batch=100):
+        super(SqliteBackend, self).__init__(serializer, batch)
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS memo (
+            namespace TEXT, key BLOB, value BLOB, PRIMARY KEY (namespace, key))''')
+        self.db.commit()
+
+    def bind(self, namespace):
+        name = namespace.rsplit(':', 1)[0]
+        with self.lock:
+            prefix = name + ':'
+            self.db.execute('DELETE FROM memo WHERE substr(namespace, 1, ?) = ? AND namespace != ?',
+                            (len(prefix), prefix, namespace))
+            self.db.commit()
+        return super(SqliteBackend, self).bind(namespace)
+
+    def read(self, namespace, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM memo WHERE namespace = ? AND key = ?',
+                                  (namespace, sqlite3.Binary(key))).fetchone()
+        return None if row is None else str(row[0])
+
+    def write(self, namespace, items):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO memo VALUES (?, ?, ?)',
+                                [(namespace, sqlite3.Binary(key), sqlite3.Binary(value)) for key, value in items])
+            self.db.commit()
+
+    def delete(self, namespace):
+        with self.lock:
+            self.db.execute('DELETE FROM memo WHERE namespace = ?', (namespace,))
+            self.db.commit()
+
+    def count(self, namespace):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM memo WHERE namespace = ?', (namespace,)).fetchone()[0]
+
+
+class LogBackend(_Backend):
+    '''
+    Memo values in an append-only log read through mmap. Records are
+    (namespace, key, value) with the last record of a key winning; an empty
+    value marks a deleted namespace. A torn record at the tail (a crash
+    during a write) is cut off when the log is opened.
+    '''
+
+    MAGIC = b'MEMOLOG1'
+    RECORD = struct.Struct('<III')
+
+    def __init__(self, path, serializer=PICKLE, batch=100):
+        super(LogBackend, self).__init__(serializer, batch)
+        self.path = path
+        self.file = open(path, 'a+b')
+        self.index = {}
+        self.map = None
+        with self.lock:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self.file.fileno()).st_size == 0:
+                    self.file.write(self.MAGIC)
+                    self.file.flush()
+                self._load()
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load(self):
+        self._remap()
+        if self.map[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError('{} is not a memo log'.format(self.path))
+        offset, size = len(self.MAGIC), len(self.map)
+        while offset + self.RECORD.size <= size:
+            name_size, key_size, value_size = self.RECORD.unpack_from(self.map, offset)
+            start = offset + self.RECORD.size
+            end = start + name_size + key_size + value_size
+            if end > size:
+                break
+            namespace = self.map[start:start + name_size]
+            if value_size == 0:
+                self.index.pop(namespace, None)
+            else:
+                key = self.map[start + name_size:start + name_size + key_size]
+                self.index.setdefault(namespace, {})[key] = (end - value_size, value_size)
+            offset = end
+        if offset < size:
+            self.map.close()
+            self.map = None
+            self.file.truncate(offset)
+            self._remap()
+
+    def _append(self, records):
+        chunks = []
+        for namespace, key, value in records:
+            chunks.append(self.RECORD.pack(len(namespace), len(key), len(value)))
+            chunks.append(namespace + key + value)
+        positions = []
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            # the end of the log is only stable under the lock: other processes append too
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        for namespace, key, value in records:
+            offset += self.RECORD.size + len(namespace) + len(key) + len(value)
+            positions.append((namespace, key, offset - len(value), len(value)))
+        self._remap()
+        return positions
+
+    def read(self, namespace, key):
+        with self.lock:
+            position = self.index.get(namespace, {}).get(key)
+            if position is None:
+                return None
+            offset, size = position
+            return self.map[offset:offset + size]
+
+    def write(self, namespace, items):
+        with self.lock:
+            positions = self._append([(namespace, key, value) for key, value in items])
+            index = self.index.setdefault(namespace, {})
+            for _, key, offset, size in positions:
+                index[key] = (offset, size)
+
+    def delete(self, namespace):
+        with self.lock:
+            self._append([(namespace, b'', b'')])
+            self.index.pop(namespace, None)
+
+    def count(self, namespace):
+        with self.lock:
+            return len(self.index.get(namespace, ()))
+
+
+class SharedTable(object):
+    '''
+    Fixed-capacity hash table in a memory-mapped file, shared by all
+    processes that map it (e.g. the workers of a multiprocessing pool
+    forked after the memoized function was defined).
+
+    A slot holds a seqlock counter, the key hash and the serialized key
+    and value; items that do not fit into slot_size are not cached. Reads
+    take no lock: a reader retries while the counter is odd or changed
+    under it. Writers take an exclusive flock on the file, so there is one
+    writer at a time. A key is looked up in PROBES slots from its hash;
+    when all of them are taken, the first one is overwritten.
+    '''
+
+    MAGIC = b'MEMOSHM1'
+    HEADER = struct.Struct('<8sII')
+    SLOT = struct.Struct('<IQHI')
+    PROBES = 8
+    RETRIES = 16
+
+    def __init__(self, path=None, capacity=65536, slot_size=256, serializer=PICKLE):
+        self.serializer = serializer
+        self.owner = None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='memo-', suffix='.shm')
+            os.close(fd)
+            self.owner = os.getpid()
+            atexit.register(self._remove)
+        self.path = path
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self.pid = os.getpid()
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            header = self.file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                self.file.write(self.HEADER.pack(self.MAGIC, capacity, slot_size))
+                self.file.truncate(self.HEADER.size + capacity * slot_size)
+            else:
+                magic, capacity, slot_size = self.HEADER.unpack(header)
+                if magic != self.MAGIC:
+                    raise ValueError('{} is not a shared memo table'.format(path))
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.evictions = 0
+
+    def _remove(self):
+        if os.getpid() == self.owner and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _locked_file(self):
+        # flock is held by an open file, which a forked child shares with its parent
+        if self.pid != os.getpid():
+            self.file = open(self.path, 'r+b')
+            self.pid = os.getpid()
+        return self.file
+
+    def bind(self, namespace):
+        return _SharedStore(self, namespace + '\0')
+
+    def _slots(self, digest):
+        start = struct.unpack_from('<Q', digest)[0] % self.capacity
+        for probe in range(self.PROBES):
+            yield self.HEADER.size + (start + probe) % self.capacity * self.slot_size
+
+    def read(self, key):
+        digest = hashlib.md5(key).digest()
+        key_hash = struct.unpack_from('<Q', digest)[0]
+        for offset in self._slots(digest):
+            for _ in range(self.RETRIES):
+                seq, slot_hash, key_size, value_size = self.SLOT.unpack_from(self.map, offset)
+                if seq & 1:
+                    continue
+                if slot_hash != key_hash or key_size != len(key):
+                    value = None
+                else:
+                    start = offset + self.SLOT.size
+                    if self.map[start:start + key_size] != key:
+                        value = None
+                    else:
+                        value = self.map[start + key_size:start + key_size + value_size]
+                if self.SLOT.unpack_from(self.map, offset)[0] == seq:
+                    break
+            else:
+                return None
+            if value is not None:
+                return value
+            if key_size == 0:
+                return None
+        return None
+
+    def _write_slot(self, offset, key_hash, key, value):
+        seq = self.SLOT.unpack_from(self.map, offset)[0]
+        struct.pack_into('<I', self.map, offset, seq + 1)
+        start = offset + self.SLOT.size
+        self.map[start:start + len(key) + len(value)] = key + value
+        self.SLOT.pack_into(self.map, offset, seq + 2, key_hash, len(key), len(value))
+
+    def write(self, key, value):
+        if self.SLOT.size + len(key) + len(value) > self.slot_size:
+            return False
+        digest = hashlib.md5(key).digest()
+        key_hash = struct.unpack_from('<Q', digest)[0]
+        lock = self._locked_file()
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            slots = list(self._slots(digest))
+            target = None
+            for offset in slots:
+                _, slot_hash, key_size, _ = self.SLOT.unpack_from(self.map, offset)
+                start = offset + self.SLOT.size
+                if slot_hash == key_hash and self.map[start:start + key_size] == key:
+                    target = offset
+                    break
+                if target is None and (key_size == 0 or (slot_hash == 0 and key_size == 1)):
+                    target = offset
+                if key_size == 0:
+                    break
+            if target is None:
+                target = slots[0]
+                self.evictions += 1
+            self._write_slot(target, key_hash, key, value)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return True
+
+    def scan(self, prefix, delete=False):
+        '''Count (and optionally delete) the items whose keys start with prefix.'''
+        count = 0
+        lock = self._locked_file()
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            for slot in range(self.capacity):
+                offset = self.HEADER.size + slot * self.slot_size
+                key_size = self.SLOT.unpack_from(self.map, offset)[2]
+                start = offset + self.SLOT.size
+                if key_size and self.map[start:start + len(prefix)] == prefix:
+                    count += 1
+                    if delete:
+                        # a deleted slot keeps the probe chain going until it is reused
+                        self._write_slot(offset, 0, b'\0', b'')
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return count
+
+
+class _SharedStore(object):
+    '''A namespace of a SharedTable.'''
+
+    def __init__(self, table, prefix):
+        self.table = table
+        self.prefix = prefix
+        self.maxsize = table.capacity
+        self.data = {}
+        self.get = self._get
+
+    @property
+    def evictions(self):
+        return self.table.evictions
+
+    @evictions.setter
+    def evictions(self, value):
+        self.table.evictions = value
+
+    def _get(self, key, default=None):
+        raw = self.table.read(self.prefix + self.table.serializer.dumps(key))
+        if raw is None:
+            return default
+        return self.table.serializer.loads(raw)
+
+    def set(self, key, value):
+        serializer = self.table.serializer
+        self.table.write(self.prefix + serializer.dumps(key), serializer.dumps(value))
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        self.table.scan(self.prefix, delete=True)
+
+    def items(self):
+        return []
+
+    def memory(self):
+        return len(self.table.map)
+
+    def __len__(self):
+        return self.table.scan(self.prefix)
+
+
+class _TieredCache(object):
+    '''In-memory cache in front of a persistent store: hits are promoted, writes go to both.'''
+
+    def __init__(self, memory, disk):
+        self.front = memory
+        self.back = disk
+        self.maxsize = memory.maxsize
+        self.data = memory.data
+        self.get = self._get
+
+    @property
+    def evictions(self):
+        return self.front.evictions
+
+    @evictions.setter
+    def evictions(self, value):
+        self.front.evictions = value
+
+    def _get(self, key, default=None):
+        value = self.front.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.back.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self.front.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.front.set(key, value)
+        self.back.set(key, value)
+
+    def flush(self):
+        self.back.flush()
+
+    def clear(self):
+        self.front.clear()
+        self.back.clear()
+
+    def items(self):
+        return self.front.items()
+
+    def memory(self):
+        return self.front.memory() + self.back.memory()
+
+    def __len__(self):
+        return len(self.front)
+
+
+class _Flight(object):
+    '''A computation in progress that concurrent callers of the same key wait on.'''
+
+    __slots__ = ('event', 'result', 'exc_info')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+def _single_flight(func, cache, stats, weak, stripes):
     '''
-    return
+    Thread-safe memo wrapper: the first caller of a missing key computes
+    it, the others wait for its result (or its exception, which is not
+    cached). Keys are guarded by striped locks, so unrelated keys do not
+    contend.
+    '''
+    locks = [threading.Lock() for _ in range(stripes)]
+    flights = {}
+    # dict.get is atomic; bounded stores relink entries on lookup and need a lock of their own
+    plain = type(cache) is _Cache
+    store_lock = threading.Lock()
+
+    def fetch(key):
+        if plain:
+            result = cache.get(key, _MISSING)
+        else:
+            with store_lock:
+                result = cache.get(key, _MISSING)
+        if weak and type(result) is weakref.ref:
+            result = result()
+            if result is None:
+                return _MISSING
+        return result
 
+    def save(key, result):
+        if weak:
+            try:
+                result = weakref.ref(result)
+            except TypeError:
+                pass
+        with store_lock:
+            cache.set(key, result)
 
-def countcalls(func):
-    '''Decorator that counts calls made to the function decorated.'''
     @wraps(func)
     def wrapper(*args, **kwargs):
-        wrapper.calls += 1
-        return func(*args, **kwargs)
-    wrapper.calls = 0
+        key = _make_key(args, kwargs) if kwargs else args
+        # counters are not locked and may under-count under heavy contention
+        result = fetch(key)
+        if result is not _MISSING:
+            stats[0] += 1
+            return result
+        lock = locks[hash(key) % stripes]
+        with lock:
+            result = fetch(key)
+            if result is not _MISSING:
+                stats[0] += 1
+                return result
+            flight = flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = flights[key] = _Flight()
+        if not leader:
+            stats[0] += 1
+            return flight.wait()
+        stats[1] += 1
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            flight.exc_info = sys.exc_info()
+            with lock:
+                del flights[key]
+            flight.event.set()
+            raise
+        with lock:
+            save(key, result)
+            del flights[key]
+        flight.result = result
+        flight.event.set()
+        return result
+
     return wrapper
 
 
-def memo(func):
+_MEMO_TEMPLATE = '''
+def wrapper({parameters}):
+    _key_ = {key}
+    _result_ = _lookup_(_key_, _MISSING_)
+    if _result_ is not _MISSING_:
+        _stats_[0] += 1
+        return _result_
+    _stats_[1] += 1
+    _result_ = _func_({arguments})
+    _store_(_key_, _result_)
+    return _result_
+'''
+# unbounded store: a hit is one dict subscript, a miss is the KeyError
+_MEMO_DICT_TEMPLATE = '''
+def wrapper({parameters}):
+    _key_ = {key}
+    try:
+        _result_ = _data_[_key_]
+    except KeyError:
+        _stats_[1] += 1
+        _result_ = _data_[_key_] = _func_({arguments})
+        return _result_
+    _stats_[0] += 1
+    return _result_
+'''
+_MEMO_NAMES = ('_func_', '_lookup_', '_store_', '_data_', '_stats_', '_MISSING_', '_defaults_', '_key_',
+               '_result_')
+
+
+def memo(func=None, maxsize=None, policy='lru', ttl=None, weak=False, concurrent=False, stripes=16,
+         backend=None, tiered=True):
     '''
     Memoize a function so that it caches all return values for
     faster future lookups.
+
+    >>> @memo
+    ... def f(x): ...
+
+    >>> @memo(maxsize=1000, policy='lfu')
+    ... def g(x, y=0): ...
+
+    maxsize -- bound the cache, None for unbounded
+    policy -- 'lru', 'lfu' or 'ttl' eviction when bounded
+    ttl -- seconds a value stays valid (implies the 'ttl' policy)
+    weak -- keep values by weak reference where the type allows it
+    concurrent -- make the cache thread-safe and coalesce concurrent
+                  misses of the same key into a single call
+    stripes -- number of key locks of the concurrent cache
+    backend -- persistent or shared store (SqliteBackend, LogBackend,
+               SharedTable); values are kept under a namespace tied to
+               a hash of the function's code
+    tiered -- keep the in-memory cache in front of the backend
+
+    Keyword arguments are part of the key. For a function of fixed arity
+    the wrapper is generated with its exact signature, which spares the
+    argument packing on every call. The wrapper exposes cache_info()
+    and cache_clear().
     '''
-    cache = {}
+    if 'memo' in DISABLED:
+        return disable(func)
+    if func is None:
+        return lambda func: memo(func, maxsize=maxsize, policy=policy, ttl=ttl, weak=weak,
+                                 concurrent=concurrent, stripes=stripes, backend=backend, tiered=tiered)
+
+    cache = _make_cache(maxsize, policy, ttl)
+    if backend is not None:
+        if weak:
+            raise ValueError('weak values cannot be persisted')
+        disk = backend.bind(code_namespace(func))
+        cache = _TieredCache(cache, disk) if tiered else disk
+    lookup, store = cache.get, cache.set
+    stats = [0, 0]  # hits, misses
+    data = cache.data if type(cache) is _Cache and not weak else None
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if args not in cache:
-            cache[args] = func(*args, **kwargs)
-        return cache.get(args)
-    return update_wrapper(func, wrapper)
+        key = _make_key(args, kwargs) if kwargs else args
+        result = lookup(key, _MISSING)
+        if weak and type(result) is weakref.ref:
+            result = result()
+            if result is None:
+                result = _MISSING
+        if result is not _MISSING:
+            stats[0] += 1
+            return result
+        stats[1] += 1
+        result = func(*args, **kwargs)
+        if weak:
+            try:
+                store(key, weakref.ref(result))
+            except TypeError:
+                store(key, result)
+        else:
+            store(key, result)
+        return result
+
+    if data is not None:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                result = data[_make_key(args, kwargs) if kwargs else args]
+            except KeyError:
+                stats[1] += 1
+                result = data[_make_key(args, kwargs) if kwargs else args] = func(*args, **kwargs)
+                return result
+            stats[0] += 1
+            return result
+
+    signature = None if weak or concurrent else _signature(func, reserved=_MEMO_NAMES)
+    if concurrent:
+        wrapper = _single_flight(func, cache, stats, weak, stripes)
+    elif signature is not None and '*' not in signature[1]:
+        # fixed arity: no argument packing, and the key is the same however the arguments are passed
+        parameters, arguments, defaults = signature
+        template = _MEMO_TEMPLATE if data is None else _MEMO_DICT_TEMPLATE
+        wrapper = _compile_wrapper(template.format(
+            parameters=parameters, arguments=arguments, key='({},)'.format(arguments) if arguments else '()'), {
+                '_func_': func, '_lookup_': lookup, '_store_': store, '_data_': data, '_stats_': stats,
+                '_MISSING_': _MISSING, '_defaults_': defaults})
+        update_wrapper(wrapper, func)
+
+    def cache_info():
+        return CacheInfo(stats[0], stats[1], cache.evictions, cache.maxsize, len(cache), cache.memory())
+
+    def cache_clear():
+        cache.clear()
+        stats[:] = [0, 0]
+        cache.evictions = 0
+
+    # the wrapper has a copy of func's attributes (e.g. countcalls' metrics), its own go on the wrapper only
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    if backend is not None:
+        wrapper.cache_flush = cache.flush
+    return wrapper
+
+
+def _item_key(item):
+    try:
+        hash(item)
+    except TypeError:
+        return tuple(item)
+    return item
+
+
+def memo_batch(func=None, maxsize=None, policy='lru', ttl=None, key=_item_key):
+    '''
+    Memoize a function that maps a batch (a sequence) of inputs to the
+    list of their results: every item is cached separately and the
+    function is called once with only the items missing from the cache.
+    Results are returned as a list in the order of the input batch.
+
+    >>> @memo_batch(maxsize=100000)
+    ... def evaluate(hands): ...
+
+    key -- cache key of an item; unhashable items are keyed by tuple(item)
+    Other arguments of the function are part of every item's key;
+    maxsize, policy and ttl are as in memo.
+    '''
+    if func is None:
+        return lambda func: memo_batch(func, maxsize=maxsize, policy=policy, ttl=ttl, key=key)
+
+    cache = _make_cache(maxsize, policy, ttl)
+    lookup, store = cache.get, cache.set
+    stats = [0, 0]  # hits, misses
+
+    @wraps(func)
+    def wrapper(batch, *args, **kwargs):
+        extra = _make_key(args, kwargs)
+        results = []
+        missing = collections.OrderedDict()  # key -> positions of the item in the batch
+        misses = []
+        for position, item in enumerate(batch):
+            item_key = (key(item),) + extra
+            result = lookup(item_key, _MISSING)
+            if result is _MISSING:
+                positions = missing.get(item_key)
+                if positions is None:
+                    positions = missing[item_key] = []
+                    misses.append(item)
+                positions.append(position)
+            results.append(result)
+        stats[0] += len(results) - len(misses)
+        stats[1] += len(misses)
+        if misses:
+            computed = func(misses, *args, **kwargs)
+            if len(computed) != len(misses):
+                raise ValueError('{} returned {} results for {} inputs'.format(
+                    func.__name__, len(computed), len(misses)))
+            for (item_key, positions), result in zip(missing.items(), computed):
+                store(item_key, result)
+                for position in positions:
+                    results[position] = result
+        return results
+
+    def cache_info():
+        return CacheInfo(stats[0], stats[1], cache.evictions, cache.maxsize, len(cache), cache.memory())
+
+    def cache_clear():
+        cache.clear()
+        stats[:] = [0, 0]
+        cache.evictions = 0
+
+    wrapper.cache_info = cache_info
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+
+N_ARY_CHUNK_SIZE = 1024
+
+
+def _fold_right(func, operands, kwargs):
+    '''f(x, f(y, f(z, ...))) over a sequence, without recursion or copies.'''
+    if not operands:
+        raise TypeError('{}() takes at least one operand'.format(func.__name__))
+    result = operands[-1]
+    for index in xrange(len(operands) - 2, -1, -1):
+        result = func(operands[index], result, **kwargs)
+    return result
+
+
+def _tree_reduce(func, operands, kwargs):
+    '''
+    Reduce a stream of operands of an associative func in a balanced
+    tree, keeping their order. Like a binary counter, the stack holds at
+    most log2(n) partial results of decreasing sizes.
+    '''
+    stack = []
+    for operand in operands:
+        size, value = 1, operand
+        while stack and stack[-1][0] == size:
+            value = func(stack.pop()[1], value, **kwargs)
+            size *= 2
+        stack.append((size, value))
+    if not stack:
+        raise TypeError('{}() takes at least one operand'.format(func.__name__))
+    value = stack.pop()[1]
+    while stack:
+        value = func(stack.pop()[1], value, **kwargs)
+    return value
+
+
+def _reduce_chunk(task):
+    '''Pool task: reduce one chunk of operands (func is pickled by name for a process pool).'''
+    func, operands, kwargs = task
+    return _tree_reduce(func, operands, kwargs)
+
 
+def _chunks(operands, size):
+    operands = iter(operands)
+    chunk = list(itertools.islice(operands, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(operands, size))
 
-def n_ary(func):
+
+def n_ary(func=None, associative=False, pool=None, chunk_size=N_ARY_CHUNK_SIZE):
     '''
     Given binary function f(x, y), return an n_ary function such
     that f(x, y, z) = f(x, f(y,z)), etc. Also allow f(x) = x.
+    Keyword arguments are passed to every application of f.
+
+    wrapper.reduce(iterable) does the same for a stream of operands.
+
+    associative -- f is associative: reduce in a balanced tree instead
+                   of the right fold (the order of operands is kept)
+    pool -- multiprocessing.Pool or ThreadPool to reduce chunks of
+            chunk_size operands in parallel (associative only). It can
+            be set later as wrapper.pool: a process pool has to be created
+            after the module-level function it runs is defined.
     '''
+    if func is None:
+        return lambda func: n_ary(func, associative=associative, pool=pool, chunk_size=chunk_size)
+    if pool is not None and not associative:
+        raise ValueError('a pool needs an associative function')
+
+    def reduce(operands, **kwargs):
+        pool = wrapper.pool
+        if pool is not None and associative:
+            partials = pool.imap(_reduce_chunk, ((wrapper, chunk, kwargs) for chunk in _chunks(operands, chunk_size)))
+            return _tree_reduce(func, partials, kwargs)
+        if associative:
+            return _tree_reduce(func, operands, kwargs)
+        if not isinstance(operands, (list, tuple)):
+            operands = list(operands)
+        return _fold_right(func, operands, kwargs)
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        count_args = len(args)
-        if count_args == 1:
-            return args[0]
-        elif count_args == 2:
+        if len(args) == 2:
             return func(args[0], args[1], **kwargs)
-        else:
-            return func(args[0], wrapper(*args[1:], **kwargs))
+        return reduce(args, **kwargs)
+
+    wrapper.reduce = reduce
+    wrapper.pool = pool
     return wrapper
 
 
-def trace(indent):
+TRACE_BUFFER_SIZE = 65536
+
+_tracing = [True]
+
+
+def set_tracing(enabled):
+    '''Global switch of trace: while off, a traced call only checks the flag.'''
+    _tracing[0] = bool(enabled)
+
+
+class TraceBuffer(object):
+    '''
+    Fixed-size ring buffer of trace events; the oldest events are
+    overwritten. An event is (seq, timestamp, phase, name, thread id,
+    depth), phase is 'B' on enter and 'E' on exit.
+    '''
+
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.size = size
+        self.events = [None] * size
+        self.counter = itertools.count()  # next() is atomic, so threads need no lock
+
+    def record(self, phase, name, depth):
+        seq = next(self.counter)
+        self.events[seq % self.size] = (seq, time.time(), phase, name, thread.get_ident(), depth)
+
+    def clear(self):
+        self.events = [None] * self.size
+
+    def snapshot(self):
+        '''Recorded events in order.'''
+        return sorted(event for event in self.events if event is not None)
+
+    def _calls(self):
+        '''
+        Pair enter and exit events per thread: yields (stack, enter, exit)
+        for every complete call. Exits whose enter was overwritten are dropped.
+        '''
+        stacks = collections.defaultdict(list)
+        for _, timestamp, phase, name, thread_id, _ in self.snapshot():
+            stack = stacks[thread_id]
+            if phase == 'B':
+                stack.append((name, timestamp))
+            elif stack:
+                entered = stack.pop()[1]
+                yield [frame[0] for frame in stack] + [name], entered, timestamp
+
+    def collapsed(self):
+        '''Stacks in the collapsed format of flamegraph.pl, weighted by self time in microseconds.'''
+        totals = collections.Counter()
+        for stack, entered, exited in self._calls():
+            elapsed = (exited - entered) * 1e6
+            totals[';'.join(stack)] += elapsed
+            if len(stack) > 1:
+                totals[';'.join(stack[:-1])] -= elapsed
+        return ''.join('{} {}\n'.format(stack, int(round(total)))
+                       for stack, total in sorted(totals.items()) if total > 0)
+
+    def chrome_trace(self):
+        '''Events in the Chrome trace-event JSON format (chrome://tracing, Perfetto).'''
+        pid = os.getpid()
+        return json.dumps({'traceEvents': [
+            {'name': name, 'ph': phase, 'ts': timestamp * 1e6, 'pid': pid, 'tid': thread_id}
+            for _, timestamp, phase, name, thread_id, _ in self.snapshot()
+        ]})
+
+
+TRACE = TraceBuffer()
+_TRACE_STATE = threading.local()
+
+
+def _format_call(name, args, kwargs):
+    arguments = [repr(arg) for arg in args] + ['{}={!r}'.format(key, value) for key, value in sorted(kwargs.items())]
+    return '{}({})'.format(name, ', '.join(arguments))
+
+
+def trace(indent='', sample=1, buffer=None, echo=False):
     '''Trace calls made to function decorated.
 
-    @trace("____")
+    Enter and exit events with timestamps, depth and thread id go into
+    a ring buffer (TRACE by default), see TraceBuffer.collapsed and
+    TraceBuffer.chrome_trace for exports. With sample=N only every N-th
+    outermost traced call is recorded, along with all calls nested in it.
+    With echo=True calls are printed as well:
+
+    @trace("____", echo=True)
     def fib(n):
         ....
 
@@ -85,19 +1579,42 @@ def trace(indent):
      <-- fib(3) == 3
 
     '''
+    if 'trace' in DISABLED:
+        return disable
+
     def deco(func):
-        deco._depth = 0
+        name = func.__name__
+        events = TRACE if buffer is None else buffer
+        roots = itertools.count()
+
         @wraps(func)
-        def wrapper(n):
-            print('{} --> fib({})'.format(indent * wrapper.depth, n))
-            wrapper.depth += 1
-            result = func(n)
-            wrapper.depth -= 1
-            print('{} <-- fib({}) == {}'.format(indent * wrapper.depth, n, result))
-            return result
-        wrapper.depth = 0
+        def wrapper(*args, **kwargs):
+            if not _tracing[0]:
+                return func(*args, **kwargs)
+            state = _TRACE_STATE.__dict__
+            depth = state.get('depth', 0)
+            if depth == 0:
+                state['active'] = next(roots) % sample == 0
+            state['depth'] = depth + 1
+            try:
+                if not state['active']:
+                    return func(*args, **kwargs)
+                if echo:
+                    print('{} --> {}'.format(indent * depth, _format_call(name, args, kwargs)))
+                events.record('B', name, depth)
+                result = func(*args, **kwargs)
+                events.record('E', name, depth)
+                if echo:
+                    print('{} <-- {} == {!r}'.format(indent * depth, _format_call(name, args, kwargs), result))
+                return result
+            except BaseException:
+                if state['active']:
+                    events.record('E', name, depth)
+                raise
+            finally:
+                state['depth'] = depth
         return wrapper
-    return deco
+    return decorator(deco)
 
 
 @memo
@@ -115,29 +1632,478 @@ def bar(a, b):
 
 
 @countcalls
-@trace("####")
+@trace("####", echo=True)
 @memo
 def fib(n):
     """Some doc"""
     return 1 if n <= 1 else fib(n-1) + fib(n-2)
 
 
+def _calls(func):
+    '''Calls counted by countcalls, '?' when countcalls is disabled.'''
+    metrics = getattr(func, 'metrics', None)
+    return '?' if metrics is None else metrics.calls
+
+
 def main():
     print foo(4, 3)
     print foo(4, 3, 2)
     print foo(4, 3)
 
-    print "foo was called", foo.calls, "timess"
+    print "foo was called", _calls(foo), "timess"
 
     print bar(4, 3)
     print bar(4, 3, 2)
     print bar(4, 3, 2, 1)
-    print "bar was called", bar.calls, "times"
+    print "bar was called", _calls(bar), "times"
 
     print fib.__doc__
     fib(3)
-    print fib.calls, 'calls made'
+    print _calls(fib), 'calls made'
+
+
+#############
+### Tests ###
+#############
+
+def test_memo_evictions():
+    print "test_memo_evictions..."
+    calls = []
+
+    @memo(maxsize=2)
+    def lru(x):
+        calls.append(x)
+        return x
+
+    for x in (1, 2, 1, 3, 1, 2):
+        lru(x)
+    # 2 is the least recently used when 3 comes, then 3 makes room for 2
+    assert calls == [1, 2, 3, 2]
+    assert lru.cache_info()[:5] == (2, 4, 2, 2, 2)
+    lru.cache_clear()
+    assert lru.cache_info()[:5] == (0, 0, 0, 2, 0)
+
+    del calls[:]
+
+    @memo(maxsize=2, policy='lfu')
+    def lfu(x):
+        calls.append(x)
+        return x
+
+    for x in (1, 1, 2, 3, 1, 2):
+        lfu(x)
+    # 1 is used most often and stays, 2 and then 3 are evicted
+    assert calls == [1, 2, 3, 2]
+    assert lfu.cache_info()[:3] == (2, 4, 2)
+
+    now = [0.0]
+    cache = _TTLCache(2, 10, timer=lambda: now[0])
+    cache.set('a', 1)
+    now[0] = 5.0
+    cache.set('b', 2)
+    assert cache.get('a') == 1 and cache.evictions == 0
+    now[0] = 6.0
+    cache.set('c', 3)  # full: the oldest key goes
+    assert cache.get('a') is None and cache.evictions == 1
+    now[0] = 15.0  # b has expired, c has not
+    assert cache.get('b') is None and cache.get('c') == 3 and cache.evictions == 2
+
+    for options in [dict(maxsize=0), dict(maxsize=-1, ttl=10), dict(maxsize=0, policy='ttl', ttl=10),
+                    dict(ttl=0), dict(ttl=-1), dict(policy='ttl'), dict(maxsize=2, policy='mru')]:
+        try:
+            memo(**options)(lambda x: x)
+            assert False, options
+        except ValueError:
+            pass
+    print 'OK'
+
+
+def test_single_flight():
+    print "test_single_flight..."
+    entered, release = threading.Event(), threading.Event()
+    calls = []
+
+    @memo(concurrent=True)
+    def fail(x):
+        calls.append(x)
+        entered.set()
+        release.wait()
+        raise ValueError(x)
+
+    errors = []
+
+    def call():
+        try:
+            fail(1)
+        except ValueError as error:
+            errors.append(error.args)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    threads[0].start()
+    entered.wait()
+    for worker in threads[1:]:
+        worker.start()
+    # a waiter counts as a hit as soon as it joins the flight
+    while fail.cache_info().hits < 3:
+        time.sleep(0.001)
+    release.set()
+    for worker in threads:
+        worker.join()
+    # one call, and its exception is raised in every waiter
+    assert calls == [1] and errors == [(1,)] * 4
+    # the exception is not cached
+    try:
+        fail(1)
+        assert False
+    except ValueError:
+        pass
+    assert calls == [1, 1]
+
+    del calls[:]
+
+    @memo(concurrent=True, maxsize=10)
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.01)
+        return x * x
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow(3))) for _ in range(8)]
+    for worker in threads:
+        worker.start()
+    for worker in threads:
+        worker.join()
+    assert calls == [3] and results == [9] * 8
+    print 'OK'
+
+
+def test_backend_persistence():
+    print "test_backend_persistence..."
+    directory = tempfile.mkdtemp()
+    try:
+        backends = [lambda: SqliteBackend(os.path.join(directory, 'memo.db')),
+                    lambda: LogBackend(os.path.join(directory, 'memo.log'), batch=2)]
+        for make_backend in backends:
+            calls = []
+            # the second round is a restart: a new backend over the same file
+            for _ in range(2):
+                def square(x):
+                    calls.append(x)
+                    return x * x
+
+                square = memo(square, backend=make_backend())
+                assert [square(x) for x in range(5)] == [0, 1, 4, 9, 16]
+                square.cache_flush()
+                assert square.cache_info().currsize == 5
+            assert calls == range(5)
+
+            # a changed function does not see the values of the old one
+            def square(x):
+                calls.append(x)
+                return x ** 2
+
+            square = memo(square, backend=make_backend(), tiered=False)
+            assert square(3) == 9 and calls == range(5) + [3]
+            square.cache_clear()
+            assert square.cache_info().currsize == 0
+    finally:
+        shutil.rmtree(directory)
+    print 'OK'
+
+
+def test_shared_table():
+    print "test_shared_table..."
+    calls = []
+
+    @memo(backend=SharedTable(capacity=1024), tiered=False)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    pid = os.fork()
+    if pid == 0:
+        # the child fills the table, its calls list is its own
+        status = 1
+        try:
+            status = 0 if [square(x) for x in range(10)] == [x * x for x in range(10)] else 1
+        finally:
+            os._exit(status)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert [square(x) for x in range(10)] == [x * x for x in range(10)]
+    assert calls == [] and square.cache_info()[:2] == (10, 0)
+    assert square.cache_info().currsize == 10
+    square.cache_clear()
+    assert square.cache_info().currsize == 0
+    assert square(2) == 4 and calls == [2]
+
+    # a full probe chain is overwritten from its first slot
+    table = SharedTable(capacity=1)
+    assert table.write(b'a', b'1') and table.write(b'b', b'2')
+    assert table.evictions == 1
+    assert table.read(b'a') is None and table.read(b'b') == b'2'
+    # items that do not fit into a slot are not cached
+    assert not table.write(b'c', b'x' * table.slot_size)
+    print 'OK'
+
+
+def test_memo_batch():
+    print "test_memo_batch..."
+    calls = []
+
+    @memo_batch(maxsize=100)
+    def double(items, scale=1):
+        calls.append(list(items))
+        return [item * 2 * scale for item in items]
+
+    assert double([1, 2, 1]) == [2, 4, 2]
+    assert double([2, 3]) == [4, 6]
+    assert calls == [[1, 2], [3]]
+    assert double.cache_info()[:2] == (2, 3)
+    # other arguments are part of the key
+    assert double([1], scale=10) == [20] and calls[-1] == [1]
+
+    @memo_batch
+    def total(rows):
+        return [sum(row) for row in rows]
+
+    # unhashable items are keyed by tuple(item)
+    assert total([[1, 2], [1, 2], [3]]) == [3, 3, 3]
+    assert total.cache_info()[:2] == (1, 2)
+
+    @memo_batch
+    def broken(items):
+        return items[1:]
+
+    try:
+        broken([1, 2])
+        assert False
+    except ValueError:
+        pass
+    print 'OK'
+
+
+def test_n_ary():
+    print "test_n_ary..."
+    from multiprocessing.pool import ThreadPool
+
+    def concat(x, y):
+        return x + y
+
+    def sub(x, y):
+        return x - y
+
+    letters = [chr(ord('a') + index) for index in range(26)]
+    assert n_ary(sub)(10, 4, 3) == 10 - (4 - 3)
+    assert n_ary(sub)(7) == 7
+    assert n_ary(sub).reduce(iter([10, 4, 3])) == 9
+    tree = n_ary(concat, associative=True)
+    assert tree(*letters) == ''.join(letters)
+    assert tree.reduce(iter(letters)) == ''.join(letters)
+    # no recursion: a long stream is fine
+    assert n_ary(concat).reduce(xrange(100000)) == sum(xrange(100000))
+    try:
+        tree.reduce([])
+        assert False
+    except TypeError:
+        pass
+
+    pool = ThreadPool(2)
+    try:
+        # chunks are reduced in parallel, the order of operands is kept
+        parallel = n_ary(concat, associative=True, pool=pool, chunk_size=3)
+        assert parallel.reduce(letters) == ''.join(letters)
+        assert parallel.reduce(iter(letters[:2])) == 'ab'
+    finally:
+        pool.close()
+        pool.join()
+    try:
+        n_ary(sub, pool=pool)
+        assert False
+    except ValueError:
+        pass
+    print 'OK'
+
+
+def test_trace():
+    print "test_trace..."
+    events = TraceBuffer(size=64)
+
+    @trace(buffer=events)
+    def inner(n):
+        if n < 0:
+            raise ValueError(n)
+        return n
+
+    @trace(buffer=events)
+    def outer(n):
+        return inner(n) + 1
+
+    assert outer(1) == 2
+    assert [event[2:4] + event[5:] for event in events.snapshot()] == [
+        ('B', 'outer', 0), ('B', 'inner', 1), ('E', 'inner', 1), ('E', 'outer', 0)]
+    for line in events.collapsed().splitlines():
+        stack, weight = line.rsplit(' ', 1)
+        assert stack in ('outer', 'outer;inner') and int(weight) > 0
+    chrome = json.loads(events.chrome_trace())['traceEvents']
+    assert [(event['name'], event['ph']) for event in chrome] == [
+        ('outer', 'B'), ('inner', 'B'), ('inner', 'E'), ('outer', 'E')]
+
+    # an exception still closes the call
+    events.clear()
+    try:
+        outer(-1)
+        assert False
+    except ValueError:
+        pass
+    assert [event[2] for event in events.snapshot()] == ['B', 'B', 'E', 'E']
+
+    # tracing off records nothing
+    events.clear()
+    set_tracing(False)
+    try:
+        assert outer(1) == 2
+    finally:
+        set_tracing(True)
+    assert events.snapshot() == []
+
+    # sampling keeps every second outermost call with its nested calls
+    sampled = trace(buffer=events, sample=2)(outer)
+    for n in range(4):
+        sampled(n)
+    assert len(events.snapshot()) == 2 * 6
+
+    # the ring keeps the newest events; an exit without its enter is dropped
+    ring = TraceBuffer(size=3)
+    for phase, name, depth in [('B', 'outer', 0), ('B', 'inner', 1), ('E', 'inner', 1), ('E', 'outer', 0)]:
+        ring.record(phase, name, depth)
+    assert [event[2:4] for event in ring.snapshot()] == [('B', 'inner'), ('E', 'inner'), ('E', 'outer')]
+    assert [stack for stack, _, _ in ring._calls()] == [['inner']]
+    print 'OK'
+
+
+def test_countcalls():
+    print "test_countcalls..."
+    global _clock
+
+    def square(x):
+        return x * x
+
+    counted = countcalls(square, name='test.square')
+    try:
+        # the wrapper has the signature of the function and no extra frame
+        assert inspect.getargspec(counted) == inspect.getargspec(square)
+        assert counted.__name__ == 'square' and counted.__code__.co_name == 'wrapper'
+        assert counted(2) == 4 and counted(x=3) == 9
+        snapshot = counted.metrics.snapshot()
+        assert snapshot['calls'] == 2 and snapshot['timed_calls'] == 2
+        assert json.loads(dump_json())['test.square']['calls'] == 2
+        assert 'deco_calls_total{function="test.square"} 2\n' in dump_prometheus()
+
+        sampled = countcalls(square, sample=4, name='test.sampled')
+        for x in range(8):
+            sampled(x)
+        assert sampled.metrics.snapshot()['timed_calls'] == 2
+
+        # a call faster than the clock goes into the first bucket
+        clock, _clock = _clock, lambda: 1.0
+        try:
+            instant = countcalls(square, name='test.instant')
+        finally:
+            _clock = clock
+        instant(2)
+        assert instant.metrics.histogram()[0] == 1 and sum(instant.metrics.histogram()) == 1
+    finally:
+        for name in ('test.square', 'test.sampled', 'test.instant'):
+            METRICS.pop(name, None)
+    print 'OK'
+
+
+def test_decorator():
+    print "test_decorator..."
+
+    @decorator
+    def double_first(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            args = (args[0] * 2,) + args[1:]
+            return func(*args, **kwargs)
+        return wrapper
+
+    @double_first
+    def add(x, y=1):
+        return x + y
+
+    # a wrapper that rebinds its arguments is not recompiled
+    assert add(3) == 7 and add(3, y=2) == 8
+
+    @decorator
+    def passthrough(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
+        return wrapper
+
+    fixed = passthrough(add)
+    assert inspect.getargspec(fixed) == inspect.getargspec(add) and fixed(3, 2) == 8
+
+    class Scale(object):
+        def __init__(self, factor):
+            self.factor = factor
+
+        def apply(self, x, y=0):
+            return self.factor * x + y
+
+    # bound methods and builtins keep the generic wrapper: there is no self to pass
+    method = Scale(2).apply
+    try:
+        assert countcalls(method, name='test.method')(3) == 6
+        assert trace(buffer=TraceBuffer(8))(method)(3, y=1) == 7
+        assert memo(method)(3) == 6 and memo(maxsize=2)(method)(3) == 6
+        assert passthrough(method)(3) == 6
+        assert memo(pow)(2, 3) == 8 and countcalls(pow, name='test.pow')(2, 3) == 8
+    finally:
+        METRICS.pop('test.method', None)
+        METRICS.pop('test.pow', None)
+    print 'OK'
+
+
+def test_configure():
+    print "test_configure..."
+    previous = set(DISABLED)
+
+    def square(x):
+        return x * x
+
+    try:
+        configure(('memo',))
+        assert memo(square) is square and memo(maxsize=10)(square) is square
+        assert memo_batch(square) is not square
+        configure()
+        assert countcalls(square) is square and countcalls(sample=2)(square) is square
+        assert trace('####')(square) is square
+        configure(())
+        assert memo(square) is not square and trace()(square) is not square
+        assert disable(square) is square and disable('####')(square) is square
+    finally:
+        configure(previous)
+    print 'OK'
 
 
 if __name__ == '__main__':
     main()
+    disabled = set(DISABLED)
+    # the tests need the decorators whatever DECO_DISABLE says
+    configure(())
+    try:
+        test_memo_evictions()
+        test_single_flight()
+        test_backend_persistence()
+        test_shared_table()
+        test_memo_batch()
+        test_n_ary()
+        test_trace()
+        test_countcalls()
+        test_decorator()
+        test_configure()
+    finally:
+        configure(disabled)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Overhead of the deco.py decorators per call.
+# Times a trivial function bare and wrapped, and reports the difference,
+# i.e. what the decorator itself costs on every call.
+#
+# Example:
+#   python deco_bench.py
+#   python deco_bench.py --number 200000 --repeat 7
+# -----------------
+
+import timeit
+import argparse
+
+import deco
+
+
+def identity(x):
+    return x
+
+
+def variants():
+    '''Decorated versions of identity to measure, in report order.'''
+    return [
+        ('bare', identity),
+        ('countcalls', deco.countcalls(identity, name='bench.timed')),
+        ('countcalls sample=16', deco.countcalls(identity, sample=16, name='bench.sampled')),
+        ('memo hit', deco.memo(identity)),
+        ('memo lru hit', deco.memo(identity, maxsize=128)),
+        ('memo concurrent hit', deco.memo(identity, concurrent=True)),
+    ]
+
+
+def measure(func, number, repeat):
+    '''Best time of one call of func(1), in seconds.'''
+    timer = timeit.Timer(lambda: func(1))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='overhead of the deco.py decorators per call')
+    parser.add_argument('--number', type=int, default=100000, help='calls per measurement')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements, the best one is reported')
+    args = parser.parse_args()
+
+    base = None
+    print '{:<24} {:>10} {:>10}'.format('variant', 'us/call', 'overhead')
+    for name, func in variants():
+        elapsed = measure(func, args.number, args.repeat)
+        base = elapsed if base is None else base
+        print '{:<24} {:>10.3f} {:>10.3f}'.format(name, elapsed * 1e6, (elapsed - base) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Расчет эквити (доли выигрышей) игроков по их карманным картам.
+# Метод Монте-Карло: недостающие карты борда раздаются случайно в пуле процессов,
+# вскрытие через поиск лучшей руки (poker.evaluate, т.е. то же, что best_hand/hand_rank).
+# Точный перебор: все досдачи борда, общие карты учитываются один раз (poker.HandState).
+# Диапазоны: нотация вида "QQ+, AKs, T9s-65s, A5o+" разворачивается в комбинации карманных карт,
+# матрица эквити диапазон против диапазона считает силу каждой комбинации один раз на досдачу.
+# -----------------
+
+import re
+import math
+import random
+import itertools
+import collections
+import multiprocessing
+
+import poker
+
+
+BOARD_SIZE = 5
+CHUNK_SIZE = 2000
+Z_SCORE = 1.96  # 95% доверительный интервал
+
+PlayerEquity = collections.namedtuple('PlayerEquity', 'win tie loss equity margin')
+EquityResult = collections.namedtuple('EquityResult', 'trials players')
+RangeEquity = collections.namedtuple('RangeEquity', 'runouts hero villain matrix combos equity')
+
+
+def parse_deal(hole_cards, board=(), dead=()):
+    """
+    :param hole_cards: карманные карты игроков, array array str
+    :param board: открытые карты борда, array str
+    :param dead: вышедшие из игры карты, array str
+    :return: (hole_cards, board, deck) в int-представлении, deck - оставшиеся карты колоды
+    """
+    holes = [poker.parse_hand(hole) for hole in hole_cards]
+    board = poker.parse_hand(board)
+    used = [card for hole in holes for card in hole] + board + poker.parse_hand(dead)
+    if len(set(used)) != len(used):
+        raise ValueError('duplicate cards in deal')
+    if len(holes) < 2 or len(board) > BOARD_SIZE:
+        raise ValueError('need at least 2 players and at most {} board cards'.format(BOARD_SIZE))
+    deck = sorted(set(poker.CARD_INTS.values()) - set(used))
+    if len(deck) < BOARD_SIZE - len(board):
+        raise ValueError('not enough cards left in deck')
+    return holes, board, deck
+
+
+def showdown_winners(holes, board):
+    """
+    :param holes: карманные карты игроков, array array int
+    :param board: 5 карт борда, array int
+    :return: номера победителей (несколько при дележе банка)
+    """
+    strengths = [poker.evaluate(hole + board) for hole in holes]
+    best = max(strengths)
+    return [i for i, strength in enumerate(strengths) if strength == best]
+
+
+def _simulate_chunk(args):
+    """
+    Разыгрывает trials случайных досдач борда
+    :param args: (holes, board, deck, trials, seed), seed - зерно генератора этого куска
+    :return: (wins, ties, shares) по игрокам: выигрыши, дележи, доли банка
+    """
+    holes, board, deck, trials, seed = args
+    rng = random.Random(seed)
+    need = BOARD_SIZE - len(board)
+    wins = [0] * len(holes)
+    ties = [0] * len(holes)
+    shares = [0.0] * len(holes)
+    for _ in range(trials):
+        winners = showdown_winners(holes, board + rng.sample(deck, need))
+        if len(winners) == 1:
+            wins[winners[0]] += 1
+        else:
+            for i in winners:
+                ties[i] += 1
+                shares[i] += 1.0 / len(winners)
+    return wins, ties, shares
+
+
+def _margin(share, trials):
+    """Полуширина доверительного интервала доли share по trials испытаниям (нормальное приближение)"""
+    return Z_SCORE * math.sqrt(max(share * (1 - share), 0.0) / trials)
+
+
+def _result(trials, wins, ties, shares, exact=False):
+    players = []
+    for win, tie, share in zip(wins, ties, shares):
+        equity = float(win + share) / trials
+        players.append(PlayerEquity(
+            win=float(win) / trials,
+            tie=float(tie) / trials,
+            loss=float(trials - win - tie) / trials,
+            equity=equity,
+            margin=0.0 if exact else _margin(equity, trials),
+        ))
+    return EquityResult(trials, players)
+
+
+def monte_carlo_equity(hole_cards, board=(), dead=(), trials=100000, precision=None,
+                       processes=None, chunk_size=CHUNK_SIZE, seed=0):
+    """
+    :param hole_cards: карманные карты игроков, array array str
+    :param board: открытые карты борда (0-5), array str
+    :param dead: вышедшие из игры карты, array str
+    :param trials: максимальное количество досдач
+    :param precision: остановиться, когда полуширина 95% интервала эквити каждого игрока не больше precision
+    :param processes: количество процессов, None - по числу ядер, 1 - без пула
+    :param chunk_size: досдач в одном задании пула
+    :param seed: зерно, у каждого куска свой генератор (seed, номер куска), поэтому результат
+        не зависит от количества процессов
+    :return: EquityResult(trials, [PlayerEquity(win, tie, loss, equity, margin), ...])
+    """
+    if trials <= 0 or chunk_size <= 0:
+        raise ValueError('trials and chunk_size must be positive')
+    holes, board, deck = parse_deal(hole_cards, board, dead)
+    if len(board) == BOARD_SIZE:
+        # досдавать нечего, исход один
+        trials = 1
+    count_chunks = (trials + chunk_size - 1) // chunk_size
+    tasks = (
+        (holes, board, deck, min(chunk_size, trials - i * chunk_size), (seed << 32) + i)
+        for i in range(count_chunks)
+    )
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_simulate_chunk, tasks)
+    else:
+        results = (_simulate_chunk(task) for task in tasks)
+
+    done = 0
+    wins = [0] * len(holes)
+    ties = [0] * len(holes)
+    shares = [0.0] * len(holes)
+    try:
+        # куски принимаются по порядку, так что ранняя остановка тоже воспроизводима
+        for i, (chunk_wins, chunk_ties, chunk_shares) in enumerate(results):
+            done += min(chunk_size, trials - i * chunk_size)
+            wins = [a + b for a, b in zip(wins, chunk_wins)]
+            ties = [a + b for a, b in zip(ties, chunk_ties)]
+            shares = [a + b for a, b in zip(shares, chunk_shares)]
+            result = _result(done, wins, ties, shares)
+            if precision is not None and max(player.margin for player in result.players) <= precision:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return result
+
+
+def _enumerate_runouts(args):
+    """
+    Перебирает все досдачи борда, первая карта которых deck[first]
+    :param args: (holes, board, deck, first, need), first - None, если досдавать нечего
+    :return: (trials, wins, ties, shares) по игрокам
+    """
+    holes, board, deck, first, need = args
+    board_state = poker.HandState(board)
+    states = [poker.HandState(hole + board, board_state.key + poker.HandState(hole).key) for hole in holes]
+    wins = [0] * len(holes)
+    ties = [0] * len(holes)
+    shares = [0.0] * len(holes)
+    trials = 0
+
+    def walk(states, start, need):
+        """Досдает need карт из deck[start:], на каждом уровне состояния игроков дополняются одной картой"""
+        if not need:
+            strengths = [state.strength() for state in states]
+            best = max(strengths)
+            winners = [i for i, strength in enumerate(strengths) if strength == best]
+            if len(winners) == 1:
+                wins[winners[0]] += 1
+            else:
+                for i in winners:
+                    ties[i] += 1
+                    shares[i] += 1.0 / len(winners)
+            return 1
+        count = 0
+        for i in range(start, len(deck) - need + 1):
+            count += walk([state.add(deck[i]) for state in states], i + 1, need - 1)
+        return count
+
+    if first is None:
+        trials = walk(states, 0, 0)
+    else:
+        trials = walk([state.add(deck[first]) for state in states], first + 1, need - 1)
+    return trials, wins, ties, shares
+
+
+def exact_equity(hole_cards, board=(), dead=(), processes=1):
+    """
+    Точное эквити перебором всех досдач борда (дешевле Монте-Карло на терне и ривере)
+    :param hole_cards: карманные карты игроков, array array str
+    :param board: открытые карты борда (0-5), array str
+    :param dead: вышедшие из игры карты, array str
+    :param processes: количество процессов, None - по числу ядер, 1 - без пула;
+        перебор делится между процессами по первой досдаваемой карте
+    :return: EquityResult(trials, [PlayerEquity(win, tie, loss, equity, margin=0), ...])
+    """
+    holes, board, deck = parse_deal(hole_cards, board, dead)
+    need = BOARD_SIZE - len(board)
+    if need:
+        tasks = [(holes, board, deck, first, need) for first in range(len(deck) - need + 1)]
+    else:
+        tasks = [(holes, board, deck, None, need)]
+
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_enumerate_runouts, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = map(_enumerate_runouts, tasks)
+
+    trials = sum(result[0] for result in results)
+    wins, ties, shares = (
+        [sum(values) for values in zip(*[result[i] for result in results])] for i in (1, 2, 3)
+    )
+    return _result(trials, wins, ties, shares, exact=True)
+
+
+################
+### Диапазоны ###
+################
+
+HAND_CLASS_RE = re.compile(r'^([2-9TJQKA])([2-9TJQKA])([so]?)$')
+COMBO_RE = re.compile(r'^([2-9TJQKA][SCDH])([2-9TJQKA][SCDH])$', re.IGNORECASE)
+COUNT_SUITS = len(poker.SUITS)
+
+
+def _hand_class(text):
+    """
+    :param text: класс рук без модификаторов: "QQ", "AKs", "KAo"
+    :return: (старший ранг, младший ранг, 's' | 'o' | '')
+    """
+    match = HAND_CLASS_RE.match(text)
+    if not match:
+        raise ValueError('bad hand class: {}'.format(text))
+    first, second, kind = match.groups()
+    high, low = sorted((poker.WEIGHT_RANKS[first], poker.WEIGHT_RANKS[second]), reverse=True)
+    if high == low and kind == 's':
+        raise ValueError('suited pair: {}'.format(text))
+    return high, low, kind
+
+
+def _hand_class_combos(high, low, kind):
+    """
+    :return: все комбинации класса рук, array (int, int), старшая карта первой
+    """
+    cards = poker.DECK_INTS
+    if high == low:
+        return [(cards[high][b], cards[high][a]) for a, b in itertools.combinations(range(COUNT_SUITS), 2)]
+    return [
+        (cards[high][a], cards[low][b])
+        for a in range(COUNT_SUITS) for b in range(COUNT_SUITS)
+        if (a == b and kind != 'o') or (a != b and kind != 's')
+    ]
+
+
+def _token_classes(token):
+    """
+    Разворачивает один элемент диапазона в классы рук
+    :param token: "QQ", "QQ+", "AKs", "A5o+", "T9s-65s", "A2s-A5s", "22-55"
+    :return: array (старший ранг, младший ранг, вид)
+    """
+    if '-' in token:
+        first, last = [_hand_class(part) for part in token.split('-', 1)]
+        (high1, low1, kind), (high2, low2, kind2) = sorted((first, last), reverse=True)
+        if kind != kind2:
+            raise ValueError('bad range: {}'.format(token))
+        if high1 == low1 and high2 == low2:
+            # пары: 55-22
+            return [(rank, rank, kind) for rank in range(high2, high1 + 1)]
+        if high1 == high2 and low2 < high2:
+            # кикеры: A5s-A2s
+            return [(high1, rank, kind) for rank in range(low2, low1 + 1)]
+        if high1 - low1 == high2 - low2:
+            # связанные карты с тем же разрывом: T9s-65s
+            return [(high2 + i, low2 + i, kind) for i in range(high1 - high2 + 1)]
+        raise ValueError('bad range: {}'.format(token))
+    if token.endswith('+'):
+        high, low, kind = _hand_class(token[:-1])
+        if high == low:
+            # пары до тузов: QQ+
+            return [(rank, rank, kind) for rank in range(high, len(poker.RANKS))]
+        # кикер до ранга ниже старшей карты: A5o+
+        return [(high, rank, kind) for rank in range(low, high)]
+    return [_hand_class(token)]
+
+
+def parse_range(text, board=(), dead=()):
+    """
+    :param text: диапазон через запятую, например "QQ+, AKs, T9s-65s, A5o+, AsKh"
+    :param board: открытые карты борда, array str; комбинации с ними выбрасываются
+    :param dead: вышедшие из игры карты, array str; комбинации с ними выбрасываются
+    :return: комбинации карманных карт без повторов, array (int, int), старшая карта первой
+    """
+    removed = set(poker.parse_hand(board) + poker.parse_hand(dead))
+    combos = set()
+    for token in text.replace(' ', '').split(','):
+        if not token:
+            continue
+        match = COMBO_RE.match(token)
+        if match:
+            combo = tuple(sorted(poker.parse_hand(card.upper() for card in match.groups()), reverse=True))
+            if combo[0] == combo[1]:
+                raise ValueError('duplicate cards in combo: {}'.format(token))
+            combos.add(combo)
+            continue
+        for hand_class in _token_classes(token):
+            combos.update(_hand_class_combos(*hand_class))
+    return sorted((combo for combo in combos if not removed.intersection(combo)), reverse=True)
+
+
+def format_combo(combo):
+    """
+    :param combo: комбинация карманных карт, (int, int)
+    :return: строка вида "ASKH"
+    """
+    return ''.join(poker.int_to_card(card) for card in combo)
+
+
+def _range_runouts(args):
+    """
+    Перебирает все досдачи борда, первая карта которых deck[first], и начисляет очки
+    (2 за выигрыш, 1 за дележ) каждой паре комбинаций героя и оппонента.
+    Сила каждой комбинации считается один раз на досдачу и переиспользуется против всех
+    комбинаций соперника; пары, у которых общая карта, тоже считаются, их отбросит range_equity.
+    :param args: (combos, hero, villain, board, deck, first, need):
+        combos - все различные комбинации обоих диапазонов, hero и villain - индексы в combos,
+        first - None, если досдавать нечего
+    :return: очки, array array int по hero x villain
+    """
+    combos, hero, villain, board, deck, first, need = args
+    board_key = sum(poker.CARD_KEYS7[card] for card in board)
+    combo_keys = [poker.CARD_KEYS7[a] + poker.CARD_KEYS7[b] for a, b in combos]
+    points = [[0] * len(villain) for _ in hero]
+    if first is None:
+        runouts = [()]
+    else:
+        runouts = ((deck[first],) + rest for rest in itertools.combinations(deck[first + 1:], need - 1))
+
+    for runout in runouts:
+        cards = tuple(board) + runout
+        key = board_key + sum(poker.CARD_KEYS7[card] for card in runout)
+        dealt = set(runout)
+        strengths = [
+            None if a in dealt or b in dealt else poker.HandState(cards + (a, b), key + combo_key).strength()
+            for (a, b), combo_key in zip(combos, combo_keys)
+        ]
+        opponents = [strengths[j] for j in villain]
+        for row, i in zip(points, hero):
+            strength = strengths[i]
+            if strength is None:
+                continue
+            # (a > b) + (a >= b): 2 за выигрыш, 1 за дележ, 0 за проигрыш
+            row[:] = [
+                score if other is None else score + (strength > other) + (strength >= other)
+                for score, other in zip(row, opponents)
+            ]
+    return points
+
+
+def range_equity(hero, villain, board=(), dead=(), processes=1):
+    """
+    Точное эквити диапазона против диапазона перебором всех досдач борда
+    :param hero: диапазон героя, строка (см. parse_range) или array (int, int)
+    :param villain: диапазон оппонента, строка или array (int, int)
+    :param board: открытые карты борда (0-5), array str
+    :param dead: вышедшие из игры карты, array str
+    :param processes: количество процессов, None - по числу ядер, 1 - без пула;
+        перебор делится между процессами по первой досдаваемой карте
+    :return: RangeEquity(runouts, hero, villain, matrix, combos, equity):
+        runouts - досдач на каждую пару комбинаций,
+        matrix[i][j] - эквити комбинации героя hero[i] против villain[j], None при общей карте,
+        combos[i] - эквити hero[i] против всего диапазона (None, если все комбинации заблокированы),
+        equity - эквити диапазона героя, все совместимые пары комбинаций равновероятны
+    """
+    board_cards = poker.parse_hand(board)
+    removed = set(board_cards + poker.parse_hand(dead))
+    if len(board_cards) > BOARD_SIZE or len(removed) != len(board_cards) + len(dead):
+        raise ValueError('bad board or dead cards')
+    hero, villain = [
+        parse_range(cards, board, dead) if isinstance(cards, basestring)
+        else [combo for combo in cards if not removed.intersection(combo)]
+        for cards in (hero, villain)
+    ]
+    if not hero or not villain:
+        raise ValueError('empty range')
+
+    combos = sorted(set(hero) | set(villain), reverse=True)
+    indices = {combo: i for i, combo in enumerate(combos)}
+    deck = sorted(set(poker.CARD_INTS.values()) - removed)
+    need = BOARD_SIZE - len(board_cards)
+    args = (combos, [indices[combo] for combo in hero], [indices[combo] for combo in villain], board_cards, deck)
+    if need:
+        tasks = [args + (first, need) for first in range(len(deck) - need + 1)]
+    else:
+        tasks = [args + (None, need)]
+
+    # очки кусков складываются в одну матрицу по мере готовности: в памяти не больше одной лишней
+    points = [[0] * len(villain) for _ in hero]
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_range_runouts, tasks)
+    else:
+        results = (_range_runouts(task) for task in tasks)
+    try:
+        for result in results:
+            for row, scores in zip(points, result):
+                row[:] = [a + b for a, b in zip(row, scores)]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # у каждой пары без общих карт одинаковое число досдач: из колоды убраны ее 4 карты
+    runouts = _combinations_count(len(deck) - 4, need)
+    scale = 1.0 / (2 * runouts)
+    bits = {card: 1 << i for i, card in enumerate(sorted(poker.CARD_INTS.values()))}
+    villain_bits = [bits[a] | bits[b] for a, b in villain]
+    matrix = []
+    for (a, b), row in zip(hero, points):
+        hero_bits = bits[a] | bits[b]
+        matrix.append([
+            None if hero_bits & other_bits else score * scale
+            for other_bits, score in zip(villain_bits, row)
+        ])
+
+    combo_equities = []
+    for row in matrix:
+        values = [value for value in row if value is not None]
+        combo_equities.append(sum(values) / len(values) if values else None)
+    values = [value for row in matrix for value in row if value is not None]
+    if not values:
+        raise ValueError('ranges do not have compatible combos')
+    return RangeEquity(runouts, hero, villain, matrix, combo_equities, sum(values) / len(values))
+
+
+def _combinations_count(n, k):
+    """:return: C(n, k)"""
+    count = 1
+    for i in range(k):
+        count = count * (n - i) // (i + 1)
+    return count
+
+
+#############
+### Тесты ###
+#############
+
+def test_monte_carlo_equity():
+    print "test_monte_carlo_equity..."
+    result = monte_carlo_equity([['AS', 'AH'], ['KS', 'KH']], trials=20000, processes=1, seed=1)
+    aces, kings = result.players
+    assert abs(aces.equity - 0.82) < 0.02 and abs(aces.win + aces.tie + aces.loss - 1) < 1e-9
+    assert abs(aces.equity + kings.equity - 1) < 1e-9
+    assert result == monte_carlo_equity([['AS', 'AH'], ['KS', 'KH']], trials=20000, processes=2, seed=1)
+
+    result = monte_carlo_equity([['AS', 'AH'], ['KS', 'KH']], trials=100000, precision=0.01, processes=1)
+    assert result.trials < 100000 and max(player.margin for player in result.players) <= 0.01
+
+    result = monte_carlo_equity([['AS', 'KS'], ['AH', 'KH']], board='QD JC 2S 3H 4D'.split(), processes=1)
+    assert result.trials == 1 and result.players[0].tie == 1.0
+
+    for trials in (0, -1):
+        try:
+            monte_carlo_equity([['AS', 'AH'], ['KS', 'KH']], trials=trials, processes=1)
+            assert False
+        except ValueError:
+            pass
+    print 'OK'
+
+
+def test_exact_equity():
+    print "test_exact_equity..."
+    result = exact_equity([['AS', 'AH'], ['KS', 'KH']], board='2C 7D 9S 3H'.split())
+    aces, kings = result.players
+    assert result.trials == 44 and aces.margin == 0.0
+    assert aces.win == 42.0 / 44 and kings.win == 2.0 / 44 and aces.tie == 0.0
+
+    result = exact_equity([['AS', 'KS'], ['AH', 'KH'], ['2C', '2D']], board='QD JC 8S'.split(), processes=2)
+    assert result.trials == 903
+    assert result == exact_equity([['AS', 'KS'], ['AH', 'KH'], ['2C', '2D']], board='QD JC 8S'.split())
+    assert abs(sum(player.equity for player in result.players) - 1) < 1e-9
+    print 'OK'
+
+
+def test_range_equity():
+    print "test_range_equity..."
+    assert len(parse_range('QQ+')) == 18 and len(parse_range('AKs')) == 4 and len(parse_range('AK')) == 16
+    assert len(parse_range('T9s-65s')) == 20 and len(parse_range('A5o+')) == 9 * 12
+    assert parse_range('22-44') == parse_range('44-22') == parse_range('22, 33, 44')
+    assert parse_range('A2s-A4s') == parse_range('A4s-A2s') == parse_range('A2s, A3s, A4s')
+    assert map(format_combo, parse_range('AsKh, KhAs')) == ['ASKH']
+    assert len(parse_range('QQ+, AKs', board='AS 7D 2C'.split(), dead=['QH'])) == 3 + 6 + 3 + 3
+
+    board = 'QD JC 8S'.split()
+    result = range_equity('AA', 'KK, 72o', board=board)
+    assert result.runouts == 990 and len(result.hero) == 6 and len(result.villain) == 6 + 12
+    for i, j in [(0, 0), (2, 5), (5, 17)]:
+        hole_cards = [map(poker.int_to_card, result.hero[i]), map(poker.int_to_card, result.villain[j])]
+        expected = exact_equity(hole_cards, board=board).players[0].equity
+        assert abs(result.matrix[i][j] - expected) < 1e-9
+    assert result == range_equity('AA', 'KK, 72o', board=board, processes=2)
+
+    result = range_equity('AA', 'AA, KK', board='2C 7D 9S 3H 4D'.split())
+    assert result.runouts == 1 and result.matrix[0][0] is None and result.matrix[0][-1] == 1.0
+    print 'OK'
+
+
+if __name__ == '__main__':
+    test_monte_carlo_equity()
+    test_exact_equity()
+    test_range_equity()
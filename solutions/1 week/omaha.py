@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Омаха (PLO и Big-O): у игрока от 4 до 6 карманных карт, "рука" собирается ровно
+# из 2х карманных и 3х карт борда, т.е. до C(6,2) * C(5,3) = 150 комбинаций на игрока.
+# Перебор не нужен: все, что зависит только от борда, считается один раз (OmahaBoard):
+#   - без флэша сила зависит только от рангов, и для каждой пары рангов карманных карт
+#     лучшая сила на этом борде запоминается - таких пар не больше 91 на всех игроков;
+#   - флэш проверяется только в мастях, которых на борде не меньше трех;
+#   - на неспаренном борде не бывает фул-хауса и каре, поэтому найденный флэш сильнее любой
+#     руки без флэша, и ее можно не искать.
+# Сила та же, что у poker.evaluate5 (от 1 до 7462, чем больше, тем сильнее).
+# -----------------
+
+import random
+import itertools
+
+import poker
+
+
+HOLE_SIZES = (4, 5, 6)  # PLO, Big-O, PLO6
+BOARD_SIZES = (3, 4, 5)
+HOLE_CARDS_USED = 2
+BOARD_CARDS_USED = 3
+
+
+def _build_rank_strengths():
+    """
+    :return: сила по произведению простых чисел рангов для всех рук из 5ти карт без флэша
+        (в poker.PRODUCTS только руки с повторяющимися рангами, здесь еще и 5 разных рангов)
+    """
+    strengths = dict(poker.PRODUCTS)
+    for mask, strength in enumerate(poker.UNIQUE5):
+        if strength:
+            product = 1
+            for rank in range(len(poker.RANKS)):
+                if mask & (1 << rank):
+                    product *= poker.PRIMES[rank]
+            strengths[product] = strength
+    return strengths
+
+
+RANK_STRENGTHS = _build_rank_strengths()
+
+
+def _prime(card):
+    return card & 0xFF
+
+
+class OmahaBoard(object):
+    """
+    Предрасчет борда для оценки рук Омахи: тройки карт борда, масти, в которых возможен флэш,
+    и кэш лучшей силы без флэша по паре рангов карманных карт.
+    Один объект на борд, дальше оценка любого количества рук (batch).
+    """
+
+    def __init__(self, board):
+        """
+        :param board: карты борда (3-5), array int
+        """
+        if len(board) not in BOARD_SIZES:
+            raise ValueError('omaha board must have {} cards'.format(' or '.join(map(str, BOARD_SIZES))))
+        self.board = tuple(board)
+        triples = list(itertools.combinations(self.board, BOARD_CARDS_USED))
+        # разные произведения рангов троек: на спаренном борде их меньше
+        self.rank_products = sorted({_prime(a) * _prime(b) * _prime(c) for a, b, c in triples})
+        # одномастные тройки по масти: маска рангов
+        self.flush_masks = {}
+        for a, b, c in triples:
+            suit = a & b & c & 0xF000
+            if suit:
+                self.flush_masks.setdefault(suit, []).append((a | b | c) >> 16)
+        ranks = [poker.get_int_rank(card) for card in self.board]
+        # фул-хаус и каре собираются только с парой на борде
+        self.paired = len(set(ranks)) < len(ranks)
+        self.pair_strengths = {}
+
+    def _pair_strength(self, product):
+        """:return: лучшая сила без флэша для пары карманных карт с произведением рангов product"""
+        strength = self.pair_strengths.get(product)
+        if strength is None:
+            strength = self.pair_strengths[product] = max(
+                RANK_STRENGTHS[product * board_product] for board_product in self.rank_products
+            )
+        return strength
+
+    def _flush_strength(self, hole):
+        """:return: лучшая сила флэша (стрит-флэша) или 0, если флэша нет"""
+        best = 0
+        for suit, masks in self.flush_masks.items():
+            suited = [card >> 16 for card in hole if card & suit]
+            if len(suited) < HOLE_CARDS_USED:
+                continue
+            for a, b in itertools.combinations(suited, HOLE_CARDS_USED):
+                for mask in masks:
+                    strength = poker.FLUSHES[a | b | mask]
+                    if strength > best:
+                        best = strength
+        return best
+
+    def strength(self, hole):
+        """
+        :param hole: карманные карты (4-6), array int
+        :return: сила лучшей руки из 2х карманных и 3х карт борда
+        """
+        best = self._flush_strength(hole) if self.flush_masks else 0
+        if best and not self.paired:
+            # на неспаренном борде флэш не перебить рукой без флэша
+            return best
+        pair_strength = self._pair_strength
+        for a, b in itertools.combinations(hole, HOLE_CARDS_USED):
+            strength = pair_strength(_prime(a) * _prime(b))
+            if strength > best:
+                best = strength
+        return best
+
+    def strengths(self, holes):
+        """
+        :param holes: карманные карты игроков, array array int
+        :return: силы лучших рук, array int
+        """
+        return [self.strength(hole) for hole in holes]
+
+    def best_cards(self, hole):
+        """
+        :param hole: карманные карты (4-6), array int
+        :return: (сила, лучшие 5 карт), при равной силе - карты со старшими мастями, как в evaluate_best
+        """
+        strength = self.strength(hole)
+        for pair in itertools.combinations(sorted(hole, reverse=True), HOLE_CARDS_USED):
+            for triple in itertools.combinations(sorted(self.board, reverse=True), BOARD_CARDS_USED):
+                if poker.evaluate5(*(pair + triple)) == strength:
+                    return strength, tuple(sorted(pair + triple, reverse=True))
+
+
+def _check_hole(hole):
+    if len(hole) not in HOLE_SIZES:
+        raise ValueError('omaha hand must have {} hole cards'.format(' or '.join(map(str, HOLE_SIZES))))
+
+
+def evaluate_omaha(hole, board):
+    """
+    :param hole: карманные карты (4-6), array int
+    :param board: карты борда (3-5), array int
+    :return: сила лучшей руки по правилу 2 + 3
+    """
+    _check_hole(hole)
+    return OmahaBoard(board).strength(hole)
+
+
+def evaluate_omaha_batch(board, holes):
+    """
+    :param board: карты борда (3-5), array int
+    :param holes: карманные карты рук на этом борде, array array int
+    :return: силы рук, array int; предрасчет борда делается один раз на весь batch
+    """
+    for hole in holes:
+        _check_hole(hole)
+    return OmahaBoard(board).strengths(holes)
+
+
+def omaha_best_hand(hole, board):
+    """
+    :param hole: карманные карты (4-6), array str
+    :param board: карты борда (3-5), array str
+    :return: лучшая "рука" из 2х карманных и 3х карт борда, array str
+    """
+    hole = poker.parse_hand(hole)
+    _check_hole(hole)
+    _, cards = OmahaBoard(poker.parse_hand(board)).best_cards(hole)
+    return map(poker.int_to_card, cards)
+
+
+def omaha_showdown(board, players):
+    """
+    :param board: карты борда, array str
+    :param players: карманные карты игроков, array array str
+    :return: номера победителей (несколько при дележе банка)
+    """
+    strengths = evaluate_omaha_batch(poker.parse_hand(board), [poker.parse_hand(hole) for hole in players])
+    best = max(strengths)
+    return [i for i, strength in enumerate(strengths) if strength == best]
+
+
+def evaluate_omaha_naive(hole, board):
+    """Эталон: перебор всех комбинаций 2 + 3 через evaluate5"""
+    return max(
+        poker.evaluate5(*(pair + triple))
+        for pair in itertools.combinations(hole, HOLE_CARDS_USED)
+        for triple in itertools.combinations(board, BOARD_CARDS_USED)
+    )
+
+
+#############
+### Тесты ###
+#############
+
+def test_omaha_best_hand():
+    print "test_omaha_best_hand..."
+    # четыре туза в руке, но сыграть можно только два
+    assert omaha_best_hand('AS AH AD AC'.split(), '2C 7D 9S 3H KD'.split()) == ['AH', 'AD', 'KD', '9S', '7D']
+    # одна черва в руке - флэша нет
+    assert omaha_best_hand('AH KS QS JS'.split(), '2H 7H 9H 3H 4C'.split()) == ['AH', 'KS', '9H', '7H', '4C']
+    assert omaha_best_hand('AH KH QS JS TC'.split(), '2H 7H 9H 3S 3C'.split()) == ['AH', 'KH', '9H', '7H', '2H']
+    assert omaha_best_hand('9C 9D QS JS 2D 2C'.split(), '9H 7H 2H 3S 3C'.split()) == ['9H', '9D', '9C', '3C', '3S']
+    assert omaha_showdown('QD JC 8S 5H 2D'.split(), ['AS AH KS KH'.split(), 'TS 9S 3C 4C'.split()]) == [1]
+    try:
+        evaluate_omaha(poker.parse_hand('AS AH KS'.split()), poker.parse_hand('2C 7D 9S'.split()))
+        assert False
+    except ValueError:
+        pass
+    print 'OK'
+
+
+def test_omaha_batch():
+    print "test_omaha_batch..."
+    rng = random.Random(1)
+    deck = sorted(poker.CARD_INTS.values())
+    for _ in range(300):
+        board_size = rng.choice(BOARD_SIZES)
+        hole_size = rng.choice(HOLE_SIZES)
+        cards = rng.sample(deck, board_size + 6 * hole_size)
+        board, rest = cards[:board_size], cards[board_size:]
+        holes = [rest[i:i + hole_size] for i in range(0, len(rest), hole_size)]
+        assert evaluate_omaha_batch(board, holes) == [evaluate_omaha_naive(hole, board) for hole in holes]
+    print 'OK'
+
+
+if __name__ == '__main__':
+    test_omaha_best_hand()
+    test_omaha_batch()
@@ -27,8 +27,30 @@
 # Можно свободно определять свои функции и т.п.
 # -----------------
 
+import io
+import os
+import csv
+import sys
+import gzip
+import mmap
+import time
+import Queue
+import zlib
+import array
+import shutil
+import struct
+import warnings
+import argparse
+import tempfile
+import threading
 import itertools
 import collections
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 RED_JOKER = '?R'
@@ -48,503 +70,1229 @@ get_rank = lambda card: card[0]
 get_index_rank = lambda card: RANKS.index(card[0])
 get_suit = lambda card: card[1]
 
+JOKERS = (RED_JOKER, BLACK_JOKER)
+PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
 
-# is not implemented
-def hand_rank(hand):
-    """Возвращает значение определяющее ранг 'руки'"""
-    ranks = card_ranks(hand)
-    if straight(ranks) and flush(hand):
-        return (8, max(ranks))
-    elif kind(4, ranks):
-        return (7, kind(4, ranks), kind(1, ranks))
-    elif kind(3, ranks) and kind(2, ranks):
-        return (6, kind(3, ranks), kind(2, ranks))
-    elif flush(hand):
-        return (5, ranks)
-    elif straight(ranks):
-        return (4, max(ranks))
-    elif kind(3, ranks):
-        return (3, kind(3, ranks), ranks)
-    elif two_pair(ranks):
-        return (2, two_pair(ranks), ranks)
-    elif kind(2, ranks):
-        return (1, kind(2, ranks), ranks)
-    else:
-        return (0, ranks)
+HIGH_CARD, PAIR, TWO_PAIR, SET, STRAIGHT, FLASH, FULL_HOUSE, CARE, STRAIGHT_FLUSH = range(9)
+CATEGORY_NAMES = (
+    'HIGH CARD', 'PAIR', 'TWO PAIR', 'SET', 'STRAIGHT', 'FLASH', 'FULL HOUSE', 'CARE', 'STRAIGHT FLUSH',
+)
 
 
-# is not implemented
-def card_ranks(hand):
-    """Возвращает список рангов (его числовой эквивалент),
-    отсортированный от большего к меньшему"""
-    return
+##########################################
+### целочисленное представление карт ###
+##########################################
 
+def card_to_int(card):
+    """
+    :param card: карта, str
+    :return: карта, упакованная в int:
+        +--------+--------+--------+--------+
+        |xxxbbbbb|bbbbbbbb|hdcsrrrr|xxpppppp|
+        +--------+--------+--------+--------+
+        p - простое число ранга (2 .. 41)
+        r - индекс ранга (0 .. 12)
+        hdcs - бит масти (S, C, D, H)
+        b - бит ранга
+    PS: сравнение таких чисел - это порядок карт: сначала ранг, затем масть (S, C, D, H)
+    """
+    rank, suit = card
+    index_rank = WEIGHT_RANKS[rank]
+    return (1 << (16 + index_rank)) | (1 << (12 + WEIGHT_SUITS[suit])) | (index_rank << 8) | PRIMES[index_rank]
 
-# is not implemented
-def flush(hand):
-    """Возвращает True, если все карты одной масти"""
-    return
 
+CARD_INTS = {rank + suit: card_to_int(rank + suit) for rank in RANKS for suit in SUITS}
+INT_CARDS = {card_int: card for card, card_int in CARD_INTS.items()}
 
-# is not implemented
-def straight(ranks):
-    """Возвращает True, если отсортированные ранги формируют последовательность 5ти,
-    где у 5ти карт ранги идут по порядку (стрит)"""
-    return
+int_to_card = INT_CARDS.__getitem__
+get_int_rank = lambda card_int: (card_int >> 8) & 0xF
+get_int_suit = lambda card_int: (card_int >> 12) & 0xF
+SUIT_BITS = tuple(1 << (12 + suit) for suit in range(len(SUITS)))
 
 
-# is not implemented
-def kind(n, ranks):
-    """Возвращает первый ранг, который n раз встречается в данной руке.
-    Возвращает None, если ничего не найдено"""
-    return
+def parse_hand(hand):
+    """
+    :param hand: набор карт, array str
+    :return: набор карт, array int
+    Примечание: строки разбираются только здесь, на границе API, дальше работаем только с int
+    """
+    return [CARD_INTS[card] for card in hand]
 
 
-# is not implemented
-def two_pair(ranks):
-    """Если есть две пары, то возврщает два соответствующих ранга,
-    иначе возвращает None"""
-    return
+def _build_tables():
+    """
+    Строит таблицы оценки 5ти карт. Сила "руки" - число от 1 до 7462, чем больше, тем сильнее.
+    :return: (flushes, unique5, products, hand_ranks)
+        flushes - сила по битам рангов для флэшей и стрит-флэшей
+        unique5 - сила по битам рангов для 5ти разных рангов без флэша (старшая карта и стрит)
+        products - сила по произведению простых чисел для рук с повторяющимися рангами
+        hand_ranks - (категория, ранги в порядке значимости) по силе
+    """
+    ranks_desc = list(reversed(range(len(RANKS))))
+    straights = [(3, 2, 1, 0, 12)] + [tuple(range(high, high - 5, -1)) for high in range(4, 13)]
+    straight_masks = {sum(1 << rank for rank in ranks) for ranks in straights}
+    high_cards = sorted(
+        combo for combo in itertools.combinations(ranks_desc, 5)
+        if sum(1 << rank for rank in combo) not in straight_masks
+    )
+
+    def kinds(*counts):
+        """Ранги в порядке значимости для рук с группами одинаковых рангов, например (3, 2) - фул-хаус"""
+        result = []
+        for groups in itertools.permutations(ranks_desc, len(counts)):
+            # группы одного размера (две пары, кикеры) перечисляем только по убыванию
+            if any(counts[i] == counts[i + 1] and groups[i] < groups[i + 1] for i in range(len(counts) - 1)):
+                continue
+            result.append(sum(((rank,) * count for rank, count in zip(groups, counts)), ()))
+        return sorted(result)
+
+    categories = (
+        (HIGH_CARD, high_cards),
+        (PAIR, kinds(2, 1, 1, 1)),
+        (TWO_PAIR, kinds(2, 2, 1)),
+        (SET, kinds(3, 1, 1)),
+        (STRAIGHT, straights),
+        (FLASH, high_cards),
+        (FULL_HOUSE, kinds(3, 2)),
+        (CARE, kinds(4, 1)),
+        (STRAIGHT_FLUSH, straights),
+    )
+    flushes = [0] * (1 << len(RANKS))
+    unique5 = [0] * (1 << len(RANKS))
+    products = {}
+    hand_ranks = [None]
+    for category, all_ranks in categories:
+        for ranks in all_ranks:
+            strength = len(hand_ranks)
+            hand_ranks.append((category, ranks))
+            if category in (FLASH, STRAIGHT_FLUSH):
+                flushes[sum(1 << rank for rank in ranks)] = strength
+            elif category in (HIGH_CARD, STRAIGHT):
+                unique5[sum(1 << rank for rank in ranks)] = strength
+            else:
+                product = 1
+                for rank in ranks:
+                    product *= PRIMES[rank]
+                products[product] = strength
+    return flushes, unique5, products, hand_ranks
 
 
-# is not implemented
-def best_hand(hand):
-    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
-    return
+FLUSHES, UNIQUE5, PRODUCTS, HAND_RANKS = _build_tables()
+get_category = lambda strength: HAND_RANKS[strength][0]
 
 
-def best_hand(hand):
+def pack_hand_rank(category, ranks):
     """
-    :param hand: набор из [5-7] карт
-    :return: возвращает лучший набор из 5 карт
-    Примечание:
-    -
-    Поправки: вместо card_ranks, используем конкретную функцию best_ проверяющую комбинацию.
-    Примечания:
-    - метод не проверяет на наличие 5 карт, т.е. T♥ T♦ T♣ T♠ Дж, т.к. джокер мы заменяем на любую другую карту
-    """
-    jokers = list(set(hand) & {RED_JOKER, BLACK_JOKER})
-    for joker in jokers:
-        hand.remove(joker)
-    # джокерные карты не могут быть заменены на те, которые уже есть в hand
-    joker_hand = generate_cards_by_jokers(hand, jokers)
-    kind_joker_hand = jokers_cards_for_kind(joker_hand)
-
-    hand = sort_hand(hand)
-    joker_hand = sort_hand(joker_hand)
-
-    for func, name_combination in (
-            (best_straight_flush, 'STRAIGHT FLUSH'),
-            (best_care, 'CARE'),
-            (best_full_house, 'FULL HOUSE'),
-            (best_flash, 'FLASH'),
-            (best_straight, 'STRAIGHT'),
-            (best_set, 'SET'),
-            (best_two_pair, 'TWO PAIR'),
-            (best_pair, 'PAIR'),
-            (best_high_card, 'HIGH CARD'),
-    ):
-        joker_cards = joker_hand
-        if name_combination not in ('STRAIGHT FLUSH', 'FLASH', 'STRAIGHT'):
-            joker_cards = kind_joker_hand
-        # нужно передавать копии, ибо внутри массивы могут подтвергаться изменениям
-        combination = func(hand[:], joker_cards[:])
-        if combination:
-            print(name_combination, combination)
-            return combination
-
-
-def best_wild_hand(hand):
-    """best_hand но с джокерами"""
-    return best_hand(hand)
+    :param category: категория руки
+    :param ranks: 5 рангов в порядке значимости
+    :return: (категория, ранги), упакованные в int по 4 бита, порядок совпадает с силой руки
+    """
+    key = category
+    for rank in ranks:
+        key = (key << 4) | rank
+    return key
 
 
-def best_straight_flush(hand, joker_hand):
+def unpack_hand_rank(key):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает лучший набор из возможных стрит-флэшей, если таковые имеются, в противном случае None
-    Примечание важно проверять сначала на флэш, поскольку там может сыграть только один джокер, т.е. у нас сокращается
-    набор джокерных карт, которые пойдут на определение стрита
+    :param key: (категория, ранги), упакованные pack_hand_rank
+    :return: (категория, ранги в порядке значимости)
     """
-    flash = best_flash(hand, joker_hand, straight_flush_mode=True)
-    if flash:
-        joker_hand = list(set(joker_hand) & set(flash))
-        straight = best_straight(flash, joker_hand)
-        if straight:
-            return straight
+    return key >> 20, tuple((key >> shift) & 0xF for shift in (16, 12, 8, 4, 0))
+
+
+# упакованные (категория, ранги) по силе руки
+HAND_RANK_INTS = [0] + [pack_hand_rank(*hand) for hand in HAND_RANKS[1:]]
 
 
-def best_care(hand, joker_hand):
+def evaluate5(c1, c2, c3, c4, c5):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает набор из каре + старшую карту, если таковые имеются, в противном случае None
+    :param c1..c5: 5 карт, int
+    :return: сила "руки", int (чем больше, тем сильнее), не более трех обращений к таблицам
     """
-    cards = hand + joker_hand
-    care = best_kind(4, cards)
-    if care:
-        joker_cards_used = list(set(care) & set(joker_hand))
-        joker_hand = cut_joker_hand(joker_hand, joker_cards_used)
-        sub_hand = cut_hand(hand, exclude_hand=care)
-        return care + best_kind(1, sub_hand + joker_hand)
+    if c1 & c2 & c3 & c4 & c5 & 0xF000:
+        return FLUSHES[(c1 | c2 | c3 | c4 | c5) >> 16]
+    strength = UNIQUE5[(c1 | c2 | c3 | c4 | c5) >> 16]
+    if strength:
+        return strength
+    return PRODUCTS[(c1 & 0xFF) * (c2 & 0xFF) * (c3 & 0xFF) * (c4 & 0xFF) * (c5 & 0xFF)]
 
 
-def best_full_house(hand, joker_hand):
+def evaluate_best(cards):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает набор из сета и пары, если таковые имеются, в противном случае None
+    :param cards: набор из [5-7] карт, array int
+    :return: (сила, лучшие 5 карт), при равной силе выбираются карты со старшими мастями
     """
-    cards = hand + joker_hand
-    _set = best_kind(3, cards)
-    if _set:
-        joker_cards_used = list(set(_set) & set(joker_hand))
-        joker_hand = cut_joker_hand(joker_hand, joker_cards_used)
-        sub_hand = cut_hand(hand, exclude_hand=_set)
-        pair = best_kind(2, sub_hand + joker_hand)
-        if pair:
-            return _set + pair
+    best_strength, best_cards = 0, None
+    for combo in itertools.combinations(sorted(cards, reverse=True), 5):
+        strength = evaluate5(*combo)
+        if strength > best_strength:
+            best_strength, best_cards = strength, combo
+    return best_strength, best_cards
 
 
-def best_flash(hand, joker_hand, straight_flush_mode=False):
-    """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :param straight_flush_mode: в результате будет содержатся несколько джокерных карт, каждая из которых составляет флэш
-    :return: возвращает лучший флеш, если таковой имеется, в противном случае None
-    Примечание: для получения флеша можно сыграть только одной джокерной картой, если даны две
-    """
-    if joker_hand:
-        high_joker_cards = get_high_card_by_suits(joker_hand)
-        best_flash = best_flash_by_5(hand, high_joker_cards)
-        if best_flash:
-            if straight_flush_mode:
-                suit_flash = get_suit(best_flash[0])
-                best_joker_cards = [card for card in joker_hand if get_suit(card) == suit_flash]
-                # уберем дубли, т.к. best_flash может содержать джокера
-                return list(set(best_flash + best_joker_cards))
-            else:
-                return best_flash
-    else:
-        return best_flash_by_5(hand)
+# сколько карт каждого ранга входит в руку данной силы
+RANK_QUOTAS = [None] + [tuple(ranks.count(rank) for rank in range(len(RANKS))) for _, ranks in HAND_RANKS[1:]]
 
 
-def best_flash_by_5(hand, high_joker_cards=None):
+def select_cards(cards, strength):
+    """
+    :param cards: набор из [5-7] карт, array int
+    :param strength: сила лучшей "руки" из cards
+    :return: 5 карт, составляющих руку силы strength, при равной силе выбираются старшие масти (как в evaluate_best)
+    """
+    cards = sorted(cards, reverse=True)
+    if get_category(strength) in (FLASH, STRAIGHT_FLUSH):
+        for suit in SUIT_BITS:
+            suited_cards = [card for card in cards if card & suit]
+            if len(suited_cards) >= 5:
+                cards = suited_cards
+                break
+    quotas = list(RANK_QUOTAS[strength])
+    result = []
+    for card in cards:
+        rank = (card >> 8) & 0xF
+        if quotas[rank]:
+            quotas[rank] -= 1
+            result.append(card)
+    return tuple(result)
+
+
+#####################################
+### таблица 7ми карт (mmap-файл) ###
+#####################################
+
+# Ключи рангов, суммы которых различны для любых 7ми карт (не более 4х карт одного ранга).
+# Сумма ключей 7ми карт - совершенный хеш набора рангов, т.е. все 133 784 560 комбинаций сводятся
+# к 49 205 наборам рангов (без флэша) и 8192 маскам рангов одной масти (флэш).
+RANK_KEYS7 = (0, 1, 5, 22, 98, 453, 2031, 8698, 22854, 83661, 262349, 636345, 1479181)
+CARD_KEYS7 = {
+    card_int: (RANK_KEYS7[get_int_rank(card_int)] << 16) | (1 << 4 * WEIGHT_SUITS[get_suit(card)])
+    for card, card_int in CARD_INTS.items()
+}
+# масть флэша (бит масти в int-представлении) по упакованным счетчикам мастей, 0 - флэша нет
+FLUSH_SUITS7 = [
+    next((1 << (12 + suit) for suit in range(len(SUITS)) if (counters >> 4 * suit) & 0xF >= 5), 0)
+    for counters in range(1 << 16)
+]
+TABLE7_MAGIC = b'PKR7'
+TABLE7_VERSION = 1
+TABLE7_HEADER = struct.Struct('<4sIIII')
+TABLE7_PATH = os.environ.get(
+    'POKER_TABLE7', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'table7.bin')
+)
+
+
+def build_table7(path=TABLE7_PATH):
+    """
+    Строит таблицу 7ми карт и записывает ее в файл path
+    :param path: путь к файлу таблицы
+    :return: контрольная сумма таблицы, int
+    Формат: заголовок (magic, version, размер таблицы рангов, размер таблицы флэшей, crc32),
+    затем таблица рангов и таблица флэшей, uint16 little-endian
+    """
+    ranks = array.array('H', [0]) * (4 * RANK_KEYS7[-1] + 3 * RANK_KEYS7[-2] + 1)
+    # масти назначаем по кругу, тогда одной масти не больше 2х карт и флэша нет
+    for combo in itertools.combinations_with_replacement(range(len(RANKS)), 7):
+        if any(combo.count(rank) > 4 for rank in set(combo)):
+            continue
+        cards = [CARD_INTS[RANKS[rank] + SUITS[i % len(SUITS)]] for i, rank in enumerate(combo)]
+        ranks[sum(RANK_KEYS7[rank] for rank in combo)] = evaluate_best(cards)[0]
+
+    flushes = array.array('H', [0]) * (1 << len(RANKS))
+    for mask in range(len(flushes)):
+        bits = [1 << rank for rank in range(len(RANKS)) if mask & (1 << rank)]
+        if len(bits) >= 5:
+            flushes[mask] = max(FLUSHES[sum(combo)] for combo in itertools.combinations(bits, 5))
+
+    if sys.byteorder != 'little':
+        ranks.byteswap()
+        flushes.byteswap()
+    payload = ranks.tostring() + flushes.tostring()
+    checksum = zlib.crc32(payload) & 0xFFFFFFFF
+    with open(path, 'wb') as f:
+        f.write(TABLE7_HEADER.pack(TABLE7_MAGIC, TABLE7_VERSION, len(ranks), len(flushes), checksum))
+        f.write(payload)
+    return checksum
+
+
+class Table7(object):
+    """
+    Таблица 7ми карт, открытая через mmap: страницы файла общие для всех процессов,
+    оценка руки - 7 чтений ключей и одно чтение из таблицы
     """
-    :param hand:
-    :param high_joker_cards: набор старших джокерных карт на каждую масть, т.е. 4 старших карты в случае 2 джокеров
-    :return: возвращает лучший флеш, если таковой имеется, в противном случае None
+    _item = struct.Struct('<H')
+
+    def __init__(self, path=TABLE7_PATH, verify=True):
+        """
+        :param path: путь к файлу таблицы
+        :param verify: проверять контрольную сумму
+        Исключения: IOError - файла нет, ValueError - файл поврежден или другой версии
+        """
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < TABLE7_HEADER.size:
+            raise ValueError('{}: file is too short'.format(path))
+        magic, version, ranks_size, flushes_size, self.checksum = TABLE7_HEADER.unpack_from(self.mmap)
+        if magic != TABLE7_MAGIC or version != TABLE7_VERSION:
+            raise ValueError('{}: unknown table format'.format(path))
+        if len(self.mmap) != TABLE7_HEADER.size + 2 * (ranks_size + flushes_size):
+            raise ValueError('{}: file is truncated'.format(path))
+        if verify and zlib.crc32(self.mmap[TABLE7_HEADER.size:]) & 0xFFFFFFFF != self.checksum:
+            raise ValueError('{}: checksum mismatch'.format(path))
+        self.path = path
+        self.ranks_offset = TABLE7_HEADER.size
+        self.flushes_offset = TABLE7_HEADER.size + 2 * ranks_size
+
+    def evaluate(self, cards):
+        """
+        :param cards: набор из 7 карт, array int
+        :return: сила лучшей "руки" из 5ти карт, та же, что evaluate_best
+        """
+        key = 0
+        for card in cards:
+            key += CARD_KEYS7[card]
+        suit = FLUSH_SUITS7[key & 0xFFFF]
+        if suit:
+            mask = 0
+            for card in cards:
+                if card & suit:
+                    mask |= card
+            return self._item.unpack_from(self.mmap, self.flushes_offset + 2 * (mask >> 16))[0]
+        return self._item.unpack_from(self.mmap, self.ranks_offset + 2 * (key >> 16))[0]
+
+    def close(self):
+        self.mmap.close()
+
+
+# ленивые таблицы для HandState: заполняются при первой встрече набора
+RANK_STRENGTHS = {}  # (количество карт, сумма ключей рангов) -> сила
+FLUSH_STRENGTHS = {}  # маска рангов одной масти -> сила
+
+
+class HandState(object):
     """
-    cards = list(hand)
-    if high_joker_cards:
-        cards += high_joker_cards
-    suits = list(map(get_suit, cards))
-    for suit in SUITS:
-        if suits.count(suit) >= 5:
-            res = [card for card in sort_hand(cards) if get_suit(card) == suit][-5:]
-            return res
+    Неизменяемое состояние набора карт для пошаговой оценки: счетчики рангов (сумма RANK_KEYS7)
+    и счетчики мастей (младшие 16 бит) в одном ключе. Добавление карты - O(1), оценка - одно
+    обращение к ленивой таблице, поэтому общие карты (борд) учитываются один раз на все досдачи.
+    """
+    __slots__ = ('cards', 'key')
+
+    def __init__(self, cards=(), key=None):
+        """
+        :param cards: набор из не более 7 карт, array int
+        :param key: сумма CARD_KEYS7 карт, если уже посчитана
+        """
+        self.cards = tuple(cards)
+        self.key = sum(CARD_KEYS7[card] for card in self.cards) if key is None else key
+
+    def add(self, card):
+        """:return: новое состояние с еще одной картой"""
+        return HandState(self.cards + (card,), self.key + CARD_KEYS7[card])
+
+    def strength(self):
+        """:return: сила лучшей "руки" из 5ти карт, та же, что evaluate_best (от 5 до 7 карт)"""
+        suit = FLUSH_SUITS7[self.key & 0xFFFF]
+        if suit:
+            # при 5+ картах одной масти из 7ми каре и фул-хауса быть не может, решают только карты масти
+            suited_cards = [card for card in self.cards if card & suit]
+            mask = 0
+            for card in suited_cards:
+                mask |= card
+            strength = FLUSH_STRENGTHS.get(mask >> 16)
+            if strength is None:
+                strength = FLUSH_STRENGTHS[mask >> 16] = evaluate_best(suited_cards)[0]
+            return strength
+        index = (len(self.cards), self.key >> 16)
+        strength = RANK_STRENGTHS.get(index)
+        if strength is None:
+            strength = RANK_STRENGTHS[index] = evaluate_best(self.cards)[0]
+        return strength
+
+
+table7 = None
+
+
+def load_table7(path=TABLE7_PATH, verify=True):
+    """
+    Открывает таблицу 7ми карт для best_hand
+    :return: Table7 или None, если файла нет или он поврежден - тогда best_hand работает через evaluate_best
+    """
+    global table7
+    try:
+        table7 = Table7(path, verify=verify)
+    except IOError:
+        table7 = None
+    except ValueError as e:
+        warnings.warn('table7 is ignored: {}'.format(e))
+        table7 = None
+    return table7
+
+
+def evaluate(cards):
+    """
+    :param cards: набор из [5-7] карт, array int
+    :return: сила лучшей "руки" из 5ти карт, для 7ми карт через таблицу 7ми карт, если она загружена
+    """
+    if table7 is not None and len(cards) == 7:
+        return table7.evaluate(cards)
+    return classify(cards)[0]
+
+
+##########################################
+### джокеры без перебора замен ###
+##########################################
+
+# масти, которые может заменить джокер, по старшинству (индексы SUITS)
+JOKER_SUITS = {
+    RED_JOKER: tuple(sorted((WEIGHT_SUITS[suit] for suit in RED_SUITS), reverse=True)),
+    BLACK_JOKER: tuple(sorted((WEIGHT_SUITS[suit] for suit in BLACK_SUITS), reverse=True)),
+}
+SUIT_JOKERS = {suit: joker for joker, suits in JOKER_SUITS.items() for suit in suits}
+DECK_INTS = [[CARD_INTS[rank + suit] for suit in SUITS] for rank in RANKS]
+SUIT_INDICES = {1 << (12 + suit): suit for suit in range(len(SUITS))}
+RANKS_DESC = tuple(reversed(range(len(RANKS))))
+SUITS_DESC = tuple(reversed(range(len(SUITS))))
+# стриты от старшего к младшему: (маска рангов, ранги в порядке значимости)
+STRAIGHT_WINDOWS = tuple(
+    (sum(1 << rank for rank in window), window)
+    for window in [tuple(range(high, high - 5, -1)) for high in range(12, 3, -1)] + [(3, 2, 1, 0, 12)]
+)
+
+
+POPCOUNTS = [bin(mask).count('1') for mask in range(1 << len(RANKS))]
+
+
+class _WildHand(object):
+    """Реальные карты руки в виде битовых масок (ранги по мастям, масти по рангам) и доступные джокеры"""
+
+    def __init__(self, cards, jokers):
+        self.jokers = tuple(jokers)
+        self.suit_masks = [0] * len(SUITS)
+        self.suits_by_rank = [0] * len(RANKS)
+        self.counts = [0] * len(RANKS)
+        for card in cards:
+            rank, suit = (card >> 8) & 0xF, SUIT_INDICES[card & 0xF000]
+            self.suit_masks[suit] |= 1 << rank
+            self.suits_by_rank[rank] |= 1 << suit
+            self.counts[rank] += 1
+        self.ranks_mask = self.suit_masks[0] | self.suit_masks[1] | self.suit_masks[2] | self.suit_masks[3]
+
+    def real_cards(self, rank, count):
+        """:return: до count реальных карт ранга rank, старшие масти первыми"""
+        return [DECK_INTS[rank][suit] for suit in SUITS_DESC if self.suits_by_rank[rank] >> suit & 1][:count]
+
+    def joker_card(self, joker, rank):
+        """:return: карта, которой джокер заменяется на ранге rank (старшая свободная масть цвета), или None"""
+        for suit in JOKER_SUITS[joker]:
+            if not self.suits_by_rank[rank] >> suit & 1:
+                return DECK_INTS[rank][suit]
+
+    def straight_flush(self):
+        suits = [
+            suit for suit in SUITS_DESC
+            if POPCOUNTS[self.suit_masks[suit]] + (SUIT_JOKERS[suit] in self.jokers) >= 5
+        ]
+        for window_mask, window in STRAIGHT_WINDOWS if suits else ():
+            for suit in suits:
+                missing = window_mask & ~self.suit_masks[suit]
+                # джокер закрывает не больше одной карты масти
+                if not missing or not missing & (missing - 1) and SUIT_JOKERS[suit] in self.jokers:
+                    return [DECK_INTS[rank][suit] for rank in window]
+
+    def groups(self, sizes):
+        """Ранги групп одинаковых карт размеров sizes (одна или две группы) от лучших к худшим"""
+        count_jokers = len(self.jokers)
+        for rank in RANKS_DESC:
+            if self.counts[rank] + count_jokers < sizes[0]:
+                continue
+            if len(sizes) == 1:
+                yield (rank,)
+                continue
+            left = count_jokers - max(0, sizes[0] - self.counts[rank])
+            for second in RANKS_DESC:
+                if second != rank and self.counts[second] + left >= sizes[1] and \
+                        (sizes[0] != sizes[1] or second < rank):
+                    yield rank, second
+
+    def kind(self, sizes, count_kickers):
+        """
+        Лучшая рука из групп одинаковых рангов размеров sizes и count_kickers кикеров
+        Джокеры закрывают недостающие карты групп (каждый - своим цветом), оставшиеся идут в кикеры
+        """
+        for groups in self.groups(sizes):
+            deficits = [max(0, size - self.counts[rank]) for size, rank in zip(sizes, groups)]
+            best = None
+            for assignment in itertools.product(range(-1, len(groups)), repeat=len(self.jokers)):
+                made = []
+                for i, (size, rank) in enumerate(zip(sizes, groups)):
+                    joker_cards = [
+                        self.joker_card(joker, rank) for joker, group in zip(self.jokers, assignment) if group == i
+                    ]
+                    if len(joker_cards) != deficits[i] or None in joker_cards:
+                        break
+                    made += self.real_cards(rank, size) + joker_cards
+                else:
+                    kickers = [
+                        (rank, self.real_cards(rank, 1)[0])
+                        for rank in RANKS_DESC if rank not in groups and self.counts[rank]
+                    ]
+                    for joker, group in zip(self.jokers, assignment):
+                        if group == -1:
+                            used = set(groups) | {rank for rank, _ in kickers}
+                            kickers.append(next(
+                                (rank, self.joker_card(joker, rank)) for rank in RANKS_DESC
+                                if rank not in used and self.joker_card(joker, rank)
+                            ))
+                    kickers = sorted(kickers, reverse=True)[:count_kickers]
+                    if best is None or kickers > best[0]:
+                        best = (kickers, made + [card for _, card in kickers])
+            if best is not None:
+                return best[1]
+
+    def flash(self):
+        best = None
+        for suit in SUITS_DESC:
+            mask = self.suit_masks[suit]
+            if SUIT_JOKERS[suit] in self.jokers:
+                # джокер - старшая недостающая карта масти
+                free = ~mask & ((1 << len(RANKS)) - 1)
+                mask |= 1 << (free.bit_length() - 1)
+            if POPCOUNTS[mask] >= 5:
+                ranks = [rank for rank in RANKS_DESC if mask >> rank & 1][:5]
+                if best is None or ranks > best[0]:
+                    best = (ranks, [DECK_INTS[rank][suit] for rank in ranks])
+        if best is not None:
+            return best[1]
+
+    def straight(self):
+        for window_mask, window in STRAIGHT_WINDOWS:
+            missing = window_mask & ~self.ranks_mask
+            if POPCOUNTS[missing] <= len(self.jokers):
+                jokers = dict(zip([rank for rank in window if missing >> rank & 1], self.jokers))
+                return [
+                    self.joker_card(jokers[rank], rank) if rank in jokers else self.real_cards(rank, 1)[0]
+                    for rank in window
+                ]
+
+    def high_card(self):
+        return [self.real_cards(rank, 1)[0] for rank in RANKS_DESC if self.counts[rank]][:5]
+
+
+def evaluate_wild(cards, jokers):
+    """
+    Лучшая рука с джокерами без перебора замен: для каждой категории, от старшей к младшей,
+    лучшее дополнение находится сразу по маскам мастей рангов
+    :param cards: реальные карты, array int
+    :param jokers: джокеры (RED_JOKER, BLACK_JOKER), не более одного каждого цвета
+    :return: (сила, лучшие 5 карт с подставленными вместо джокеров картами)
+    """
+    hand = _WildHand(cards, jokers)
+    for best_cards in (
+            hand.straight_flush,
+            lambda: hand.kind((4,), 1),
+            lambda: hand.kind((3, 2), 0),
+            hand.flash,
+            hand.straight,
+            lambda: hand.kind((3,), 2),
+            lambda: hand.kind((2, 2), 1),
+            lambda: hand.kind((2,), 3),
+            hand.high_card,
+    ):
+        result = best_cards()
+        if result:
+            return evaluate5(*result), tuple(sorted(result, reverse=True))
 
 
-def best_straight(hand, joker_hand):
+def evaluate_wild_by_substitution(cards, jokers):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает лучший набор из возможных стритов, если таковые имеются, в противном случае None
-    Примечание: при наличии джокеров среди нескольких стритов выбираем лучший по весу
-    """
-    if joker_hand:
-        hand = list(set(hand) - set(joker_hand))
-        weight_straight = {}
-        for joker_cards in jokers_cards_for_straight(joker_hand):
-            straight = best_straight_by_hand(hand + joker_cards)
-            if straight:
-                weight = get_weight_hand(straight)
-                weight_straight[weight] = straight
-        if weight_straight:
-            best_weight = max(weight_straight)
-            return weight_straight[best_weight]
+    Эталон для evaluate_wild: перебор всех замен джокеров (до 26 карт на джокера)
+    :return: сила лучшей руки
+    """
+    substitutions = [
+        [DECK_INTS[rank][suit] for rank in range(len(RANKS)) for suit in JOKER_SUITS[joker]
+         if DECK_INTS[rank][suit] not in cards]
+        for joker in jokers
+    ]
+    return max(
+        evaluate_best(list(cards) + list(substitution))[0]
+        for substitution in itertools.product(*substitutions)
+    )
+
+
+def check_wild_hands(size=5):
+    """
+    Сверяет evaluate_wild с перебором замен на всех руках из size карт с одним и двумя джокерами
+    :return: количество проверенных рук, AssertionError при расхождении
+    """
+    checked = 0
+    deck = sorted(CARD_INTS.values())
+    for jokers in ((RED_JOKER,), (BLACK_JOKER,), (RED_JOKER, BLACK_JOKER)):
+        for cards in itertools.combinations(deck, size - len(jokers)):
+            expected = evaluate_wild_by_substitution(cards, jokers)
+            assert evaluate_wild(cards, jokers)[0] == expected, (map(int_to_card, cards), jokers)
+            checked += 1
+    return checked
+
+
+#########################################
+### классификация руки за один проход ###
+#########################################
+
+# сколько рук classify отнес к каждой категории (индекс - категория)
+CATEGORY_COUNTS = [0] * len(CATEGORY_NAMES)
+# карты ранга по маске мастей (бит масти - 1 << индекс масти), старшие масти первыми
+RANK_SUIT_CARDS = [
+    [[DECK_INTS[rank][suit] for suit in SUITS_DESC if suits >> suit & 1] for suits in range(1 << len(SUITS))]
+    for rank in range(len(RANKS))
+]
+# лучший стрит (ранги по значимости) по маске рангов или None
+STRAIGHT_BY_MASK = [
+    next((window for window_mask, window in STRAIGHT_WINDOWS if mask & window_mask == window_mask), None)
+    for mask in range(1 << len(RANKS))
+]
+# индекс масти по ее биту в карте ((card >> 12) & 0xF)
+SUIT_NUMBERS = [SUIT_INDICES.get(suit_bit << 12) for suit_bit in range(16)]
+
+
+def classify(cards):
+    """
+    Лучшая рука за один проход по картам: гистограмма рангов, маски рангов по мастям и общая маска
+    рангов (для стритов), категория выбирается сразу по ним, без перебора 5ти карт
+    :param cards: набор из [5-7] карт, array int
+    :return: (сила, лучшие 5 карт по убыванию), то же, что evaluate_best:
+        при равной силе выбираются карты со старшими мастями
+    """
+    counts = [0] * 13
+    suits_by_rank = [0] * 13
+    suit_masks = [0, 0, 0, 0]
+    for card in cards:
+        rank = (card >> 8) & 0xF
+        counts[rank] += 1
+        suits_by_rank[rank] |= (card >> 12) & 0xF
+        suit_masks[SUIT_NUMBERS[(card >> 12) & 0xF]] |= card >> 16
+
+    flush_suit = None
+    for suit in SUITS_DESC:
+        if POPCOUNTS[suit_masks[suit]] >= 5:
+            flush_suit = suit
+            mask = suit_masks[suit]
+            window = STRAIGHT_BY_MASK[mask]
+            if window:
+                return _classified(STRAIGHT_FLUSH, [DECK_INTS[rank][suit] for rank in window])
+    groups = [[], [], [], [], []]  # ранги по количеству карт, от старших к младшим
+    for rank in RANKS_DESC:
+        groups[counts[rank]].append(rank)
+    quads, sets, pairs, singles = groups[4], groups[3], groups[2], groups[1]
+
+    if quads:
+        kicker = max(rank for rank in RANKS_DESC if counts[rank] and rank != quads[0])
+        return _classified(CARE, RANK_SUIT_CARDS[quads[0]][15] + RANK_SUIT_CARDS[kicker][suits_by_rank[kicker]][:1])
+    if sets and (len(sets) > 1 or pairs):
+        low = max(sets[1:] + pairs)
+        return _classified(FULL_HOUSE, RANK_SUIT_CARDS[sets[0]][suits_by_rank[sets[0]]][:3] +
+                           RANK_SUIT_CARDS[low][suits_by_rank[low]][:2])
+    if flush_suit is not None:
+        return _classified(FLASH, [DECK_INTS[rank][flush_suit] for rank in RANKS_DESC if mask >> rank & 1][:5])
+    window = STRAIGHT_BY_MASK[suit_masks[0] | suit_masks[1] | suit_masks[2] | suit_masks[3]]
+    if window:
+        return _classified(STRAIGHT, [RANK_SUIT_CARDS[rank][suits_by_rank[rank]][0] for rank in window])
+    # остались сет, пары или старшая карта: ранги групп и кикеров не пересекаются
+    if sets:
+        category, made, rest = SET, RANK_SUIT_CARDS[sets[0]][suits_by_rank[sets[0]]], singles[:2]
+    elif len(pairs) > 1:
+        category, rest = TWO_PAIR, sorted(pairs[2:] + singles, reverse=True)[:1]
+        made = RANK_SUIT_CARDS[pairs[0]][suits_by_rank[pairs[0]]] + RANK_SUIT_CARDS[pairs[1]][suits_by_rank[pairs[1]]]
+    elif pairs:
+        category, made, rest = PAIR, RANK_SUIT_CARDS[pairs[0]][suits_by_rank[pairs[0]]], singles[:3]
     else:
-        straight = best_straight_by_hand(hand)
-        if straight:
-            return straight
+        category, made, rest = HIGH_CARD, [], singles[:5]
+    return _classified(category, made + [RANK_SUIT_CARDS[rank][suits_by_rank[rank]][0] for rank in rest])
 
 
-def best_straight_by_hand(hand):
-    """
-    :param hand: набор из 7 карт
-    :return: возвращает набор из 5 карт если он является стритом, в противном случае None
-    PS: в случае отсортированной руки достаточно 3 проверки на стрит
-    """
-    for shift in reversed(range(3)):
-        cards = hand[shift: shift + 5]
-        if best_straight_by_5(cards):
-            return cards
+def _classified(category, cards):
+    CATEGORY_COUNTS[category] += 1
+    return evaluate5(*cards), tuple(sorted(cards, reverse=True))
 
 
-def best_straight_by_5(hand):
-    """
-    :param hand: набор из 5 карт
-    :return: возвращает набор если он является стритом, в противном случае None
-    PS: стритом будем считать, если все имеют одинаковые ранги и разница между границами составляет 4
-    """
-    hand = sort_hand(hand)
-    ranks = list(map(get_index_rank, hand))
-    first, last = ranks[0], ranks[-1]
-    if len(set(ranks)) == 5 and (last - first) == 4:
-        return hand
+def category_counts():
+    """:return: сколько рук classify отнес к каждой категории, {название категории: количество}"""
+    return collections.OrderedDict(zip(CATEGORY_NAMES, CATEGORY_COUNTS))
+
+
+####################################
+### кэш по изоморфизму мастей ###
+####################################
 
-    # необходимо учесть случай перехода, т.е. 5♦ 4♥ 3♠ 2♦ A♦.
-    rank_a = RANKS.index('A')
-    rank_2 = RANKS.index('2')
-    if rank_a in ranks and rank_2 in ranks:
-        ranks.pop(rank_a)
-        first, last = ranks[0], ranks[-1]
-        if len(set(ranks)) == 4 and (last - first) == 3:
-            return hand
+CANONICAL_CACHE_SIZE = 1 << 20
+BLACK_SUIT_INDICES = tuple(WEIGHT_SUITS[suit] for suit in BLACK_SUITS)
+RED_SUIT_INDICES = tuple(WEIGHT_SUITS[suit] for suit in RED_SUITS)
 
+CanonicalCacheInfo = collections.namedtuple('CanonicalCacheInfo', 'hits misses size hit_rate')
 
-def best_set(hand, joker_hand):
+
+def canonical_key(cards, jokers=()):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает сет + 2 старшие карты, если таковые имеются, в противном случае None
+    Ключ класса рук, одинаковых с точностью до перестановки мастей (сила руки у них одна)
+    :param cards: реальные карты, array int
+    :param jokers: джокеры руки, tuple
+    :return: (ключ, порядок мастей: индекс масти для каждой позиции в ключе или None)
+        - без джокеров и без возможности флеша масти не важны: ключ - ранги (от 5 до 7 элементов)
+        - без джокеров: отсортированные маски рангов мастей (4 элемента)
+        - с джокерами масти переставляются только внутри цвета, джокер ограничен цветом:
+          (джокеры, маски мастей в порядке мастей) - 2 элемента
+    Примечание: при равных масках порядок мастей сохраняется, поэтому выбор из равных карт не меняется
+    """
+    masks = [0] * len(SUITS)
+    for card in cards:
+        masks[SUIT_INDICES[card & 0xF000]] |= card >> 16
+    if jokers:
+        order = (sorted(BLACK_SUIT_INDICES, key=lambda suit: (masks[suit], suit)) +
+                 sorted(RED_SUIT_INDICES, key=lambda suit: (masks[suit], suit)))
+        return (jokers, tuple(masks[suit] for suit in order)), order
+    if max(POPCOUNTS[mask] for mask in masks) >= 5:
+        return tuple(sorted(masks)), None
+    return tuple(sorted((card >> 8) & 0xF for card in cards)), None
+
+
+class CanonicalCache(object):
     """
-    cards = hand + joker_hand
-    _set = best_kind(3, cards)
-    if _set:
-        joker_cards_used = list(set(_set) & set(joker_hand))
-        joker_hand = cut_joker_hand(joker_hand, joker_cards_used)
-        sub_cards = cut_hand(hand, exclude_hand=_set)
-        high_cards = best_kind(1, sub_cards + joker_hand, count_seq=2)
-        return _set + high_cards
+    Кэш best_hand по каноническому ключу руки (см. canonical_key). Без джокеров хранится только сила,
+    а лучшие 5 карт выбираются из карт руки через select_cards; с джокерами хранятся лучшие карты в
+    виде (ранг, позиция масти в ключе, замена джокером), которые переводятся обратно в масти руки.
+    """
+
+    def __init__(self, maxsize=CANONICAL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def best_hand(self, hand):
+        """best_hand (и best_wild_hand) через кэш"""
+        # порядок джокеров влияет на выбор из равных по силе рук, поэтому он входит в ключ
+        jokers = tuple(card for card in hand if card in JOKERS)
+        cards = parse_hand(card for card in hand if card not in JOKERS)
+        key, order = canonical_key(cards, jokers)
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+            if jokers:
+                strength, best = evaluate_wild(cards, jokers)
+                real = set(cards)
+                result = strength, tuple(
+                    (get_int_rank(card), order.index(SUIT_INDICES[card & 0xF000]), card not in real)
+                    for card in best)
+            else:
+                result = evaluate(cards)
+            if len(self.results) >= self.maxsize:
+                self.results.clear()
+            self.results[key] = result
+        else:
+            self.hits += 1
+        if jokers:
+            if get_category(result[0]) in (FLASH, STRAIGHT_FLUSH):
+                # масть флеша переводится перестановкой мастей
+                best = [DECK_INTS[rank][order[slot]] for rank, slot, _ in result[1]]
+            else:
+                # вне флеша масти выбираются как в evaluate_wild: реальные карты ранга - старшие масти,
+                # джокер - старшая свободная масть своего цвета
+                held = set(cards)
+                best = []
+                for rank, count in collections.Counter(
+                        rank for rank, _, substituted in result[1] if not substituted).items():
+                    best += [DECK_INTS[rank][suit] for suit in SUITS_DESC if DECK_INTS[rank][suit] in held][:count]
+                for rank, slot, substituted in result[1]:
+                    if substituted:
+                        best.append(next(
+                            DECK_INTS[rank][suit] for suit in JOKER_SUITS[SUIT_JOKERS[order[slot]]]
+                            if DECK_INTS[rank][suit] not in held and DECK_INTS[rank][suit] not in best))
+            best.sort(reverse=True)
+        else:
+            best = select_cards(cards, result)
+        return [INT_CARDS[card] for card in best]
+
+    def info(self):
+        """:return: CanonicalCacheInfo - попадания, промахи, размер кэша, доля попаданий"""
+        total = self.hits + self.misses
+        return CanonicalCacheInfo(self.hits, self.misses, len(self.results),
+                                  float(self.hits) / total if total else 0.0)
+
+    def clear(self):
+        self.results.clear()
+        self.hits = self.misses = 0
+
+
+def hand_rank(hand):
+    """Возвращает значение определяющее ранг 'руки': (категория, ранги в порядке значимости)"""
+    return HAND_RANKS[evaluate5(*parse_hand(hand))]
 
 
-def best_two_pair(hand, joker_hand):
+def hand_rank_int(hand):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает две лучшие пары, в противном случае None
+    Ранг "руки" одним целым числом: категория и до 5ти рангов в порядке значимости по 4 бита,
+    сравнение чисел совпадает со сравнением hand_rank
+    :param hand: набор из [5-7] карт (для 6-7 карт - ранг лучшей "руки")
+    :return: int, не больше 24 бит
     """
-    cards = hand + joker_hand
-    pairs = best_kind(2, cards, count_seq=2)
-    if pairs:
-        joker_cards_used = list(set(pairs) & set(joker_hand))
-        joker_hand = cut_joker_hand(joker_hand, joker_cards_used)
-        sub_cards = cut_hand(hand, exclude_hand=pairs)
-        high_card = best_kind(1, sub_cards + joker_hand, count_seq=1)
-        return pairs + high_card
+    return HAND_RANK_INTS[evaluate(parse_hand(hand))]
 
 
-def best_pair(hand, joker_hand):
+def describe_hand_rank_int(key):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возврает лучшую пару, в противном случае None
+    :param key: результат hand_rank_int
+    :return: читаемое описание, например 'FULL HOUSE: T T T 8 8'
     """
-    cards = hand + joker_hand
-    pair = best_kind(2, cards)
-    if pair:
-        joker_cards_used = list(set(pair) & set(joker_hand))
-        joker_hand = cut_joker_hand(joker_hand, joker_cards_used)
-        sub_cards = cut_hand(hand, exclude_hand=pair)
-        high_cards = best_kind(1, sub_cards + joker_hand, count_seq=3)
-        return pair + high_cards
+    category, ranks = unpack_hand_rank(key)
+    return '{}: {}'.format(CATEGORY_NAMES[category], ' '.join(RANKS[rank] for rank in ranks))
+
+
+def card_ranks(hand):
+    """Возвращает список рангов (его числовой эквивалент),
+    отсортированный от большего к меньшему"""
+    return sorted((WEIGHT_RANKS[get_rank(card)] for card in hand), reverse=True)
+
+
+def flush(hand):
+    """Возвращает True, если все карты одной масти"""
+    return len(set(map(get_suit, hand))) == 1
+
+
+def straight(ranks):
+    """Возвращает True, если отсортированные ранги формируют последовательность 5ти,
+    где у 5ти карт ранги идут по порядку (стрит)"""
+    if len(set(ranks)) != 5:
+        return False
+    # туз может быть младшей картой: 5 4 3 2 A
+    return ranks[0] - ranks[-1] == 4 or list(ranks) == [WEIGHT_RANKS['A'], 3, 2, 1, 0]
+
+
+def kind(n, ranks):
+    """Возвращает первый ранг, который n раз встречается в данной руке.
+    Возвращает None, если ничего не найдено"""
+    for rank in ranks:
+        if ranks.count(rank) == n:
+            return rank
+
+
+def two_pair(ranks):
+    """Если есть две пары, то возврщает два соответствующих ранга,
+    иначе возвращает None"""
+    high = kind(2, ranks)
+    low = kind(2, list(reversed(ranks)))
+    if high is not None and low != high:
+        return high, low
 
 
-def best_high_card(hand, joker_hand):
+def best_hand(hand):
     """
+    Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт
     :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает 5 лучших карт из набора
+    :return: возвращает лучший набор из 5 карт
+    Примечание: руки с джокерами передаются в best_wild_hand
     """
-    cards = hand + joker_hand
-    high_cards = best_kind(1, cards, count_seq=5)
-    if high_cards:
-        return high_cards
+    if RED_JOKER in hand or BLACK_JOKER in hand:
+        return best_wild_hand(hand)
+    cards = parse_hand(hand)
+    if table7 is not None and len(cards) == 7:
+        cards = select_cards(cards, table7.evaluate(cards))
+    else:
+        _, cards = classify(cards)
+    return [INT_CARDS[card] for card in cards]
 
 
-###############################
-### вспомогательные функции ###
-###############################
+def best_wild_hand(hand):
+    """best_hand но с джокерами"""
+    jokers = [card for card in hand if card in JOKERS]
+    if not jokers:
+        return best_hand(hand)
+    _, cards = evaluate_wild(parse_hand(card for card in hand if card not in JOKERS), jokers)
+    return [INT_CARDS[card] for card in cards]
 
-def get_weight(card):
-    """
-    :param card: карта, str
-    :return: Возвращает вес карты, int
-    Примеры:
-        2S -> 0
-        4D -> 22
-        TS -> 80
-        AH -> 123
-    """
-    rank, suit = card
-    return 10 * WEIGHT_RANKS.get(rank) + WEIGHT_SUITS.get(suit)
+
+ShowdownResult = collections.namedtuple('ShowdownResult', 'winners groups best_hands strengths')
 
 
-def get_weight_hand(hand):
+def showdown(board, players):
     """
-    :param hand: набор карт
-    :return: Вовзращает вес руки
+    Вскрытие: один борд на всех игроков, работа по борду (счетчики рангов и мастей) делается один раз
+    :param board: 5 карт борда, array str
+    :param players: карманные карты игроков, array array str
+    :return: ShowdownResult:
+        winners - номера победителей (несколько при дележе банка)
+        groups - номера игроков, сгруппированные по равной силе руки, от сильнейших к слабейшим
+        best_hands - лучшие 5 карт каждого игрока
+        strengths - сила руки каждого игрока
     """
-    return sum(map(get_weight, hand))
-
-
-def sort_hand(hand):
+    board = parse_hand(board)
+    board_state = HandState(board)
+    holes = [parse_hand(hole) for hole in players]
+    strengths = [
+        HandState(board + hole, board_state.key + CARD_KEYS7[hole[0]] + CARD_KEYS7[hole[1]]).strength()
+        if len(hole) == 2 else HandState(board + hole).strength()
+        for hole in holes
+    ]
+    groups = []
+    for strength in sorted(set(strengths), reverse=True):
+        groups.append([i for i, player_strength in enumerate(strengths) if player_strength == strength])
+    best_hands = [
+        [INT_CARDS[card] for card in select_cards(board + hole, strength)]
+        for hole, strength in zip(holes, strengths)
+    ]
+    return ShowdownResult(groups[0] if groups else [], groups, best_hands, strengths)
+
+
+##################################
+### пакетная оценка (numpy) ###
+##################################
+
+# индекс карты для пакетной оценки: 4 * ранг + масть, порядок совпадает с card_to_int
+CARD_INDICES = {card: 4 * WEIGHT_RANKS[get_rank(card)] + WEIGHT_SUITS[get_suit(card)] for card in CARD_INTS}
+BATCH_CHUNK_SIZE = 1 << 16
+
+
+def parse_hand_batch(hands):
     """
-    :param hand: набор карт, array str
-    :return: отсортированный набор карт 2S, 2C, 2D, ... AC, AD, AH, array str
+    :param hands: набор рук одинаковой длины, array array str
+    :return: ndarray[N, k] индексов карт (CARD_INDICES)
     """
-    hand_with_weight = {get_weight(card): card for card in hand}
-    return [hand_with_weight.get(weight) for weight in sorted(hand_with_weight)]
+    return numpy.array([[CARD_INDICES[card] for card in hand] for hand in hands], dtype=numpy.int8)
 
 
-def cut_hand(hand, exclude_hand):
+def _top_ranks(present, count):
     """
-    :param hand: набор карт
-    :param exclude_hand: набор карт
-    :return: Исключает из набора hand набор exclude_hand
+    :param present: ndarray[N, 13] bool
+    :return: ndarray[N, count] старших рангов, для которых present истинно
     """
-    # PS: важно сохранить порядок следования карт в руке, поэтому не используем разность множеств
-    return [card for card in hand if card not in exclude_hand]
+    return numpy.argsort(-(present * 16 + numpy.arange(len(RANKS))), axis=1, kind='mergesort')[:, :count]
 
 
-def cut_joker_hand(joker_hand, joker_cards_used):
+def _straight_highs(present):
     """
-    :param joker_hand: набор джокерных карт
-    :param joker_cards_used: набор разыгранных карт
-    :return: Исключает все сгенерированные карты из joker_hand на основе уже сыгранных карт
+    :param present: ndarray[N, 13] bool
+    :return: ndarray[N] старшего ранга стрита, 3 для стрита от туза (5-high), -1 если стрита нет
     """
-    for joker_card in joker_cards_used:
-        joker_suit = get_suit(joker_card)
-        if joker_suit in RED_SUITS:
-            joker_hand = list(set(joker_hand) - set(RED_CARDS))
-        if joker_suit in BLACK_SUITS:
-            joker_hand = list(set(joker_hand) - set(BLACK_CARDS))
-    return joker_hand
-
-
-def best_kind(count_card_need, hand, count_seq=1):
+    highs = numpy.where(present[:, [12, 0, 1, 2, 3]].all(axis=1), 3, -1)
+    for high in range(4, len(RANKS)):
+        highs[present[:, high - 4:high + 1].all(axis=1)] = high
+    return highs
+
+
+def _straight_ranks(highs):
+    """Ранги стрита в порядке значимости по старшему рангу, ndarray[N, 5]"""
+    ranks = highs[:, None] - numpy.arange(5)
+    ranks[ranks < 0] = RANKS.index('A')
+    return ranks
+
+
+def _best_hand_chunk(hands):
+    """best_hand_batch для одного куска, см. best_hand_batch"""
+    count, size = hands.shape
+    rows = numpy.arange(count)
+    ranks, suits = hands // 4, hands % 4
+    hist = (ranks[:, :, None] == numpy.arange(len(RANKS))).sum(axis=1)
+    suit_hist = (suits[:, :, None] == numpy.arange(len(SUITS))).sum(axis=1)
+    present = hist > 0
+
+    flush_suits = suit_hist.argmax(axis=1)
+    is_flush = suit_hist[rows, flush_suits] >= 5
+    is_suited = suits == flush_suits[:, None]
+    flush_present = ((ranks[:, :, None] == numpy.arange(len(RANKS))) & is_suited[:, :, None]).any(axis=1)
+    flush_present &= is_flush[:, None]
+
+    straight_highs = _straight_highs(present)
+    straight_flush_highs = _straight_highs(flush_present)
+    top_cares = _top_ranks(hist >= 4, 1)[:, 0]
+    top_sets = _top_ranks(hist >= 3, 1)[:, 0]
+    count_sets = (hist >= 3).sum(axis=1)
+    count_pairs = (hist >= 2).sum(axis=1)
+
+    # категория: проверяем от старшей к младшей, т.е. присваиваем от младшей к старшей
+    categories = numpy.full(count, HIGH_CARD, dtype=numpy.int8)
+    categories[count_pairs >= 1] = PAIR
+    categories[count_pairs >= 2] = TWO_PAIR
+    categories[count_sets >= 1] = SET
+    categories[straight_highs >= 0] = STRAIGHT
+    categories[is_flush] = FLASH
+    categories[(count_sets >= 1) & (count_pairs >= 2)] = FULL_HOUSE
+    categories[(hist >= 4).any(axis=1)] = CARE
+    categories[straight_flush_highs >= 0] = STRAIGHT_FLUSH
+
+    # ранги в порядке значимости для каждой категории
+    sig = _top_ranks(present, 5)
+    high_pairs = _top_ranks(hist >= 2, 2)
+    pair_ranks = numpy.where(high_pairs[:, :1] == top_sets[:, None], high_pairs[:, 1:], high_pairs[:, :1])[:, 0]
+    for category, group in (
+            (PAIR, high_pairs[:, [0, 0]]),
+            (TWO_PAIR, high_pairs[:, [0, 0, 1, 1]]),
+            (SET, numpy.repeat(top_sets[:, None], 3, axis=1)),
+            (CARE, numpy.repeat(top_cares[:, None], 4, axis=1)),
+    ):
+        mask = categories == category
+        kickers_present = present[mask].copy()
+        kickers_present[numpy.arange(mask.sum())[:, None], group[mask]] = False
+        sig[mask] = numpy.hstack((group[mask], _top_ranks(kickers_present, 5 - group.shape[1])))
+    mask = categories == FULL_HOUSE
+    sig[mask] = numpy.hstack((
+        numpy.repeat(top_sets[mask, None], 3, axis=1), numpy.repeat(pair_ranks[mask, None], 2, axis=1),
+    ))
+    mask = categories == STRAIGHT
+    sig[mask] = _straight_ranks(straight_highs[mask])
+    mask = categories == FLASH
+    sig[mask] = _top_ranks(flush_present[mask], 5)
+    mask = categories == STRAIGHT_FLUSH
+    sig[mask] = _straight_ranks(straight_flush_highs[mask])
+
+    keys = categories.astype(numpy.int64)
+    for i in range(5):
+        keys = (keys << 4) | sig[:, i]
+    strengths = numpy.searchsorted(PACKED_HAND_RANKS, keys) + 1
+
+    # карты: по каждому рангу в порядке значимости берем неиспользованную карту старшей масти
+    allowed = numpy.where(
+        ((categories == FLASH) | (categories == STRAIGHT_FLUSH))[:, None], is_suited, True,
+    )
+    indices = numpy.empty((count, 5), dtype=numpy.int8)
+    for i in range(5):
+        candidates = allowed & (ranks == sig[:, i:i + 1])
+        indices[:, i] = numpy.where(candidates, suits, -1).argmax(axis=1)
+        allowed[rows, indices[:, i]] = False
+    order = numpy.argsort(-hands[rows[:, None], indices], axis=1, kind='mergesort')
+    return categories, strengths, indices[rows[:, None], order]
+
+
+def best_hand_batch(hands, chunk_size=BATCH_CHUNK_SIZE):
     """
-    :param count_card_need: искомое количество карт с одинаковым rank
-    :param hand: набор из N кат, array str
-    :param count_seq: количество наборов последовательностей с count_card_need
-    :return: возвращает count_seq наборов с количеством count_card_need кард, в противном случае None
-    Например: best_kind(count_card_need=3, hand, count_seq=2) => [6C, 6D, 6H, 10H, 10D, 10C]
-    Примечание: чтобы не пропустить фул-хаус в примере выше, проверку делаем >= n
+    Векторная версия best_hand без джокеров
+    :param hands: ndarray[N, k] индексов карт (CARD_INDICES), 5 <= k <= 7, см. parse_hand_batch
+    :param chunk_size: количество рук, обрабатываемых за раз (ограничивает промежуточную память)
+    :return: (categories, strengths, indices):
+        categories - ndarray[N] категорий рук
+        strengths - ndarray[N] сил рук, те же, что у evaluate_best
+        indices - ndarray[N, 5] номеров столбцов hands с лучшими 5 картами, в порядке best_hand
     """
-    hand = sort_hand(hand)
-    best_kind_cards = []
+    if numpy is None:
+        raise ImportError('best_hand_batch requires numpy')
+    hands = numpy.asarray(hands)
+    if hands.ndim != 2 or not 5 <= hands.shape[1] <= 7:
+        raise ValueError('hands must be an array of shape (N, 5..7)')
+    chunks = [
+        _best_hand_chunk(hands[start:start + chunk_size].astype(numpy.int64))
+        for start in range(0, len(hands), chunk_size)
+    ] or [_best_hand_chunk(hands.astype(numpy.int64))]
+    return tuple(numpy.concatenate(arrays) for arrays in zip(*chunks))
+
+
+if numpy is not None:
+    PACKED_HAND_RANKS = numpy.array(HAND_RANK_INTS[1:], dtype=numpy.int64)
 
-    i = count_seq
-    while i:
-        best_rank = find_best_rank(count_card_need, hand)
-        if not best_rank:
-            break
-        n_cards = [card for card in hand if get_rank(card) == best_rank][-count_card_need:]
-        best_kind_cards += n_cards
-        hand = cut_hand(hand, exclude_hand=n_cards)
-        i -= 1
 
-    # проверим, вдруг нашли меньше, чем требуется
-    if len(best_kind_cards) == count_card_need * count_seq:
-        return best_kind_cards
+######################################
+### потоковая оценка истории рук ###
+######################################
 
+STREAM_CHUNK_SIZE = 1000
+STATS_INTERVAL = 5.0  # секунд между выводами статистики в stderr
 
-def find_best_rank(count_card_need, hand):
+
+def open_stream(path, mode='rb'):
     """
-    :param count_card_need: искомое количество карт с одинаковым rank
-    :param hand: набор из N кат, array str
-    :return: Ищет лучшую комбинацию из count_card_need одинаковых rank
+    :param path: путь к файлу, '-' - stdin/stdout, *.gz - сжатый gzip
+    :return: файловый объект
     """
-    ranks = list(map(get_rank, hand))
-    best_ranks = [rank for rank, count_rank in collections.Counter(ranks).items() if count_rank >= count_card_need]
-    for rank in ranks[::-1]:
-        if rank in best_ranks:
-            return rank
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
 
 
-def get_high_card_by_suits(joker_hand):
+def read_records(paths, csv_format=False):
     """
-    Возвращает старшие карты каждой масти из набора joker_hand
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает по 1 старшей карте на каждую масть из набора joker_hand
-    PS: необходимо в основном для определения флэша
-    Например:
-        input: [..., 'JH', 'JD', 'QH', 'QD', 'KD', 'AD']
-        output: ['QH', 'AD']
+    Построчно читает записи рук из файлов, не загружая их целиком
+    :return: генератор записей: строк (текст) или списков полей (csv)
     """
-    result = []
-    suits = set(map(get_suit, joker_hand))
-    for card in joker_hand[::-1]:
-        suit = get_suit(card)
-        if suit in suits:
-            result.append(card)
-            suits.remove(suit)
-        if not suits:
-            break
-    return result
+    for path in paths:
+        stream = open_stream(path)
+        try:
+            if csv_format:
+                for row in csv.reader(stream):
+                    if row:
+                        yield row
+            else:
+                for line in stream:
+                    line = line.strip()
+                    if line:
+                        yield line
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
 
 
-def generate_cards_by_jokers(hand, jokers):
+def evaluate_records(records, csv_format=False, column=0):
     """
-    Генерирует возможные карты колоды, которые могут быть заменены джокерами, в которые не входят входные карты
-    :param hand: набор из [5-7] карт
-    :param jokers: список джокеров
-    :return: список карт
-    """
-    cards_by_jokers = {
-        RED_JOKER: RED_CARDS,
-        BLACK_JOKER: BLACK_CARDS,
-    }
-    cards = []
-    for joker in jokers:
-        cards += cards_by_jokers.get(joker)
-    return list(set(cards) - set(hand))
-
-
-def jokers_cards_for_straight(joker_hand):
-    """
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает отсортированный набор джокерных карт для стрита, по одной карте или по двум (в зависимости
-    от количества джокерных карт)
-    PS: по сути не важно какой suit назначить по существующим джокерам, поэтому в случае только черного джокера
-    берем крести, в противном случае черви. А для случая стрит-флеша, сначала идет проверка на флеш, которая
-    фильтрует джокерные карты до одного suit.
-    """
-    joker_suits = set(map(get_suit, joker_hand))
-    joker_suit = 'C' if joker_suits & set(BLACK_SUITS) else 'H'
-    count_jokers = joker_suits & (set(RED_SUITS) | set(BLACK_SUITS))
-    need_pair = count_jokers == 4
-
-    joker_cards = ['{}{}'.format(rank, joker_suit) for rank in set(map(get_rank, joker_hand))]
-    joker_cards = sort_hand(joker_cards)
-    if need_pair:
-        # формируем комбинации из соседних карт
-        joker_cards = list(zip(joker_cards[:-1], joker_cards[1:]))
-    else:
-        joker_cards = [[card] for card in joker_cards]
-    return joker_cards
+    Оценивает кусок записей (выполняется в процессах пула)
+    :param records: строки с картами через пробел или csv-строки, где карты в столбце column
+    :return: (количество рук, количество ошибок, строки результата)
+    """
+    output = io.BytesIO()
+    writer = csv.writer(output, lineterminator='\n') if csv_format else None
+    errors = 0
+    for record in records:
+        try:
+            hand = (record[column] if csv_format else record).split()
+            cards = best_wild_hand(hand)
+            strength = evaluate5(*parse_hand(cards))
+            result = [' '.join(cards), CATEGORY_NAMES[get_category(strength)], str(strength)]
+        except (KeyError, IndexError, ValueError, TypeError):
+            errors += 1
+            result = ['', 'INVALID', '']
+        if csv_format:
+            writer.writerow(record + result)
+        else:
+            output.write('\t'.join([record] + result) + '\n')
+    return len(records), errors, output.getvalue()
+
+
+def _evaluate_records_safe(records, csv_format=False, column=0):
+    """
+    evaluate_records для пула: исключение возвращается результатом, а не теряется -
+    иначе callback apply_async не вызывается и кусок навсегда остается в обработке
+    """
+    try:
+        return evaluate_records(records, csv_format, column)
+    except Exception as e:
+        return RuntimeError('chunk evaluation failed: {!r}'.format(e))
+
 
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-def jokers_cards_for_kind(joker_hand):
+
+def evaluate_stream(paths, output='-', csv_format=False, column=0, workers=None,
+                    chunk_size=STREAM_CHUNK_SIZE, ordered=True, stats=sys.stderr):
     """
-    :param hand: набор из [5-7] карт
-    :param joker_hand: набор из n карт, в которые можно превратить джокеров
-    :return: возвращает набор, в котором выбрана только одна карта из двух возможных для каждого rank
+    Оценивает руки из файлов конвейером: чтение и разбор (поток) -> оценка (пул процессов) -> запись (поток).
+    В обработке одновременно не больше 2 * workers кусков, поэтому память ограничена при любом размере входа.
+    :param paths: входные файлы ('-' - stdin, *.gz - gzip)
+    :param output: выходной файл ('-' - stdout, *.gz - gzip)
+    :param workers: количество процессов, None - по числу ядер, 0 - оценка в текущем процессе
+    :param ordered: сохранять порядок входа; без него куски пишутся по мере готовности
+    :param stats: поток для статистики (руки/с), None - без статистики
+    :return: (количество рук, количество ошибок)
     """
-    if not joker_hand:
-        return []
-    result = []
-    for rank in RANKS:
-        for cards in (
-                (rank + 'H', rank + 'D'),
-                (rank + 'C', rank + 'S'),
-        ):
-            exist_cards = list(filter(lambda card: card in joker_hand, cards))
-            if exist_cards:
-                result.append(exist_cards[0])
-    return result
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    window = 2 * max(workers, 1)
+    pool = multiprocessing.Pool(workers) if workers else None
+    chunks = Queue.Queue(maxsize=window)
+    results = Queue.Queue()
+    progress = threading.Condition()  # уведомляет о записанном куске и об остановке писателя
+    totals = {'hands': 0, 'errors': 0, 'inflight': 0}
+    failures = []
+    started = time.time()
+
+    def report(final=False):
+        elapsed = max(time.time() - started, 1e-9)
+        if stats is not None:
+            stats.write('{} hands, {} invalid, {:.0f} hands/s{}\n'.format(
+                totals['hands'], totals['errors'], totals['hands'] / elapsed, ' (done)' if final else '',
+            ))
+
+    def read():
+        try:
+            for chunk in _chunks(read_records(paths, csv_format), chunk_size):
+                chunks.put(chunk)
+        except (IOError, csv.Error) as e:
+            failures.append(e)
+        finally:
+            chunks.put(None)
+
+    def write():
+        try:
+            stream = open_stream(output, 'wb')
+            last_report = time.time()
+            try:
+                while True:
+                    result = results.get()
+                    if result is None:
+                        break
+                    result = result.get() if ordered and pool is not None else result
+                    if isinstance(result, Exception):
+                        raise result
+                    hands, errors, lines = result
+                    stream.write(lines)
+                    totals['hands'] += hands
+                    totals['errors'] += errors
+                    with progress:
+                        totals['inflight'] -= 1
+                        progress.notify()
+                    if time.time() - last_report >= STATS_INTERVAL:
+                        last_report = time.time()
+                        report()
+            finally:
+                try:
+                    stream.flush()
+                finally:
+                    if stream is not sys.stdout:
+                        stream.close()
+        except Exception as e:
+            # ошибка записи (EPIPE, нет каталога) или оценки: конвейер останавливается, а не зависает
+            failures.append(e)
+        finally:
+            with progress:
+                progress.notify()
+
+    def wait_inflight(limit):
+        """Ждет, пока в обработке не больше limit кусков; False, если конвейер остановлен ошибкой"""
+        with progress:
+            while totals['inflight'] > limit and not failures:
+                progress.wait()
+        return not failures
+
+    reader = threading.Thread(target=read, name='poker-reader')
+    writer = threading.Thread(target=write, name='poker-writer')
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None or not wait_inflight(window - 1):
+                break
+            with progress:
+                totals['inflight'] += 1
+            args = (chunk, csv_format, column)
+            if pool is None:
+                results.put(_evaluate_records_safe(*args))
+            elif ordered:
+                results.put(pool.apply_async(_evaluate_records_safe, args))
+            else:
+                pool.apply_async(_evaluate_records_safe, args, callback=results.put)
+        # все куски отправлены: ждем окончания обработки
+        wait_inflight(0)
+        results.put(None)
+        writer.join()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    if pool is not None:
+        # после ошибки в пуле остается не больше window кусков; terminate в Python 2 может зависнуть,
+        # если обработчик задач в этот момент пишет кусок в канал воркеров, поэтому дожидаемся их
+        pool.close()
+        pool.join()
+    if failures:
+        raise failures[0]
+    report(final=True)
+    return totals['hands'], totals['errors']
 
 
 #############
@@ -572,6 +1320,160 @@ def test_best_wild_hand():
             == ['7C', '7D', '7H', '7S', 'JD'])
     print 'OK'
 
+def test_classify():
+    print "test_classify..."
+    counts = list(CATEGORY_COUNTS)
+    for hand, category in (("6C 7C 8C 9C TC 5C JS", STRAIGHT_FLUSH), ("JD TC TH 7C 7D 7S 7H", CARE),
+                           ("TD TC TH 7C 7D 8C 8S", FULL_HOUSE), ("2S 3S 4S 5S 9S 9D KD", FLASH),
+                           ("AS 2D 3C 4H 5S 5D KC", STRAIGHT), ("AS AD AC 4H 5S 8D KC", SET),
+                           ("AS AD 4C 4H 5S 5D KC", TWO_PAIR), ("AS AD 2C 4H 5S 8D KC", PAIR),
+                           ("AS 3D 2C 4H 9S 8D KC", HIGH_CARD)):
+        cards = parse_hand(hand.split())
+        assert classify(cards) == evaluate_best(cards), hand
+        assert get_category(classify(cards)[0]) == category, hand
+    assert [after - before for before, after in zip(counts, CATEGORY_COUNTS)] == [2] * len(CATEGORY_NAMES)
+    print 'OK'
+
+
+def test_hand_rank_int():
+    print "test_hand_rank_int..."
+    hands = [
+        "6C 7C 8C 9C TC".split(),
+        "TD TC TH 8C 8S".split(),
+        "JD 7C 7D 7S 7H".split(),
+        "AS 2D 3C 4H 5S".split(),
+        "KS KD 3C 3H 5S".split(),
+        "KS QD 3C 3H 5S".split(),
+    ]
+    for first, second in itertools.combinations(hands, 2):
+        assert cmp(hand_rank(first), hand_rank(second)) == cmp(hand_rank_int(first), hand_rank_int(second))
+    assert describe_hand_rank_int(hand_rank_int(hands[1])) == 'FULL HOUSE: T T T 8 8'
+    assert describe_hand_rank_int(hand_rank_int(hands[3])) == 'STRAIGHT: 5 4 3 2 A'
+    assert hand_rank_int("6C 7C 8C 9C TC 5C JS".split()) == hand_rank_int(hands[0])
+
+    ranks = card_ranks(hands[4])
+    assert ranks == [11, 11, 3, 1, 1] and two_pair(ranks) == (11, 1) and kind(1, ranks) == 3
+    assert kind(4, card_ranks(hands[2])) == 5 and kind(3, ranks) is None and two_pair(card_ranks(hands[5])) is None
+    assert straight(card_ranks(hands[3])) and straight(card_ranks(hands[0])) and not straight(ranks)
+    assert flush(hands[0]) and not flush(hands[1])
+    print 'OK'
+
+
+def test_showdown():
+    print "test_showdown..."
+    result = showdown('2C 7D 9S KH KD'.split(), [['AS', 'AH'], ['KS', 'QH'], ['AC', 'AD'], ['3C', '4C']])
+    assert result.winners == [1] and result.groups == [[1], [0, 2], [3]]
+    assert sorted(result.best_hands[1]) == ['9S', 'KD', 'KH', 'KS', 'QH']
+    assert result.strengths[0] == result.strengths[2] == evaluate_best(parse_hand('2C 7D 9S KH KD AS AH'.split()))[0]
+    print 'OK'
+
+
+def test_best_hand_batch():
+    print "test_best_hand_batch..."
+    if numpy is None:
+        print 'SKIP (numpy is not installed)'
+        return
+    hands = [
+        "6C 7C 8C 9C TC 5C JS".split(),
+        "TD TC TH 7C 7D 8C 8S".split(),
+        "JD TC TH 7C 7D 7S 7H".split(),
+        "AS 2D 3C 4H 5S 5D KC".split(),
+    ]
+    categories, strengths, indices = best_hand_batch(parse_hand_batch(hands))
+    for hand, category, strength, hand_indices in zip(hands, categories, strengths, indices):
+        assert strength == evaluate_best(parse_hand(hand))[0]
+        assert category == get_category(strength)
+        assert [hand[i] for i in hand_indices] == best_hand(hand)
+    print 'OK'
+
+
+def test_canonical_cache():
+    print "test_canonical_cache..."
+    cache = CanonicalCache()
+    # руки одного класса: масти переставлены (с джокером - только внутри цвета)
+    for hand in ("6C 7C 8C 9C TC 5C JS".split(), "6S 7S 8S 9S TS 5S JC".split(),
+                 "TD TC TH 7C 7D 8C 8S".split(), "TH TS TD 7S 7H 8S 8C".split(),
+                 "2S 2C 6D 3S 4H ?R".split(), "2C 2S 6H 3C 4D ?R".split()):
+        assert cache.best_hand(hand) == best_hand(hand), hand
+    info = cache.info()
+    assert (info.hits, info.misses, info.size) == (3, 3, 3)
+    print 'OK'
+
+
+def test_evaluate_stream():
+    print "test_evaluate_stream..."
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'hands.txt')
+        with open(path, 'w') as f:
+            f.write('6C 7C 8C 9C TC 5C JS\nXX\n2S 2C 6D 3S 4H ?R\n' * 50)
+        output = os.path.join(directory, 'out.txt')
+        assert evaluate_stream([path], output, workers=2, chunk_size=7, stats=None) == (150, 50)
+        with open(output) as f:
+            assert f.readline() == '6C 7C 8C 9C TC 5C JS\tTC 9C 8C 7C 6C\tSTRAIGHT FLUSH\t7458\n'
+        # ошибка записи останавливает конвейер, а не оставляет его ждать свободных слотов
+        try:
+            evaluate_stream([path], os.path.join(directory, 'missing', 'out.txt'), workers=2, stats=None)
+            assert False
+        except IOError:
+            pass
+    finally:
+        shutil.rmtree(directory)
+    print 'OK'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Poker hands evaluator')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('test', help='run self-tests (default)')
+    for command, help_text in (
+            ('build-table', 'build the 7-card rank table'),
+            ('check-table', 'validate the 7-card rank table checksum'),
+    ):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument('path', nargs='?', default=TABLE7_PATH)
+    subparser = subparsers.add_parser('check-wild', help='cross-check best_wild_hand against joker substitution')
+    subparser.add_argument('--size', type=int, default=5, choices=(5, 6, 7), help='cards in hand')
+    subparser = subparsers.add_parser('eval', help='stream hand records and evaluate best hands')
+    subparser.add_argument('paths', nargs='*', default=['-'], help="input files, '-' is stdin, *.gz is gzip")
+    subparser.add_argument('-o', '--output', default='-', help="output file, '-' is stdout, *.gz is gzip")
+    subparser.add_argument('--csv', action='store_true', help='input is csv, results are appended as columns')
+    subparser.add_argument('--column', type=int, default=0, help='csv column with space-separated cards')
+    subparser.add_argument('-j', '--workers', type=int, default=None, help='worker processes, 0 - inline')
+    subparser.add_argument('--chunk-size', type=int, default=STREAM_CHUNK_SIZE)
+    subparser.add_argument('--unordered', action='store_true', help='write chunks as soon as they are ready')
+    subparser.add_argument('-q', '--quiet', action='store_true', help='no throughput stats on stderr')
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv or ['test'])
+
+    if args.command == 'build-table':
+        print 'table7: {} crc32={:08x}'.format(args.path, build_table7(args.path))
+    elif args.command == 'check-table':
+        print 'table7: {} crc32={:08x} OK'.format(args.path, Table7(args.path).checksum)
+    elif args.command == 'check-wild':
+        print 'check-wild: {} hands OK'.format(check_wild_hands(args.size))
+    elif args.command == 'eval':
+        try:
+            evaluate_stream(
+                args.paths, args.output, csv_format=args.csv, column=args.column, workers=args.workers,
+                chunk_size=args.chunk_size, ordered=not args.unordered, stats=None if args.quiet else sys.stderr,
+            )
+        except (IOError, OSError, RuntimeError) as e:
+            sys.stderr.write('eval: {}\n'.format(e))
+            return 1
+    else:
+        test_best_hand()
+        test_best_wild_hand()
+        test_classify()
+        test_hand_rank_int()
+        test_showdown()
+        test_best_hand_batch()
+        test_canonical_cache()
+        test_evaluate_stream()
+
+
+load_table7()
+
 if __name__ == '__main__':
-    test_best_hand()
-    test_best_wild_hand()
+    sys.exit(main())
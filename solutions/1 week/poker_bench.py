@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Бенчмарк и проверка корректности poker.py.
+# Замеряет best_hand, best_wild_hand и hand_rank (время вызова и пакетная скорость) на
+# воспроизводимых наборах рук, сверяет best_hand с перебором всех 5ти карт через hand_rank,
+# сохраняет результаты в JSON и сравнивает их с результатами другого коммита.
+#
+# Пример:
+#   python poker_bench.py run -o before.json
+#   python poker_bench.py run -o after.json --baseline before.json --threshold 0.1
+# -----------------
+
+import sys
+import json
+import random
+import timeit
+import argparse
+import platform
+import itertools
+import subprocess
+
+import poker
+
+
+DECK = ['{}{}'.format(rank, suit) for rank in poker.RANKS for suit in poker.SUITS]
+HANDS = 2000
+CHECK_HANDS = 300
+THRESHOLD = 0.2  # допустимое замедление, доля
+
+
+#######################
+### наборы рук ###
+#######################
+
+def random_hands(rng, count, size=7, jokers=()):
+    """:return: count случайных рук из size карт, включая джокеров jokers"""
+    return [rng.sample(DECK, size - len(jokers)) + list(jokers) for _ in range(count)]
+
+
+def category_hand(rng, category, size=7):
+    """
+    :return: рука из size карт, собранная под категорию category (остальные карты случайные,
+    поэтому итоговая категория может оказаться старше)
+    """
+    ranks = list(poker.RANKS)
+    if category in (poker.STRAIGHT, poker.STRAIGHT_FLUSH):
+        high = rng.randrange(3, len(ranks))
+        window = [ranks[(high - i) % len(ranks)] if high - i >= 0 else 'A' for i in range(5)]
+        suit = rng.choice(poker.SUITS)
+        cards = [rank + (suit if category == poker.STRAIGHT_FLUSH else rng.choice(poker.SUITS)) for rank in window]
+    elif category == poker.FLASH:
+        suit = rng.choice(poker.SUITS)
+        cards = [rank + suit for rank in rng.sample(ranks, 5)]
+    else:
+        sizes = {
+            poker.HIGH_CARD: (1, 1, 1, 1, 1),
+            poker.PAIR: (2, 1, 1, 1),
+            poker.TWO_PAIR: (2, 2, 1),
+            poker.SET: (3, 1, 1),
+            poker.FULL_HOUSE: (3, 2),
+            poker.CARE: (4, 1),
+        }[category]
+        cards = []
+        for rank, count in zip(rng.sample(ranks, len(sizes)), sizes):
+            cards += [rank + suit for suit in rng.sample(poker.SUITS, count)]
+    cards = list(set(cards))
+    return cards + rng.sample([card for card in DECK if card not in cards], size - len(cards))
+
+
+def datasets(seed=0, count=HANDS):
+    """:return: {имя набора: руки}, наборы одинаковы при одинаковом seed"""
+    rng = random.Random(seed)
+    result = {
+        'random7': random_hands(rng, count),
+        'joker0': random_hands(rng, count),
+        'joker1': random_hands(rng, count // 2, jokers=[poker.RED_JOKER]) +
+                  random_hands(rng, count - count // 2, jokers=[poker.BLACK_JOKER]),
+        'joker2': random_hands(rng, count, jokers=poker.JOKERS),
+        'five': random_hands(rng, count, size=5),
+    }
+    for category, name in enumerate(poker.CATEGORY_NAMES):
+        result['category:' + name] = [category_hand(rng, category) for _ in range(count)]
+    return result
+
+
+###################
+### замеры ###
+###################
+
+def measure(func, hands):
+    """
+    :return: {per_call_us: медиана времени одного вызова, hands_per_s: скорость на всем наборе}
+    """
+    timer = timeit.default_timer
+    calls = []
+    for hand in hands:
+        start = timer()
+        func(hand)
+        calls.append(timer() - start)
+    start = timer()
+    for hand in hands:
+        func(hand)
+    bulk = timer() - start
+    calls.sort()
+    return {
+        'per_call_us': round(calls[len(calls) // 2] * 1e6, 3),
+        'hands_per_s': round(len(hands) / bulk, 1),
+    }
+
+
+def run_benchmarks(seed=0, count=HANDS):
+    """:return: {имя замера: результат measure}"""
+    data = datasets(seed, count)
+    benchmarks = {
+        'hand_rank:five': measure(poker.hand_rank, data['five']),
+        'best_hand:random7': measure(lambda hand: poker.best_hand(list(hand)), data['random7']),
+    }
+    for name in sorted(data):
+        if name.startswith('category:'):
+            benchmarks['best_hand:' + name] = measure(lambda hand: poker.best_hand(list(hand)), data[name])
+        if name.startswith('joker'):
+            benchmarks['best_wild_hand:' + name] = measure(lambda hand: poker.best_wild_hand(list(hand)), data[name])
+    return benchmarks
+
+
+###################################
+### проверка корректности ###
+###################################
+
+def reference_rank(hand):
+    """Эталон: лучший hand_rank среди всех наборов из 5ти карт руки (21 для 7ми карт)"""
+    return max(poker.hand_rank(combo) for combo in itertools.combinations(hand, 5))
+
+
+def reference_wild_rank(hand):
+    """Эталон с джокерами: все замены джокеров картами их цвета, затем reference_rank"""
+    real = [card for card in hand if card not in poker.JOKERS]
+    substitutions = [
+        [card for card in DECK if card[1] in (poker.RED_SUITS if joker == poker.RED_JOKER else poker.BLACK_SUITS)
+         and card not in real]
+        for joker in hand if joker in poker.JOKERS
+    ]
+    return max(
+        reference_rank(real + list(cards))
+        for cards in itertools.product(*substitutions) if len(set(cards)) == len(cards)
+    )
+
+
+def run_checks(seed=0, count=CHECK_HANDS):
+    """
+    Сверяет best_hand и best_wild_hand с эталоном на count руках каждого набора
+    :return: {имя набора: количество расхождений}, примеры расхождений в 'mismatches'
+    """
+    data = datasets(seed, count)
+    result = {'mismatches': []}
+    for name in sorted(data):
+        if name.startswith('joker'):
+            func, reference = poker.best_wild_hand, reference_wild_rank
+            hands = data[name][:max(count // 10, 1)] if name == 'joker2' else data[name]
+        else:
+            func, reference, hands = poker.best_hand, reference_rank, data[name]
+        errors = 0
+        for hand in hands:
+            best = func(list(hand))
+            real = [card for card in hand if card not in poker.JOKERS]
+            substituted = [card for card in best if card not in real]
+            if len(set(best)) != 5 or len(substituted) > len(hand) - len(real) or \
+                    poker.hand_rank(best) != reference(hand):
+                errors += 1
+                result['mismatches'].append({'hand': hand, 'best': best})
+        result[name] = errors
+    return result
+
+
+###########################
+### сравнение ###
+###########################
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    :return: список регрессий: замеры, у которых время вызова выросло больше, чем на threshold
+    """
+    regressions = []
+    for name, current in sorted(results['benchmarks'].items()):
+        previous = baseline['benchmarks'].get(name)
+        if previous and current['per_call_us'] > previous['per_call_us'] * (1 + threshold):
+            regressions.append('{}: {} us -> {} us (+{:.0%})'.format(
+                name, previous['per_call_us'], current['per_call_us'],
+                current['per_call_us'] / previous['per_call_us'] - 1,
+            ))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark and correctness suite for poker.py')
+    parser.add_argument('command', nargs='?', default='run', choices=('run', 'check'))
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='allowed slowdown, e.g. 0.2 = 20%%')
+    parser.add_argument('--hands', type=int, default=HANDS, help='hands per dataset')
+    parser.add_argument('--check-hands', type=int, default=CHECK_HANDS, help='hands per dataset to cross-check')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'seed': args.seed,
+        'table7': poker.table7 is not None,
+        'checks': run_checks(args.seed, args.check_hands),
+    }
+    if args.command == 'run':
+        results['hands'] = args.hands
+        results['benchmarks'] = run_benchmarks(args.seed, args.hands)
+        for name, values in sorted(results['benchmarks'].items()):
+            print '{:<32} {:>10.2f} us/call {:>12.0f} hands/s'.format(name, values['per_call_us'], values['hands_per_s'])
+    failed = sum(errors for name, errors in results['checks'].items() if name != 'mismatches')
+    print 'checks: {}'.format('OK' if not failed else '{} mismatches'.format(failed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    regressions = []
+    if args.baseline and args.command == 'run':
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for regression in regressions:
+            print 'REGRESSION', regression
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
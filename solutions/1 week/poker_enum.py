@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Полный перебор колоды: все C(52,7) = 133 784 560 рук из 7ми карт и, по желанию, все руки
+# с джокерами (6 карт + один джокер каждого цвета, 5 карт + оба джокера) для best_wild_hand.
+# Считает частоты категорий и распределение силы рук (ключей ранга), сверяет их с известными
+# комбинаторными итогами и печатает скорость (рук/с) по каждому процессу и общую.
+# Это и доказательство корректности оценки, и эталонный бенчмарк масштабирования.
+#
+# Работа делится между процессами по индексу первой карты руки (в отсортированной колоде).
+# Готовые куски сохраняются в checkpoint-файл, прерванный запуск продолжается с того же места.
+#
+# Пример:
+#   python poker_enum.py run -j 8 --checkpoint enum.json
+#   python poker_enum.py run --jokers 2 --checkpoint enum.json -o stats.json
+#   python poker_enum.py run --first 40-45   # только хвост колоды, быстро
+# -----------------
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+import poker
+
+
+DECK = sorted(poker.CARD_INTS.values())
+CHECKPOINT_VERSION = 1
+
+# известные итоги для 7ми карт: количество рук каждой категории и различных сил
+KNOWN_CATEGORY_COUNTS = {
+    poker.STRAIGHT_FLUSH: 41584,
+    poker.CARE: 224848,
+    poker.FULL_HOUSE: 3473184,
+    poker.FLASH: 4047644,
+    poker.STRAIGHT: 6180020,
+    poker.SET: 6461620,
+    poker.TWO_PAIR: 31433400,
+    poker.PAIR: 58627800,
+    poker.HIGH_CARD: 23294460,
+}
+KNOWN_DISTINCT_STRENGTHS = 4824
+
+# задания: имя -> (джокеры, реальных карт в руке)
+JOBS = (
+    ('7', (), 7),
+    ('6+?R', (poker.RED_JOKER,), 6),
+    ('6+?B', (poker.BLACK_JOKER,), 6),
+    ('5+?R?B', (poker.RED_JOKER, poker.BLACK_JOKER), 5),
+)
+JOKER_JOBS = {0: ('7',), 1: ('7', '6+?R', '6+?B'), 2: ('7', '6+?R', '6+?B', '5+?R?B')}
+
+# бит карты в маске руки из 52х бит: 13 бит рангов на масть, масти в порядке SUITS
+CARD_BITS = {card: 1 << (13 * poker.WEIGHT_SUITS[poker.get_suit(name)] + poker.get_int_rank(card))
+             for name, card in poker.CARD_INTS.items()}
+RANKS_MASK = (1 << len(poker.RANKS)) - 1
+
+
+def _combinations_count(n, k):
+    """:return: C(n, k)"""
+    count = 1
+    for i in range(k):
+        count = count * (n - i) // (i + 1)
+    return count
+
+
+def task_hands(size, first):
+    """:return: количество рук из size карт, младшая карта которых DECK[first]"""
+    return _combinations_count(len(DECK) - first - 1, size - 1)
+
+
+##########################
+### перебор одного куска ###
+##########################
+
+_rank_strengths = None  # сила по ключу рангов 7ми карт, общая для всех кусков процесса
+_wild_strengths = {}  # (джокеры, ключ класса рук) -> сила, см. _wild_key
+
+
+def _seven_rank_strengths():
+    """
+    :return: сила по сумме RANK_KEYS7 для всех наборов рангов 7ми карт без флэша
+    (масти назначаются по кругу, как в build_table7, тогда флэша нет)
+    """
+    global _rank_strengths
+    if _rank_strengths is None:
+        _rank_strengths = {}
+        for combo in itertools.combinations_with_replacement(range(len(poker.RANKS)), 7):
+            if any(combo.count(rank) > 4 for rank in set(combo)):
+                continue
+            cards = [poker.DECK_INTS[rank][i % len(poker.SUITS)] for i, rank in enumerate(combo)]
+            _rank_strengths[sum(poker.RANK_KEYS7[rank] for rank in combo)] = poker.evaluate(cards)
+    return _rank_strengths
+
+
+def _flush_possible(jokers):
+    """:return: таблица по упакованным счетчикам мастей: может ли быть флэш с этими джокерами"""
+    need = 5 - len(jokers)
+    return [any((counters >> 4 * suit) & 0xF >= need for suit in range(len(poker.SUITS)))
+            for counters in range(1 << 16)]
+
+
+def _wild_key(key, bits, jokers, flush_possible):
+    """
+    Ключ класса рук с джокерами одной силы
+    :param key: сумма CARD_KEYS7 реальных карт
+    :param bits: маска руки из 52х бит (CARD_BITS)
+    :return: без возможности флэша - ранги и ранги, в которых занят цвет каждого джокера
+        (джокер не может стать картой, которая уже есть в руке); иначе - маски мастей,
+        упорядоченные внутри цвета (масти одного цвета взаимозаменяемы)
+    """
+    spades, clubs = bits & RANKS_MASK, (bits >> 13) & RANKS_MASK
+    diamonds, hearts = (bits >> 26) & RANKS_MASK, bits >> 39
+    if flush_possible[key & 0xFFFF]:
+        return min(spades, clubs), max(spades, clubs), min(diamonds, hearts), max(diamonds, hearts)
+    return (key >> 16,) + tuple(
+        diamonds & hearts if joker == poker.RED_JOKER else spades & clubs for joker in jokers
+    )
+
+
+def enumerate_task(args):
+    """
+    Перебирает все руки задания, младшая карта которых DECK[first]
+    :param args: (имя задания, first)
+    :return: {'job', 'first', 'counts': {сила: количество}, 'hands', 'seconds', 'pid'}
+    """
+    job, first = args
+    jokers, size = dict((name, (jokers, size)) for name, jokers, size in JOBS)[job]
+    started = time.time()
+    counts = [0] * len(poker.HAND_RANKS)
+    keys = [poker.CARD_KEYS7[card] for card in DECK]
+    rest = range(first + 1, len(DECK))
+    if jokers:
+        flush_possible = _flush_possible(jokers)
+        strengths = _wild_strengths.setdefault(jokers, {})
+        bits = [CARD_BITS[card] for card in DECK]
+    else:
+        flush_suits = poker.FLUSH_SUITS7
+        rank_strengths = _seven_rank_strengths()
+
+    # внешние size-2 карты перебираются комбинациями, последняя - во внутреннем цикле с добавлением ключа
+    for prefix in itertools.combinations(rest[:-1], size - 2):
+        prefix_key = keys[first] + sum(keys[i] for i in prefix)
+        tail = range(prefix[-1] + 1 if prefix else first + 1, len(DECK))
+        if not jokers:
+            for last in tail:
+                key = prefix_key + keys[last]
+                if flush_suits[key & 0xFFFF]:
+                    cards = [DECK[first]] + [DECK[i] for i in prefix] + [DECK[last]]
+                    counts[poker.HandState(cards, key).strength()] += 1
+                else:
+                    counts[rank_strengths[key >> 16]] += 1
+            continue
+        prefix_bits = bits[first] + sum(bits[i] for i in prefix)
+        for last in tail:
+            key = prefix_key + keys[last]
+            hand_key = _wild_key(key, prefix_bits + bits[last], jokers, flush_possible)
+            strength = strengths.get(hand_key)
+            if strength is None:
+                cards = [DECK[first]] + [DECK[i] for i in prefix] + [DECK[last]]
+                strength = strengths[hand_key] = poker.evaluate_wild(cards, jokers)[0]
+            counts[strength] += 1
+
+    return {
+        'job': job,
+        'first': first,
+        'counts': {strength: count for strength, count in enumerate(counts) if count},
+        'hands': sum(counts),
+        'seconds': time.time() - started,
+        'pid': os.getpid(),
+    }
+
+
+#######################
+### checkpoint ###
+#######################
+
+def load_checkpoint(path):
+    """:return: {имя задания: {first: результат куска}} из checkpoint-файла, {} если файла нет"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != CHECKPOINT_VERSION:
+        raise ValueError('{}: unknown checkpoint version'.format(path))
+    done = {}
+    for job, tasks in data['jobs'].items():
+        for first, result in tasks.items():
+            result['counts'] = {int(strength): count for strength, count in result['counts'].items()}
+            done.setdefault(job, {})[int(first)] = result
+    return done
+
+
+def save_checkpoint(path, done):
+    """Записывает готовые куски атомарно: во временный файл и переименование"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'version': CHECKPOINT_VERSION, 'jobs': done}, f)
+    os.rename(temp_path, path)
+
+
+#####################
+### итоги ###
+#####################
+
+def summarize(job, results):
+    """
+    :param results: результаты кусков задания
+    :return: {'hands', 'categories': {имя: количество}, 'distinct', 'strengths': {сила: количество}}
+    """
+    strengths = {}
+    for result in results:
+        for strength, count in result['counts'].items():
+            strengths[strength] = strengths.get(strength, 0) + count
+    categories = dict.fromkeys(poker.CATEGORY_NAMES, 0)
+    for strength, count in strengths.items():
+        categories[poker.CATEGORY_NAMES[poker.get_category(strength)]] += count
+    return {
+        'hands': sum(strengths.values()),
+        'categories': categories,
+        'distinct': len(strengths),
+        'strengths': strengths,
+    }
+
+
+def verify(summaries):
+    """
+    :param summaries: {имя задания: summarize(...)} полностью перебранных заданий
+    :return: список расхождений с известными итогами
+    """
+    errors = []
+    jobs = dict((name, (jokers, size)) for name, jokers, size in JOBS)
+    for job, summary in sorted(summaries.items()):
+        expected = _combinations_count(len(DECK), jobs[job][1])
+        if summary['hands'] != expected:
+            errors.append('{}: {} hands, expected {}'.format(job, summary['hands'], expected))
+    if '7' in summaries:
+        summary = summaries['7']
+        for category, expected in sorted(KNOWN_CATEGORY_COUNTS.items()):
+            name = poker.CATEGORY_NAMES[category]
+            if summary['categories'][name] != expected:
+                errors.append('7: {} {}, expected {}'.format(name, summary['categories'][name], expected))
+        if summary['distinct'] != KNOWN_DISTINCT_STRENGTHS:
+            errors.append('7: {} distinct strengths, expected {}'.format(summary['distinct'],
+                                                                        KNOWN_DISTINCT_STRENGTHS))
+    # цвета симметричны: красный и черный джокер дают одно распределение
+    if '6+?R' in summaries and '6+?B' in summaries and \
+            summaries['6+?R']['strengths'] != summaries['6+?B']['strengths']:
+        errors.append('6+?R and 6+?B distributions differ')
+    return errors
+
+
+def run(jobs, processes=None, checkpoint=None, firsts=None, log=sys.stderr):
+    """
+    :param jobs: имена заданий (JOBS)
+    :param processes: количество процессов, None - по числу ядер, 1 - без пула
+    :param checkpoint: путь к checkpoint-файлу, готовые куски из него не пересчитываются
+    :param firsts: индексы первой карты для перебора, None - все
+    :return: {'jobs': {имя: итоги полностью перебранного задания}, 'errors', 'rate', 'workers'}
+    """
+    sizes = dict((name, size) for name, _, size in JOBS)
+    done = load_checkpoint(checkpoint)
+    tasks = [
+        (job, first)
+        for job in jobs for first in range(len(DECK) - sizes[job] + 1)
+        if (firsts is None or first in firsts) and first not in done.get(job, {})
+    ]
+    # крупные куски первыми, чтобы в конце не ждать одного долгого
+    tasks.sort(key=lambda task: -task_hands(sizes[task[0]], task[1]))
+
+    pool = None
+    if processes != 1 and tasks:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(enumerate_task, tasks)
+    else:
+        results = (enumerate_task(task) for task in tasks)
+
+    started = time.time()
+    workers = {}
+    try:
+        for result in results:
+            done.setdefault(result['job'], {})[result['first']] = result
+            if checkpoint:
+                save_checkpoint(checkpoint, done)
+            worker = workers.setdefault(result['pid'], {'hands': 0, 'seconds': 0.0})
+            worker['hands'] += result['hands']
+            worker['seconds'] += result['seconds']
+            if log:
+                log.write('{} first={}: {} hands in {:.1f}s ({:.0f} hands/s)\n'.format(
+                    result['job'], result['first'], result['hands'], result['seconds'],
+                    result['hands'] / max(result['seconds'], 1e-9)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    elapsed = time.time() - started
+
+    summaries = {}
+    for job in jobs:
+        if len(done.get(job, {})) == len(DECK) - sizes[job] + 1:
+            summaries[job] = summarize(job, done[job].values())
+    hands = sum(worker['hands'] for worker in workers.values())
+    return {
+        'jobs': summaries,
+        'errors': verify(summaries),
+        'rate': hands / elapsed if hands else 0.0,
+        'workers': {
+            pid: dict(worker, rate=worker['hands'] / max(worker['seconds'], 1e-9))
+            for pid, worker in workers.items()
+        },
+    }
+
+
+def parse_firsts(text):
+    """:param text: "40-45" или "0,3,7" -> множество индексов первой карты"""
+    firsts = set()
+    for part in text.split(','):
+        start, _, end = part.partition('-')
+        firsts.update(range(int(start), int(end or start) + 1))
+    return firsts
+
+
+#############
+### Тесты ###
+#############
+
+def test_enumerate_task():
+    print "test_enumerate_task..."
+    for job, jokers, size in JOBS:
+        first = len(DECK) - size - 4
+        result = enumerate_task((job, first))
+        expected = {}
+        for rest in itertools.combinations(DECK[first + 1:], size - 1):
+            cards = [DECK[first]] + list(rest)
+            strength = poker.evaluate_wild(cards, jokers)[0] if jokers else poker.evaluate(cards)
+            expected[strength] = expected.get(strength, 0) + 1
+        assert result['counts'] == expected and result['hands'] == task_hands(size, first)
+    print 'OK'
+
+
+def test_verify():
+    print "test_verify..."
+    strengths = {}
+    for category, count in KNOWN_CATEGORY_COUNTS.items():
+        strengths[next(strength for strength in range(1, len(poker.HAND_RANKS))
+                       if poker.get_category(strength) == category)] = count
+    summary = summarize('7', [{'counts': strengths}])
+    assert verify({'7': summary}) == ['7: 9 distinct strengths, expected 4824']
+    assert summary['hands'] == _combinations_count(52, 7)
+    print 'OK'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Enumerate every 7-card hand and verify category counts')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('test', help='run self-tests (default)')
+    run_parser = commands.add_parser('run', help='run the enumeration')
+    run_parser.add_argument('--jokers', type=int, default=0, choices=sorted(JOKER_JOBS),
+                            help='also enumerate hands with up to this many jokers')
+    run_parser.add_argument('-j', '--processes', type=int, help='worker processes (default: CPU count)')
+    run_parser.add_argument('--checkpoint', help='save finished chunks here and resume from it')
+    run_parser.add_argument('--first', help='only these first-card indices, e.g. 40-45')
+    run_parser.add_argument('-o', '--output', help='write totals and distributions as JSON')
+    run_parser.add_argument('-q', '--quiet', action='store_true', help='no per-chunk log on stderr')
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv or ['test'])
+
+    if args.command == 'test':
+        test_enumerate_task()
+        test_verify()
+        return 0
+
+    result = run(JOKER_JOBS[args.jokers], args.processes, args.checkpoint,
+                 parse_firsts(args.first) if args.first else None, log=None if args.quiet else sys.stderr)
+    for job, summary in sorted(result['jobs'].items()):
+        print '{}: {} hands, {} distinct strengths'.format(job, summary['hands'], summary['distinct'])
+        for category in reversed(range(len(poker.CATEGORY_NAMES))):
+            name = poker.CATEGORY_NAMES[category]
+            print '  {:<16} {:>12}'.format(name, summary['categories'][name])
+    for pid, worker in sorted(result['workers'].items()):
+        print 'process {}: {} hands, {:.0f} hands/s'.format(pid, worker['hands'], worker['rate'])
+    print 'total: {:.0f} hands/s'.format(result['rate'])
+    for error in result['errors']:
+        print 'MISMATCH', error
+    if not result['jobs']:
+        print 'checks: skipped, no job was enumerated completely'
+    else:
+        print 'checks: {}'.format('OK' if not result['errors'] else '{} mismatches'.format(len(result['errors'])))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
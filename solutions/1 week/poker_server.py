@@ -0,0 +1,607 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Сервер оценки рук (best_hand / best_wild_hand) с микро-пакетами.
+# Протокол - JSON построчно по TCP или Unix-сокету:
+#   -> {"id": 1, "hand": ["AS", "AH", "KS", "KH", "2C", "3D", "?R"], "timeout": 0.5}
+#   <- {"id": 1, "best_hand": [...], "rank": 1234567}  или  {"id": 1, "error": "timeout"}
+#   -> {"cmd": "stats"}  <- глубина очереди, пакеты, p50/p99 задержки
+# Одновременные запросы собираются в пакеты (не больше batch_size, не дольше max_delay) и
+# оцениваются в пуле процессов. Когда очередь полна, сервер перестает читать сокеты (backpressure).
+#
+# Пример:
+#   python poker_server.py serve --port 8765 --batch-size 64 --max-delay 0.002
+#   python poker_server.py bench --batch-sizes 1,8,64 --connections 8 --requests 5000
+#   python poker_server.py            # самопроверка (test)
+# -----------------
+
+import os
+import sys
+import json
+import time
+import Queue
+import errno
+import heapq
+import fcntl
+import random
+import signal
+import socket
+import shutil
+import asyncore
+import asynchat
+import argparse
+import tempfile
+import threading
+import collections
+import multiprocessing
+
+import poker
+
+
+BATCH_SIZE = 64
+MAX_DELAY = 0.002  # секунд ожидания неполного пакета
+MAX_PENDING = 10000  # запросов в очереди, дальше сокеты не читаются
+TIMEOUT = 5.0  # секунд на запрос по умолчанию
+MAX_INFLIGHT = 8  # пакетов в пуле одновременно; сервер ставит 2 * workers
+MAX_LINE = 1 << 16
+LATENCY_WINDOW = 10000  # последних запросов для p50/p99
+TICK = 0.05  # наибольшее время ожидания событий в цикле
+
+
+def evaluate_batch(hands):
+    """
+    Задача пула: оценка пакета рук. Исключения не выходят наружу: apply_async вызывает callback
+    только при успехе, и пакет с исключением навсегда остался бы в полете
+    :param hands: руки, array array str
+    :return: для каждой руки (лучшие 5 карт, hand_rank_int, None) или (None, None, ошибка)
+    """
+    results = []
+    for hand in hands:
+        try:
+            if not isinstance(hand, list) or not 5 <= len(hand) <= 7 or len(set(hand)) != len(hand):
+                raise ValueError('hand must be 5-7 distinct cards')
+            best = poker.best_hand([str(card) for card in hand])
+            results.append((best, poker.hand_rank_int(best), None))
+        except (KeyError, ValueError, TypeError) as e:
+            results.append((None, None, 'bad hand: {}'.format(e)))
+        except Exception as e:
+            results.append((None, None, 'internal error: {!r}'.format(e)))
+    return results
+
+
+def quantile(values, q):
+    """:return: квантиль q отсортированных значений values или 0.0"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Request(object):
+    __slots__ = ('channel', 'id', 'hand', 'received', 'deadline', 'answered', 'dispatched')
+
+    def __init__(self, channel, request_id, hand, received, deadline):
+        self.channel = channel
+        self.id = request_id
+        self.hand = hand
+        self.received = received
+        self.deadline = deadline
+        self.answered = False
+        self.dispatched = False
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Пробуждает цикл asyncore из потока пула, когда готов пакет"""
+
+    def __init__(self, socket_map):
+        read_fd, self.write_fd = os.pipe()
+        # поток пула не должен ждать на полном pipe: пробуждение там уже есть
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+        os.close(read_fd)  # file_dispatcher держит свой dup
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def writable(self):
+        return False
+
+
+class Batcher(object):
+    """Очередь запросов, сборка пакетов, отправка в пул, таймауты и метрики"""
+
+    def __init__(self, pool, waker, batch_size=BATCH_SIZE, max_delay=MAX_DELAY, max_pending=MAX_PENDING,
+                 max_inflight=MAX_INFLIGHT, timeout=TIMEOUT):
+        self.pool = pool
+        self.waker = waker
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.pending = collections.deque()
+        self.stale = 0  # просроченные запросы, еще лежащие в pending
+        self.deadlines = []  # куча (срок, номер запроса, запрос)
+        self.inflight = {}  # номер пакета -> запросы
+        self.done = Queue.Queue()  # (номер пакета, результаты) из потока пула
+        self.batch_ids = iter(xrange(sys.maxint))
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.counters = collections.Counter()
+
+    def depth(self):
+        return len(self.pending) - self.stale
+
+    def full(self):
+        return self.depth() >= self.max_pending
+
+    def submit(self, request):
+        self.counters['requests'] += 1
+        self.pending.append(request)
+        heapq.heappush(self.deadlines, (request.deadline, self.counters['requests'], request))
+
+    def answer(self, request, response, now):
+        if request.answered:
+            return
+        request.answered = True
+        self.latencies.append(now - request.received)
+        request.channel.send_response(response)
+
+    def _dispatch(self, now):
+        while self.pending and len(self.inflight) < self.max_inflight and (
+                len(self.pending) >= self.batch_size or now - self.pending[0].received >= self.max_delay):
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            size = len(batch)
+            batch = [request for request in batch if not request.answered]
+            self.stale -= size - len(batch)
+            if not batch:
+                continue
+            for request in batch:
+                request.dispatched = True
+            batch_id = next(self.batch_ids)
+            self.inflight[batch_id] = batch
+            self.counters['batches'] += 1
+            self.counters['batched'] += len(batch)
+
+            def callback(results, batch_id=batch_id):
+                self.done.put((batch_id, results))
+                self.waker.wake()
+
+            self.pool.apply_async(evaluate_batch, ([request.hand for request in batch],), callback=callback)
+
+    def _complete(self, now):
+        while True:
+            try:
+                batch_id, results = self.done.get_nowait()
+            except Queue.Empty:
+                return
+            for request, (best, rank, error) in zip(self.inflight.pop(batch_id), results):
+                if error:
+                    self.counters['errors'] += 1
+                    self.answer(request, {'id': request.id, 'error': error}, now)
+                else:
+                    self.answer(request, {'id': request.id, 'best_hand': best, 'rank': rank}, now)
+
+    def _expire(self, now):
+        # из кучи достаются только истекшие запросы, а не весь pending на каждой итерации цикла
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            request = heapq.heappop(deadlines)[2]
+            if request.answered:
+                continue
+            if not request.dispatched:
+                self.stale += 1
+            self.counters['timeouts'] += 1
+            self.answer(request, {'id': request.id, 'error': 'timeout'}, now)
+        # при одинаковом таймауте просроченные запросы - в начале очереди
+        while self.pending and self.pending[0].answered:
+            self.pending.popleft()
+            self.stale -= 1
+
+    def process(self):
+        now = time.time()
+        self._complete(now)
+        self._expire(now)
+        self._dispatch(now)
+
+    def wait_time(self):
+        """:return: сколько можно ждать событий сокетов до следующего пакета или таймаута"""
+        if not self.pending:
+            return TICK
+        wait = self.pending[0].received + self.max_delay - time.time()
+        if len(self.inflight) >= self.max_inflight:
+            wait = TICK
+        return max(0.0, min(wait, TICK))
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        batches = self.counters['batches']
+        return collections.OrderedDict([
+            ('queue_depth', self.depth()),
+            ('inflight_batches', len(self.inflight)),
+            ('requests', self.counters['requests']),
+            ('errors', self.counters['errors']),
+            ('timeouts', self.counters['timeouts']),
+            ('batches', batches),
+            ('mean_batch', float(self.counters['batched']) / batches if batches else 0.0),
+            ('p50', quantile(latencies, 0.5)),
+            ('p99', quantile(latencies, 0.99)),
+        ])
+
+
+class EvalChannel(asynchat.async_chat):
+    """Соединение клиента: строки JSON на входе, ответы в том же порядке, в каком готовы"""
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.buffer = []
+        self.buffered = 0
+        self.set_terminator(b'\n')
+
+    def readable(self):
+        # backpressure: пока очередь полна, клиенты ждут в TCP-буферах
+        return not self.server.batcher.full()
+
+    def collect_incoming_data(self, data):
+        self.buffered += len(data)
+        if self.buffered > MAX_LINE:
+            self.close()
+            return
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line, self.buffer, self.buffered = b''.join(self.buffer), [], 0
+        if not line.strip():
+            return
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError('request must be an object')
+        except ValueError as e:
+            self.send_response({'error': 'bad request: {}'.format(e)})
+            return
+        if message.get('cmd') == 'stats':
+            self.send_response(self.server.batcher.stats())
+            return
+        now = time.time()
+        timeout = message.get('timeout', self.server.batcher.timeout)
+        if not isinstance(timeout, (int, float)):
+            self.send_response({'id': message.get('id'), 'error': 'bad request: timeout must be a number'})
+            return
+        self.server.batcher.submit(Request(self, message.get('id'), message.get('hand'), now, now + timeout))
+
+    def send_response(self, response):
+        if self.connected:
+            self.push(json.dumps(response) + b'\n')
+
+
+class EvalServer(asyncore.dispatcher):
+    """Сервер: принимает соединения, цикл asyncore и сборка пакетов в одном потоке"""
+
+    def __init__(self, address, workers=None, **batcher_options):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        # пул создается до сокетов, чтобы его процессы их не наследовали
+        self.pool = multiprocessing.Pool(workers)
+        workers = workers or multiprocessing.cpu_count()
+        batcher_options.setdefault('max_inflight', 2 * workers)
+        self.batcher = Batcher(self.pool, _Waker(self.socket_map), **batcher_options)
+        if isinstance(address, tuple):
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.bind(address)
+        self.address = self.socket.getsockname()
+        self.listen(128)
+        self.running = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            EvalChannel(pair[0], self)
+
+    def serve_forever(self):
+        self.running = True
+        try:
+            while self.running:
+                asyncore.loop(timeout=self.batcher.wait_time(), count=1, map=self.socket_map)
+                self.batcher.process()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            asyncore.close_all(self.socket_map)
+            if not isinstance(self.address, tuple) and os.path.exists(self.address):
+                os.remove(self.address)
+
+    def stop(self):
+        self.running = False
+
+
+def serve(address, workers=None, stats_interval=None, ready=None, **batcher_options):
+    """
+    Запускает сервер до SIGTERM/SIGINT
+    :param address: (host, port) или путь Unix-сокета
+    :param stats_interval: секунд между выводами метрик в stderr, None - не выводить
+    :param ready: multiprocessing.Event, устанавливается, когда сокет слушает
+    """
+    server = EvalServer(address, workers, **batcher_options)
+    signal.signal(signal.SIGTERM, lambda *args: server.stop())
+    if stats_interval:
+        def report():
+            while server.running:
+                time.sleep(stats_interval)
+                sys.stderr.write(json.dumps(server.batcher.stats()) + '\n')
+        reporter = threading.Thread(target=report)
+        reporter.daemon = True
+        server.running = True
+        reporter.start()
+    if ready is not None:
+        ready.set()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+##################################
+### генератор нагрузки ###
+##################################
+
+DECK = ['{}{}'.format(rank, suit) for rank in poker.RANKS for suit in poker.SUITS]
+
+
+def connect(address):
+    sock = socket.socket(socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def _client(address, hands, window, latencies, errors):
+    """Одно соединение: держит до window запросов в полете, задержки пишет в latencies"""
+    sock = connect(address)
+    reader = sock.makefile('rb')
+    sent = {}
+    position = 0
+    try:
+        while position < len(hands) or sent:
+            lines = []
+            while position < len(hands) and len(sent) < window:
+                sent[position] = time.time()
+                lines.append(json.dumps({'id': position, 'hand': hands[position]}) + '\n')
+                position += 1
+            if lines:
+                sock.sendall(''.join(lines))
+            response = json.loads(reader.readline())
+            latencies.append(time.time() - sent.pop(response['id']))
+            if 'error' in response:
+                errors.append(response['error'])
+    finally:
+        reader.close()
+        sock.close()
+
+
+def load_test(address, connections=8, requests=5000, window=32, seed=0):
+    """
+    Нагрузка на запущенный сервер
+    :return: dict: запросов в секунду, p50/p99 задержки на клиенте, ошибки, метрики сервера
+    """
+    rng = random.Random(seed)
+    hands = [rng.sample(DECK, 7 - jokers) + list(poker.JOKERS[:jokers])
+             for jokers in (rng.choice((0, 0, 0, 1, 2)) for _ in range(requests))]
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(target=_client, args=(address, hands[i::connections], window, latencies, errors))
+        for i in range(connections)
+    ]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    sock = connect(address)
+    sock.sendall(json.dumps({'cmd': 'stats'}) + '\n')
+    stats = json.loads(sock.makefile('rb').readline())
+    sock.close()
+    latencies.sort()
+    return collections.OrderedDict([
+        ('requests_per_s', len(latencies) / elapsed),
+        ('p50', quantile(latencies, 0.5)),
+        ('p99', quantile(latencies, 0.99)),
+        ('errors', len(errors)),
+        ('server', stats),
+    ])
+
+
+def bench(batch_sizes, workers=None, max_delay=MAX_DELAY, **load_options):
+    """
+    Пропускная способность в зависимости от размера пакета: для каждого размера поднимается
+    локальный сервер на Unix-сокете и нагружается load_test
+    :return: [(batch_size, результат load_test)]
+    """
+    directory = tempfile.mkdtemp(prefix='poker-server-')
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            address = os.path.join(directory, 'server.sock')
+            ready = multiprocessing.Event()
+            process = multiprocessing.Process(target=serve, args=(address, workers), kwargs={
+                'ready': ready, 'batch_size': batch_size, 'max_delay': max_delay})
+            process.start()
+            try:
+                if not ready.wait(30):
+                    raise RuntimeError('server did not start')
+                results.append((batch_size, load_test(address, **load_options)))
+            finally:
+                process.terminate()
+                process.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def parse_address(args):
+    return args.unix if args.unix else (args.host, args.port)
+
+
+#############
+### Тесты ###
+#############
+
+class _InlinePool(object):
+    """Пул без процессов для тестов Batcher: задача выполняется сразу"""
+
+    def apply_async(self, func, args, callback=None):
+        result = func(*args)
+        if callback is not None:
+            callback(result)
+
+
+def test_batcher():
+    print "test_batcher..."
+    answers = []
+    channel = collections.namedtuple('Channel', 'send_response')(answers.append)
+    waker = collections.namedtuple('Waker', 'wake')(lambda: None)
+    batcher = Batcher(_InlinePool(), waker, max_delay=0.0)
+    now = time.time()
+    batcher.submit(Request(channel, 1, 'AS AH KS KH 2C 3D 4H'.split(), now, now + TIMEOUT))
+    batcher.process()
+    batcher.process()
+    assert answers == [{'id': 1, 'best_hand': ['AH', 'AS', 'KH', 'KS', '4H'],
+                        'rank': poker.hand_rank_int(['AH', 'AS', 'KH', 'KS', '4H'])}]
+    assert not batcher.inflight
+
+    # исключение при оценке - ответ с ошибкой, а не пакет, навсегда оставшийся в полете
+    best_hand = poker.best_hand
+    poker.best_hand = lambda hand: 1 // 0
+    try:
+        assert evaluate_batch([['AS', 'AH', 'KS', 'KH', '2C']]) == [
+            (None, None, "internal error: ZeroDivisionError('integer division or modulo by zero',)")]
+    finally:
+        poker.best_hand = best_hand
+
+    # истекшие запросы снимаются по куче сроков, в том числе из середины очереди
+    del answers[:]
+    batcher = Batcher(_InlinePool(), waker, max_delay=60.0)
+    now = time.time()
+    for request_id, timeout in enumerate([60, -1, 60, -1]):
+        batcher.submit(Request(channel, request_id, 'AS AH KS KH 2C 3D 4H'.split(), now, now + timeout))
+    batcher.process()
+    assert answers == [{'id': 1, 'error': 'timeout'}, {'id': 3, 'error': 'timeout'}]
+    assert batcher.stats()['queue_depth'] == 2 and batcher.stats()['timeouts'] == 2
+    batcher.max_delay = 0.0
+    batcher.process()
+    batcher.process()
+    assert [answer['id'] for answer in answers[2:]] == [0, 2] and batcher.stats()['queue_depth'] == 0
+    assert not batcher.pending and batcher.stale == 0
+
+    # полный pipe пробуждения не блокирует поток пула
+    waker = _Waker({})
+    try:
+        for _ in range(100000):
+            waker.wake()
+    finally:
+        waker.close()
+        os.close(waker.write_fd)
+    print 'OK'
+
+
+def test_server():
+    print "test_server..."
+    directory = tempfile.mkdtemp(prefix='poker-server-')
+    address = os.path.join(directory, 'server.sock')
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=serve, args=(address, 1), kwargs={'ready': ready})
+    process.start()
+    try:
+        assert ready.wait(30), 'server did not start'
+        sock = connect(address)
+        reader = sock.makefile('rb')
+        hand = 'AS AH KS KH 2C 3D 4H'.split()
+        for message, expected in (
+                ({'id': 1, 'hand': hand}, {'id': 1, 'best_hand': ['AH', 'AS', 'KH', 'KS', '4H'],
+                                           'rank': poker.hand_rank_int(['AH', 'AS', 'KH', 'KS', '4H'])}),
+                ({'id': 2, 'hand': hand, 'timeout': 0}, {'id': 2, 'error': 'timeout'}),
+        ):
+            sock.sendall(json.dumps(message) + '\n')
+            assert json.loads(reader.readline()) == expected
+        sock.sendall(json.dumps({'cmd': 'stats'}) + '\n')
+        stats = json.loads(reader.readline())
+        assert (stats['requests'], stats['timeouts'], stats['queue_depth']) == (2, 1, 0)
+        reader.close()
+        sock.close()
+    finally:
+        process.terminate()
+        process.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    assert process.exitcode == 0
+    print 'OK'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='best_hand evaluation server with micro-batching')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('test', help='run self-tests (default)')
+
+    serve_parser = commands.add_parser('serve', help='run the server')
+    load_parser = commands.add_parser('load', help='load a running server')
+    for command in (serve_parser, load_parser):
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8765)
+        command.add_argument('--unix', help='Unix socket path instead of TCP')
+    serve_parser.add_argument('-j', '--workers', type=int, help='worker processes (default: CPU count)')
+    serve_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    serve_parser.add_argument('--max-delay', type=float, default=MAX_DELAY, help='seconds to wait for a full batch')
+    serve_parser.add_argument('--max-pending', type=int, default=MAX_PENDING, help='queue size before backpressure')
+    serve_parser.add_argument('--timeout', type=float, default=TIMEOUT, help='default request timeout, seconds')
+    serve_parser.add_argument('--stats-interval', type=float, help='print metrics to stderr every N seconds')
+
+    bench_parser = commands.add_parser('bench', help='throughput against batch size on a local server')
+    bench_parser.add_argument('--batch-sizes', default='1,8,32,128')
+    bench_parser.add_argument('-j', '--workers', type=int)
+    bench_parser.add_argument('--max-delay', type=float, default=MAX_DELAY)
+    for command in (load_parser, bench_parser):
+        command.add_argument('--connections', type=int, default=8)
+        command.add_argument('--requests', type=int, default=5000)
+        command.add_argument('--window', type=int, default=32, help='requests in flight per connection')
+        command.add_argument('--seed', type=int, default=0)
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parser.parse_args(argv or ['test'])
+
+    if args.command == 'test':
+        test_batcher()
+        test_server()
+        return 0
+    if args.command == 'serve':
+        serve(parse_address(args), args.workers, args.stats_interval, batch_size=args.batch_size,
+              max_delay=args.max_delay, max_pending=args.max_pending, timeout=args.timeout)
+        return 0
+    load_options = {'connections': args.connections, 'requests': args.requests,
+                    'window': args.window, 'seed': args.seed}
+    if args.command == 'load':
+        print json.dumps(load_test(parse_address(args), **load_options), indent=2)
+        return 0
+    results = bench([int(size) for size in args.batch_sizes.split(',')], args.workers, args.max_delay,
+                    **load_options)
+    print '{:>10} {:>12} {:>10} {:>10} {:>10} {:>8}'.format('batch', 'requests/s', 'p50 ms', 'p99 ms', 'mean batch',
+                                                             'errors')
+    for batch_size, result in results:
+        print '{:>10} {:>12.0f} {:>10.2f} {:>10.2f} {:>10.1f} {:>8}'.format(
+            batch_size, result['requests_per_s'], result['p50'] * 1e3, result['p99'] * 1e3,
+            result['server']['mean_batch'], result['errors'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())